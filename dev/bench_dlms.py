@@ -0,0 +1,47 @@
+"""microbenchmark: native DLMS decoder vs. Gurux XML round-trip
+
+run via: python -m dev.bench_dlms
+"""
+
+import timeit
+import xml.etree.ElementTree as ET
+
+from gurux_dlms.GXDLMSTranslator import GXDLMSTranslator
+
+from src.smartmeter import dlms
+from tests.test_data import EVN_DECRYPTED_APDU, MY_DECRYPTED_APDU
+
+translator = GXDLMSTranslator()
+
+
+def decode_xml(apdu: str) -> dict:
+    """the former translate_dlms path: pduToXml, ElementTree and a linear scan"""
+    items = list(ET.fromstring(translator.pduToXml(apdu)).iter())
+    values = {}
+    for i, child in enumerate(items):
+        if child.tag == "OctetString" and "Value" in child.attrib:
+            if i + 1 < len(items) and "Value" in items[i + 1].attrib:
+                values[child.attrib["Value"]] = int(items[i + 1].attrib["Value"], 16)
+    return values
+
+
+def decode_native(apdu: str) -> dict:
+    try:
+        return dlms.decode_notification(bytes.fromhex(apdu))
+    except dlms.DlmsDecodeError as err:
+        return err.values
+
+
+def bench(name: str, function, apdu: str, number: int) -> float:
+    seconds = min(timeit.repeat(lambda: function(apdu), number=number, repeat=5))
+    per_frame = seconds / number * 1e6
+    print(f"{name:<28}{per_frame:10.1f} µs/frame")
+    return per_frame
+
+
+if __name__ == "__main__":
+    for label, apdu in (("evn", EVN_DECRYPTED_APDU), ("my", MY_DECRYPTED_APDU)):
+        print(f"sample frame: {label}")
+        xml = bench("  gurux xml", decode_xml, apdu, 200)
+        native = bench("  native", decode_native, apdu, 20000)
+        print(f"  speedup: {xml / native:.0f}x")
@@ -0,0 +1,451 @@
+"""benchmark of the decode and store path with synthetic T210-D telegrams
+
+Telegrams are generated like the meter sends them: a data-notification with
+varying values and date-time, encrypted with a known key and an increasing
+frame counter, split into a long and a short M-Bus frame. Every telegram
+goes through the stages of the gateway one by one:
+
+    frame    MbusFramer.feed
+    decrypt  parse the ciphered APDU, drop duplicates, AES
+    decode   native DLMS decoder and OBIS registry
+    reading  immutable Reading of the processed data
+    store    write a batch to the sink (per batch)
+
+The latency percentiles of every stage and the throughput are printed and,
+with --json, written as JSON. --baseline compares with an earlier result and
+exits with 1 if the throughput dropped or a median latency grew by more
+than --tolerance.
+
+run via: python -m dev.bench_pipeline [--telegrams 20000] [--store sqlite]
+
+The postgres stores use a throwaway schema in the database of database.ini,
+it is dropped again afterwards.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import perf_counter, perf_counter_ns
+
+from Cryptodome.Cipher import AES
+
+from src.smartmeter import dlms
+from src.smartmeter.config import Configuration
+from src.smartmeter.data import SmartmeterToPostgres
+from src.smartmeter.engine import DecodeEngine
+from src.smartmeter.mbus import MbusFramer
+from src.smartmeter.obis import parse_code
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from src.smartmeter.reading import ReadingBatch
+from src.smartmeter.sinks import Sink, SqliteSink
+
+BENCH_KEY = "000102030405060708090A0B0C0D0E0F"
+SYSTEM_TITLE = bytes.fromhex("4B464D6750000009")
+METER_NUMBER = b"181220000009"
+BENCH_SCHEMA = "smartmeter_bench"
+STAGES = ("frame", "decrypt", "decode", "reading", "store")
+STORES = ("none", "sqlite", "postgres", "postgres-copy")
+
+MAX_FRAME_PAYLOAD = 245  # L = 0xFA: C A CI STSAP DTSAP and 245 bytes of the APDU
+FRAME_HEADER = bytes([0x53, 0xFF])  # C A
+FRAME_TSAP = bytes([0x01, 0x67])  # STSAP DTSAP
+
+# the values the T210-D pushes: OBIS code, A-XDR tag, scaler, unit
+T210D_FIELDS = (
+    (parse_code("1.0.1.8.0.255"), dlms.TAG_UINT32, 0, 0x1E),
+    (parse_code("1.0.2.8.0.255"), dlms.TAG_UINT32, 0, 0x1E),
+    (parse_code("1.0.1.7.0.255"), dlms.TAG_UINT32, 0, 0x1B),
+    (parse_code("1.0.2.7.0.255"), dlms.TAG_UINT32, 0, 0x1B),
+    (parse_code("1.0.32.7.0.255"), dlms.TAG_UINT16, -1, 0x23),
+    (parse_code("1.0.52.7.0.255"), dlms.TAG_UINT16, -1, 0x23),
+    (parse_code("1.0.72.7.0.255"), dlms.TAG_UINT16, -1, 0x23),
+    (parse_code("1.0.31.7.0.255"), dlms.TAG_UINT16, -2, 0x21),
+    (parse_code("1.0.51.7.0.255"), dlms.TAG_UINT16, -2, 0x21),
+    (parse_code("1.0.71.7.0.255"), dlms.TAG_UINT16, -2, 0x21),
+    (parse_code("1.0.13.7.0.255"), dlms.TAG_UINT16, -3, 0xFF),
+)
+
+
+def encode_datetime(time: datetime, deviation: int = -60, status: int = 0x00) -> bytes:
+    """COSEM date-time of the local time, UTC = time + deviation (minutes)"""
+    return (
+        time.year.to_bytes(2, "big")
+        + bytes(
+            [
+                time.month,
+                time.day,
+                time.isoweekday(),
+                time.hour,
+                time.minute,
+                time.second,
+                time.microsecond // 10000,
+            ]
+        )
+        + deviation.to_bytes(2, "big", signed=True)
+        + bytes([status])
+    )
+
+
+def encode_notification(time: datetime, values: dict) -> bytes:
+    """data-notification as pushed by the T210-D, values by OBIS code (unscaled)"""
+    date_time = encode_datetime(time)
+    apdu = bytearray([dlms.DATA_NOTIFICATION, 0x80, 0x06, 0x87, 0x0E])
+    apdu += bytes([len(date_time)]) + date_time
+    apdu += bytes([dlms.TAG_STRUCTURE, 2 + 3 * len(T210D_FIELDS)])
+    apdu += bytes([dlms.TAG_OCTET_STRING, len(date_time)]) + date_time
+    for code, tag, scaler, unit in T210D_FIELDS:
+        apdu += bytes([dlms.TAG_OCTET_STRING, len(code)]) + code
+        _, size = dlms.INTEGER_TAGS[tag]
+        apdu += bytes([tag]) + values[code].to_bytes(size, "big")
+        apdu += bytes(
+            [dlms.TAG_STRUCTURE, 2, dlms.TAG_INT8, scaler & 0xFF, dlms.TAG_ENUM, unit]
+        )
+    apdu += bytes([dlms.TAG_OCTET_STRING, len(METER_NUMBER)]) + METER_NUMBER
+    return bytes(apdu)
+
+
+def encrypt_telegram(
+    key: str, apdu: bytes, frame_counter: int, system_title: bytes = SYSTEM_TITLE
+) -> bytes:
+    """encrypt an APDU (AES-GCM without tag) and split it into M-Bus frames"""
+    invocation = frame_counter.to_bytes(4, "big")
+    cipher = AES.new(bytes.fromhex(key), AES.MODE_GCM, nonce=system_title + invocation)
+    secured = bytes([0x20]) + invocation + cipher.encrypt(apdu)
+    length = len(secured)
+    if length < 0x80:
+        length_field = bytes([length])
+    elif length < 0x100:
+        length_field = bytes([0x81, length])
+    else:
+        length_field = bytes([0x82]) + length.to_bytes(2, "big")
+    payload = bytes([0xDB, len(system_title)]) + system_title + length_field + secured
+    frames = []
+    chunks = range(0, len(payload), MAX_FRAME_PAYLOAD)
+    for segment, start in enumerate(chunks):
+        chunk = payload[start : start + MAX_FRAME_PAYLOAD]
+        ci = segment | (0x10 if start + MAX_FRAME_PAYLOAD >= len(payload) else 0)
+        user_data = FRAME_HEADER + bytes([ci]) + FRAME_TSAP + chunk
+        frames.append(
+            bytes([0x68, len(user_data), len(user_data), 0x68])
+            + user_data
+            + bytes([sum(user_data) & 0xFF, 0x16])
+        )
+    return b"".join(frames)
+
+
+def synthetic_values(rng: random.Random, energy: list[int]) -> dict:
+    """plausible raw values, energy (Wh bought and sold) keeps counting up"""
+    power = [rng.randrange(0, 12000), rng.randrange(0, 3000)]
+    energy[0] += power[0] // 720  # 5 s
+    energy[1] += power[1] // 720
+    raw = energy + power
+    raw += [rng.randrange(2200, 2450) for _ in range(3)]  # 0.1 V
+    raw += [rng.randrange(0, 2500) for _ in range(3)]  # 0.01 A
+    raw.append(rng.randrange(500, 1000))  # 0.001
+    return {field[0]: value for field, value in zip(T210D_FIELDS, raw)}
+
+
+def synthetic_telegrams(
+    count: int,
+    key: str = BENCH_KEY,
+    seed: int = 0,
+    first_frame_counter: int = 1,
+    start: datetime = datetime(2024, 1, 1),
+) -> list[tuple[bytes, dict]]:
+    """count telegrams pushed every 5 seconds, with the raw values of each"""
+    rng = random.Random(seed)
+    energy = [rng.randrange(10**6, 10**8), rng.randrange(0, 10**6)]
+    telegrams = []
+    for i in range(count):
+        values = synthetic_values(rng, energy)
+        apdu = encode_notification(start + timedelta(seconds=5 * i), values)
+        telegrams.append((encrypt_telegram(key, apdu, first_frame_counter + i), values))
+    return telegrams
+
+
+def percentiles(samples: list[int]) -> dict:
+    """latency percentiles in µs of samples in ns"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+
+    def at(fraction: float) -> float:
+        return ordered[round(fraction * last)] / 1000
+
+    return {
+        "count": len(ordered),
+        "mean_us": sum(ordered) / len(ordered) / 1000,
+        "p50_us": at(0.50),
+        "p90_us": at(0.90),
+        "p99_us": at(0.99),
+        "max_us": ordered[-1] / 1000,
+    }
+
+
+class WriterSink(Sink):
+    """write the batches with a PostgresWriter, as INSERT or COPY"""
+
+    def __init__(self, writer, copy: bool = False) -> None:
+        self.writer = writer
+        self.copy = copy
+
+    def write(self, batch: ReadingBatch) -> None:
+        if self.copy:
+            self.writer.copy(list(batch.rows()))
+            return
+        for row in batch.rows():
+            self.writer.add(row)
+        self.writer.flush()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+@contextmanager
+def throwaway_postgres(registry):
+    """connection parameters of a new schema with the smartmeter table, dropped on exit"""
+    import psycopg2
+
+    from src.smartmeter.schema import SchemaManager
+
+    params = Configuration().postgresql_config()
+    admin = psycopg2.connect(**params)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+            cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        bench_params = dict(params, options=f"-c search_path={BENCH_SCHEMA}")
+        conn = psycopg2.connect(**bench_params)
+        with conn, conn.cursor() as cur:
+            SchemaManager(registry).create(cur)
+        conn.close()
+        yield bench_params
+    finally:
+        with admin.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        admin.close()
+
+
+@contextmanager
+def open_store(store: str, registry, batch_size: int):
+    """the sink of a store, cleaned up on exit"""
+    if store == "none":
+        yield None
+    elif store == "sqlite":
+        with tempfile.TemporaryDirectory() as directory:
+            sink = SqliteSink(os.path.join(directory, "bench.sqlite"), registry)
+            try:
+                yield sink
+            finally:
+                sink.close()
+    elif store in ("postgres", "postgres-copy"):
+        from src.smartmeter.postgresql_writer import PostgresWriter
+        from src.smartmeter.schema import SchemaManager
+
+        with throwaway_postgres(registry) as params:
+            writer = PostgresWriter(
+                params,
+                batch_size=batch_size,
+                max_buffer=batch_size,
+                schema=SchemaManager(registry),
+                registry=registry,
+            )
+            sink = WriterSink(writer, copy=store == "postgres-copy")
+            try:
+                yield sink
+            finally:
+                sink.close()
+    else:
+        raise ValueError(f"unknown store {store}")
+
+
+def run_benchmark(
+    decoder: SmartmeterToPostgres,
+    telegrams: list[bytes],
+    sink: Sink = None,
+    batch_size: int = 100,
+    key: str = BENCH_KEY,
+) -> dict:
+    """push the telegrams through all stages, return the samples (ns) and seconds"""
+    framer = MbusFramer()
+    decryptor = decoder.decryptor(key)
+    samples = {stage: [] for stage in STAGES}
+    batch = ReadingBatch(decoder.registry)
+    received = datetime(2024, 1, 1)
+    stored = 0
+
+    def store() -> None:
+        nonlocal batch, stored
+        begin = perf_counter_ns()
+        sink.write(batch)
+        samples["store"].append(perf_counter_ns() - begin)
+        stored += len(batch)
+        batch = ReadingBatch(decoder.registry)
+
+    start = perf_counter()
+    for data in telegrams:
+        t0 = perf_counter_ns()
+        framed = framer.feed(data)
+        samples["frame"].append(perf_counter_ns() - t0)
+        for telegram in framed:
+            # the steps of SmartmeterToPostgres.process_telegram, timed one by one
+            t1 = perf_counter_ns()
+            decoder.data = {}
+            apdu = decoder.decrypt_telegram(telegram, decryptor)
+            t2 = perf_counter_ns()
+            samples["decrypt"].append(t2 - t1)
+            if apdu is None:
+                continue
+            decoder.data["DeviceTime"] = dlms.notification_utc(apdu)
+            decoder.translate_dlms(apdu)
+            t3 = perf_counter_ns()
+            samples["decode"].append(t3 - t2)
+            reading = decoder.reading(received, "bench")
+            samples["reading"].append(perf_counter_ns() - t3)
+            if sink is not None:
+                batch.append(reading)
+                if len(batch) >= batch_size:
+                    store()
+    if sink is not None and batch:
+        store()
+    return {"samples": samples, "seconds": perf_counter() - start, "stored": stored}
+
+
+def summarize(run: dict, telegrams: int, store: str, batch_size: int) -> dict:
+    """machine-readable result of a run"""
+    samples = run["samples"]
+    decode_ns = sum(
+        sum(samples[stage]) for stage in ("frame", "decrypt", "decode", "reading")
+    )
+    return {
+        "benchmark": "pipeline",
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "telegrams": telegrams,
+        "store": store,
+        "batch_size": batch_size,
+        "stored": run["stored"],
+        "stages": {stage: percentiles(samples[stage]) for stage in STAGES},
+        "throughput": {
+            "decode_per_s": telegrams / (decode_ns / 1e9) if decode_ns else 0.0,
+            "end_to_end_per_s": telegrams / run["seconds"],
+        },
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float = 0.2) -> list[str]:
+    """the regressions of result against baseline"""
+    regressions = []
+    for name, value in baseline.get("throughput", {}).items():
+        current = result["throughput"].get(name)
+        if current is not None and current < value * (1 - tolerance):
+            regressions.append(f"{name}: {current:.0f}/s, was {value:.0f}/s")
+    for stage, stats in baseline.get("stages", {}).items():
+        before = stats.get("p50_us")
+        current = result["stages"].get(stage, {}).get("p50_us")
+        if before and current is not None and current > before * (1 + tolerance):
+            regressions.append(f"{stage} p50: {current:.1f} µs, was {before:.1f} µs")
+    return regressions
+
+
+def print_result(result: dict) -> None:
+    print(
+        f"{result['telegrams']} telegrams, store {result['store']}"
+        f" (batch size {result['batch_size']})"
+    )
+    print(f"{'stage':<10}{'p50 µs':>10}{'p90 µs':>10}{'p99 µs':>10}{'max µs':>10}")
+    for stage, stats in result["stages"].items():
+        if stats["count"]:
+            print(
+                f"{stage:<10}{stats['p50_us']:10.1f}{stats['p90_us']:10.1f}"
+                f"{stats['p99_us']:10.1f}{stats['max_us']:10.1f}"
+            )
+    throughput = result["throughput"]
+    print(f"decode:     {throughput['decode_per_s']:10.0f} telegrams/s")
+    print(f"end to end: {throughput['end_to_end_per_s']:10.0f} telegrams/s")
+
+
+def bench_engine(
+    config: Configuration,
+    telegrams: list[bytes],
+    workers: list[int],
+    chunk_size: int = 2000,
+) -> dict[int, float]:
+    """telegrams per second decoded by a DecodeEngine with each number of workers"""
+    framer = MbusFramer()
+    frames = [
+        ("bench", frame, None)
+        for telegram in telegrams
+        for frame in framer.feed(telegram)
+    ]
+    rates = {}
+    for count in workers:
+        with DecodeEngine(config, {"bench": BENCH_KEY}, count, chunk_size) as engine:
+            # the workers are started by the first tasks
+            list(engine.decode(frames[: chunk_size * max(count, 1)]))
+            started = perf_counter()
+            decoded = sum(len(batch) for batch in engine.decode(frames))
+            rates[count] = decoded / (perf_counter() - started)
+    return rates
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="benchmark decoding and storing synthetic T210-D telegrams"
+    )
+    parser.add_argument("--telegrams", type=int, default=20000)
+    parser.add_argument("--warmup", type=int, default=500)
+    parser.add_argument("--store", choices=STORES, default="none")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the result to this file")
+    parser.add_argument("--baseline", help="result of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--engine",
+        help="decode with DecodeEngine for these worker counts, e.g. 1,2,4,8",
+    )
+    args = parser.parse_args()
+
+    generated = synthetic_telegrams(args.warmup + args.telegrams, seed=args.seed)
+    telegrams = [telegram for telegram, _ in generated]
+    config = Configuration()
+    if args.engine:
+        workers = [int(count) for count in args.engine.split(",")]
+        rates = bench_engine(config, telegrams, workers)
+        for count, rate in rates.items():
+            print(
+                f"{count} workers: {rate:10.0f} telegrams/s ({rate / rates[workers[0]]:.2f}x)"
+            )
+        return
+    decoder = SmartmeterToPostgres(config, PostgresTasks(config))
+    run_benchmark(decoder, telegrams[: args.warmup])
+    with open_store(args.store, decoder.registry, args.batch_size) as sink:
+        run = run_benchmark(
+            decoder, telegrams[args.warmup :], sink, batch_size=args.batch_size
+        )
+    result = summarize(run, args.telegrams, args.store, args.batch_size)
+    print_result(result)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
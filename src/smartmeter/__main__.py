@@ -1,17 +1,18 @@
 # from fronius_data_postgresql import FroniusToInflux
 import os
 import logging
+import sys
 
 from dev.definitions import ROOT_DIR
 from src.smartmeter.postgresql_tasks import PostgresTasks
-from src.smartmeter.data import SmartmeterToPostgres
+from src.smartmeter.gateway import Gateway
 from src.smartmeter.config import Configuration
 
 # instance of Configuration class
 config = Configuration()
 
 # instance of PostgresTasks class
-client = PostgresTasks()
+client = PostgresTasks(config)
 
 # initialize logging
 loggingFile: str = os.path.join(ROOT_DIR, "smartmeter-postgres.log")
@@ -25,7 +26,12 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
 )
 
-smartmeter_postg = SmartmeterToPostgres(config, client)
-
 if __name__ == "__main__":
-    smartmeter_postg.run()
+    if sys.argv[1:2] == ["export"]:
+        # python -m src.smartmeter export ..., see export.py
+        from src.smartmeter.export import main
+
+        main(sys.argv[2:], config)
+    else:
+        # one meter or several meters listed in main_config.yaml, see Gateway
+        Gateway(config, client).run()
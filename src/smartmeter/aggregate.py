@@ -0,0 +1,242 @@
+"""streaming aggregation of the readings into wall-clock aligned windows
+
+The meter pushes a telegram every 5 seconds. Instead of storing every one,
+a sink can store one row per window (e.g. 10 s and 1 min) and meter with
+the number of samples, the time of the last reading and, for every field of
+the OBIS registry:
+
+    energy counters (integer columns)  <column>_first, <column>_last
+    power, voltage, current, ...       <column>_min, <column>_max, <column>_mean,
+                                       <column>_count (values in the mean)
+
+Windows are aligned to the clock (UTC) by the time of the readings and
+closed by the first reading of a later window, so nothing depends on
+timers. Peaks between two stored rows are kept in min/max.
+
+The rows are upserted into the table smartmeter_window, a window which was
+written before (e.g. the part before a restart) is merged with the new rows.
+Only rows with later readings than the stored window are merged, writing
+the same rows twice (e.g. retried after a lost connection) changes nothing.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.reading import Reading
+
+EPOCH = datetime(1970, 1, 1)
+WINDOW_KEY = ("bucket", "seconds", "meter_id")
+WINDOW_PREFIX = WINDOW_KEY + ("samples", "latest")
+
+CREATE_WINDOW = """
+    CREATE TABLE IF NOT EXISTS smartmeter_window (
+    bucket TIMESTAMP NOT NULL,
+    seconds INTEGER NOT NULL,
+    meter_id VARCHAR(32) NOT NULL,
+    samples INTEGER NOT NULL,
+    latest TIMESTAMP,
+    {columns},
+    PRIMARY KEY (meter_id, seconds, bucket)
+    )
+"""
+
+
+def field_columns(field) -> list[tuple[str, str]]:
+    """(column, SQL type) of the aggregates of a field"""
+    if field.integer:
+        return [
+            (f"{field.column}_first", field.sql_type),
+            (f"{field.column}_last", field.sql_type),
+        ]
+    return [
+        (f"{field.column}_min", field.sql_type),
+        (f"{field.column}_max", field.sql_type),
+        (f"{field.column}_mean", field.sql_type),
+        (f"{field.column}_count", "INTEGER"),
+    ]
+
+
+def window_columns(registry: ObisRegistry = DEFAULT_REGISTRY) -> tuple:
+    """the columns of smartmeter_window, ordered as the rows of WindowAggregator"""
+    columns = [
+        column for field in registry.fields for column, _ in field_columns(field)
+    ]
+    return WINDOW_PREFIX + tuple(columns)
+
+
+def create_window_sql(registry: ObisRegistry = DEFAULT_REGISTRY) -> str:
+    definitions = [
+        f"{column} {sql_type}"
+        for field in registry.fields
+        for column, sql_type in field_columns(field)
+    ]
+    return CREATE_WINDOW.format(columns=",\n    ".join(definitions))
+
+
+def upsert_window_sql(
+    registry: ObisRegistry = DEFAULT_REGISTRY,
+    values: str = "%s",
+    greatest: str = "GREATEST",
+    least: str = "LEAST",
+) -> str:
+    """INSERT of window rows which merges a window stored before
+
+    A row is merged only if its last reading is later than the one of the
+    stored window (latest), windows stored without latest are always merged.
+    values is the VALUES clause of the driver, greatest and least the scalar
+    functions of the database (SQLite: max, min).
+    """
+    table = "smartmeter_window"
+    columns = window_columns(registry)
+
+    def merge(function: str, column: str) -> str:
+        # a NULL on one side keeps the other value
+        return (
+            f"{function}(COALESCE({table}.{column}, excluded.{column}),"
+            f" COALESCE(excluded.{column}, {table}.{column}))"
+        )
+
+    updates = [
+        f"samples = {table}.samples + excluded.samples",
+        "latest = excluded.latest",
+    ]
+    for field in registry.fields:
+        column = field.column
+        if field.integer:
+            updates.append(
+                f"{column}_first = COALESCE({table}.{column}_first, excluded.{column}_first)"
+            )
+            updates.append(
+                f"{column}_last = COALESCE(excluded.{column}_last, {table}.{column}_last)"
+            )
+        else:
+            updates.append(f"{column}_min = {merge(least, column + '_min')}")
+            updates.append(f"{column}_max = {merge(greatest, column + '_max')}")
+            # windows stored before the count column: every sample had the value
+            stored = (
+                f"COALESCE({table}.{column}_count, CASE WHEN {table}.{column}_mean"
+                f" IS NULL THEN 0 ELSE {table}.samples END)"
+            )
+            count = f"{stored} + COALESCE(excluded.{column}_count, 0)"
+            updates.append(
+                f"{column}_mean = (COALESCE({table}.{column}_mean * {stored}, 0)"
+                f" + COALESCE(excluded.{column}_mean * excluded.{column}_count, 0))"
+                f" / NULLIF({count}, 0)"
+            )
+            updates.append(f"{column}_count = {count}")
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values}"
+        f" ON CONFLICT (meter_id, seconds, bucket) DO UPDATE SET {', '.join(updates)}"
+        f" WHERE {table}.latest IS NULL OR excluded.latest > {table}.latest"
+    )
+
+
+class Window:
+    """the aggregates of one meter in one window"""
+
+    __slots__ = (
+        "bucket",
+        "samples",
+        "latest",
+        "first",
+        "last",
+        "minimum",
+        "maximum",
+        "sums",
+        "counts",
+    )
+
+    def __init__(self, bucket: datetime, size: int) -> None:
+        self.bucket = bucket
+        self.samples = 0
+        self.latest = None  # time of the last reading
+        self.first = [None] * size
+        self.last = [None] * size
+        self.minimum = [None] * size
+        self.maximum = [None] * size
+        self.sums = [0.0] * size
+        self.counts = [0] * size
+
+    def add(self, time: datetime, values: tuple) -> None:
+        self.samples += 1
+        self.latest = time
+        first, last = self.first, self.last
+        minimum, maximum = self.minimum, self.maximum
+        sums, counts = self.sums, self.counts
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            if first[i] is None:
+                first[i] = minimum[i] = maximum[i] = value
+            elif value < minimum[i]:
+                minimum[i] = value
+            elif value > maximum[i]:
+                maximum[i] = value
+            last[i] = value
+            sums[i] += value
+            counts[i] += 1
+
+
+class WindowAggregator:
+    """aggregate the readings of every meter into windows of seconds"""
+
+    def __init__(self, seconds: int, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        if seconds <= 0:
+            raise ValueError("the window must be longer than 0 seconds")
+        self.seconds = seconds
+        self.length = timedelta(seconds=seconds)
+        self.integers = tuple(field.integer for field in registry.fields)
+        self.windows: dict[str, Window] = {}  # open window by meter id
+        self.late = 0  # readings older than the open window, dropped
+
+    def bucket(self, time: datetime) -> datetime:
+        """start of the window of time, aligned to the clock"""
+        return time - (time - EPOCH) % self.length
+
+    def add(self, reading: Reading) -> list[tuple]:
+        """add a reading, return the rows of the windows it closed"""
+        bucket = self.bucket(reading.time)
+        window = self.windows.get(reading.meter_id)
+        rows = []
+        if window is not None and window.bucket != bucket:
+            if bucket < window.bucket:
+                self.late += 1
+                logging.debug(
+                    "reading of %s older than the open window, dropped", reading.time
+                )
+                return rows
+            rows.append(self.row(reading.meter_id, window))
+            window = None
+        if window is None:
+            window = Window(bucket, len(self.integers))
+            self.windows[reading.meter_id] = window
+        window.add(reading.time, reading.values)
+        return rows
+
+    def flush(self) -> list[tuple]:
+        """close the open windows (on shutdown)"""
+        rows = [self.row(meter_id, window) for meter_id, window in self.windows.items()]
+        self.windows = {}
+        return rows
+
+    def row(self, meter_id: str, window: Window) -> tuple:
+        """the window as row of smartmeter_window"""
+        row = [window.bucket, self.seconds, meter_id, window.samples, window.latest]
+        for i, integer in enumerate(self.integers):
+            if integer:
+                row += (window.first[i], window.last[i])
+            else:
+                count = window.counts[i]
+                mean = window.sums[i] / count if count else None
+                row += (window.minimum[i], window.maximum[i], mean, count)
+        return tuple(row)
+
+
+def aggregators(
+    windows, registry: ObisRegistry = DEFAULT_REGISTRY
+) -> tuple[bool, list]:
+    """split the windows of a sink (seconds, 0: every reading) into (raw, aggregators)"""
+    windows = list(windows or [])
+    raw = not windows or 0 in windows
+    return raw, [WindowAggregator(seconds, registry) for seconds in windows if seconds]
@@ -0,0 +1,62 @@
+"""capture of the raw bytes read from the serial ports, for debugging
+
+Instead of logging telegrams as hex, the bytes of every meter are appended
+to a binary file exactly as they were read, including noise between the
+telegrams. The file is rotated like a RotatingFileHandler (capture.bin,
+capture.bin.1, ...) so it never grows beyond max_bytes * (backups + 1).
+Capture files are raw serial dumps and can be decoded offline:
+
+    python -m src.smartmeter.replay --dry-run capture/haus.bin.1 capture/haus.bin
+
+Enabled with captureDir in main_config.yaml.
+"""
+
+import logging
+import os
+import threading
+
+
+class FrameCapture:
+    """append bytes to a rotating binary file"""
+
+    def __init__(self, path: str, max_bytes: int = 16 << 20, backups: int = 5) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups  # rotated files kept
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # unbuffered, the serial port delivers a few hundred bytes at a time
+        self.file = open(path, "ab", buffering=0)
+        self.size = self.file.tell()
+
+    def write(self, data: bytes) -> None:
+        with self.lock:
+            if self.size and self.size + len(data) > self.max_bytes:
+                self.rotate()
+            self.file.write(data)
+            self.size += len(data)
+
+    def rotate(self) -> None:
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "ab", buffering=0)
+        self.size = 0
+        logging.info(f"capture {self.path} rotated")
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+    def files(self) -> list[str]:
+        """the capture files, oldest first"""
+        rotated = [f"{self.path}.{index}" for index in range(self.backups, 0, -1)]
+        return [path for path in rotated + [self.path] if os.path.exists(path)]
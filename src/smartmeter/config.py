@@ -1,11 +1,143 @@
+import logging
 import os
-import yaml
+import re
 from configparser import ConfigParser
+from types import MappingProxyType
+
+import yaml
+
 from dev.definitions import ROOT_DIR
-from dotenv import load_dotenv
+
+NUMBER = (int, float)
+OPTIONAL_STRING = (str, type(None))
+
+# type of every key of main_config.yaml, checked once when it is loaded
+YAML_TYPES = {
+    "port": str,
+    "baudrate": int,
+    "printValue": bool,
+    "usePostgres": bool,
+    "batchSize": int,
+    "batchMaxAge": NUMBER,
+    "meterId": (str, int),
+    "authenticationKeyEnv": OPTIONAL_STRING,
+    "useMeterTime": bool,
+    "frameCounterFile": str,
+    "spoolDir": OPTIONAL_STRING,
+    "spoolMaxMB": int,
+    "spoolSyncInterval": NUMBER,
+    "queueSize": int,
+    "decodeWorkers": int,
+    "statsInterval": NUMBER,
+    "metricsPort": int,
+    "metricsHost": str,
+    "logRateLimit": NUMBER,
+    "captureDir": OPTIONAL_STRING,
+    "captureMaxMB": int,
+    "captureFiles": int,
+    "profileFile": OPTIONAL_STRING,
+    "liveDir": OPTIONAL_STRING,
+    "profileInterval": NUMBER,
+    "meters": (list, type(None)),
+    "sinks": (list, type(None)),
+    "obisCodes": (list, type(None)),
+    "rules": (list, type(None)),
+}
+# keys which must be greater than 0
+POSITIVE = ("baudrate", "batchSize", "queueSize", "spoolMaxMB", "captureMaxMB")
+# keys every entry of a list must have
+LIST_KEYS = {
+    "meters": ("meterId", "port"),
+    "sinks": ("type",),
+    "obisCodes": ("code", "name", "column"),
+    "rules": ("name",),
+}
+
+# column of an OBIS code, written into the DDL and the statements unquoted
+COLUMN_NAME = re.compile(r"[a-z_][a-z0-9_]*")
+# SQL types of an OBIS code
+SQL_TYPES = ("BIGINT", "INTEGER", "SMALLINT", "FLOAT4", "FLOAT8", "REAL")
+
+# bytes of a meter id: VARCHAR(32) in the tables, 32 bytes in spool and live records
+METER_ID_BYTES = 32
+
+
+class ConfigError(ValueError):
+    """raised for an invalid main_config.yaml"""
+
+
+def freeze(value):
+    """read-only copy of parsed YAML: mappings become MappingProxyType, lists tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """plain copy of frozen YAML, MappingProxyType cannot be pickled"""
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return tuple(thaw(item) for item in value)
+    return value
+
+
+def validate_yaml(config_yaml: dict, path: str = "main_config.yaml") -> None:
+    """check the types of the known keys, unknown keys are only logged (typos)"""
+    if not isinstance(config_yaml, dict):
+        raise ConfigError(f"{path} is no mapping")
+    for key, value in config_yaml.items():
+        expected = YAML_TYPES.get(key)
+        if expected is None:
+            logging.warning(f"{path}: unknown key {key}")
+            continue
+        if not isinstance(expected, tuple):
+            expected = (expected,)
+        # True is an int as well
+        if not isinstance(value, expected) or (
+            isinstance(value, bool) and bool not in expected
+        ):
+            raise ConfigError(f"{path}: {key} has the invalid value {value!r}")
+        if key in POSITIVE and value <= 0:
+            raise ConfigError(f"{path}: {key} must be greater than 0")
+    for key, required in LIST_KEYS.items():
+        for entry in config_yaml.get(key) or []:
+            if not isinstance(entry, dict) or any(
+                name not in entry for name in required
+            ):
+                raise ConfigError(
+                    f"{path}: every entry of {key} needs {', '.join(required)}"
+                )
+    for entry in config_yaml.get("obisCodes") or []:
+        if not isinstance(entry["column"], str) or not COLUMN_NAME.fullmatch(
+            entry["column"]
+        ):
+            raise ConfigError(
+                f"{path}: column {entry['column']!r} of obisCodes must match {COLUMN_NAME.pattern}"
+            )
+        if str(entry.get("type", "FLOAT4")).upper() not in SQL_TYPES:
+            raise ConfigError(
+                f"{path}: type {entry['type']!r} of obisCodes is none of {', '.join(SQL_TYPES)}"
+            )
+    meters = [config_yaml] + list(config_yaml.get("meters") or [])
+    for meter in meters:
+        meter_id = str(meter.get("meterId") or "")
+        if len(meter_id.encode("utf-8")) > METER_ID_BYTES:
+            raise ConfigError(
+                f"{path}: meterId {meter_id} is longer than {METER_ID_BYTES} bytes"
+            )
 
 
 class Configuration:
+    """the configuration files, every file is parsed once and kept read-only
+
+    One instance is created at startup and passed to everything which needs
+    it, the parsed files are cached on the instance. Worker processes get a
+    pickled copy including the parsed files, they read no file again.
+    """
+
     def __init__(
         self,
         url_to_database: str = os.path.join(ROOT_DIR, "database.ini"),
@@ -13,33 +145,52 @@ class Configuration:
     ):
         self.url_to_database = url_to_database
         self.url_yaml_config = url_yaml_config
+        self.cache = {}  # parsed files
+
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__)
+        state["cache"] = {key: thaw(value) for key, value in self.cache.items()}
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.cache = {key: freeze(value) for key, value in self.cache.items()}
 
     def postgresql_config(self, section: str = "postgresql") -> dict:
         """define the details of a database connection based on database.ini"""
-        # create a parser
-        parser = ConfigParser()
-        # read config file
-        parser.read(self.url_to_database)
-
-        # get section
-        db = {}
-        if parser.has_section(section):
-            params = parser.items(section)
-            for param in params:
-                db[param[0]] = param[1]
-        else:
-            raise Exception(
-                f"Section {section} not found in the {self.url_to_database} file"
-            )
+        key = ("postgresql", section)
+        if key not in self.cache:
+            # create a parser
+            parser = ConfigParser()
+            # read config file
+            parser.read(self.url_to_database)
 
-        return db
+            # get section
+            if not parser.has_section(section):
+                raise Exception(
+                    f"Section {section} not found in the {self.url_to_database} file"
+                )
+            self.cache[key] = MappingProxyType(dict(parser.items(section)))
+        # a new dict, callers add connection options
+        return dict(self.cache[key])
 
     def yaml_config(self) -> dict:
-        with open(self.url_yaml_config) as file:
-            return yaml.load(file, Loader=yaml.FullLoader)
+        """main_config.yaml, validated and read-only"""
+        if "yaml" not in self.cache:
+            with open(self.url_yaml_config) as file:
+                # the C loader (libyaml) parses several times faster where available
+                loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+                config_yaml = yaml.load(file, Loader=loader) or {}
+            validate_yaml(config_yaml, os.path.basename(self.url_yaml_config))
+            self.cache["yaml"] = freeze(config_yaml)
+        return self.cache["yaml"]
 
     def env_config(self) -> dict:
-        load_dotenv()
-        env_config = {}
-        env_config["evn_key"] = os.getenv("EVN_SCHLUESSEL")
-        return env_config
+        if "env" not in self.cache:
+            from dotenv import load_dotenv
+
+            load_dotenv()
+            self.cache["env"] = MappingProxyType(
+                {"evn_key": os.getenv("EVN_SCHLUESSEL")}
+            )
+        return self.cache["env"]
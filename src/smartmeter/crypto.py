@@ -0,0 +1,108 @@
+"""bytes-native decryption of the general-glo-ciphering APDU in a telegram
+
+Every M-Bus frame of a telegram carries a 9 byte header (68 LL LL 68 C A CI
+STSAP DTSAP) and a checksum and stop byte, the payloads of all frames form
+the ciphered APDU:
+
+    DB 08 <system title> <length> <security control> <frame counter> <ciphertext> [<tag>]
+
+The meter encrypts with AES-GCM. Without authentication GCM decryption is
+AES-CTR starting at counter 2, so the expanded key is kept in an ECB cipher
+and the key stream is computed without creating a new GCM object per frame.
+"""
+
+from typing import NamedTuple
+
+from Cryptodome.Cipher import AES
+
+GENERAL_GLO_CIPHERING = 0xDB
+FRAME_HEADER_LENGTH = 9  # 68 LL LL 68 C A CI STSAP DTSAP
+AUTHENTICATION = 0x10  # security control bit: GCM tag present
+ENCRYPTION = 0x20  # security control bit: ciphertext
+TAG_LENGTH = 12
+
+
+class SecuredApdu(NamedTuple):
+    """parts of a ciphered APDU, memoryviews into the telegram payload"""
+
+    system_title: memoryview
+    security_control: int
+    frame_counter: memoryview
+    ciphertext: memoryview
+    tag: memoryview  # None without authentication
+
+
+def telegram_payload(telegram: bytes) -> memoryview:
+    """join the payloads of the M-Bus frames of a telegram"""
+    view = memoryview(telegram)
+    parts = []
+    pos = 0
+    while pos < len(view):
+        end = pos + view[pos + 1] + 6
+        parts.append(view[pos + FRAME_HEADER_LENGTH : end - 2])
+        pos = end
+    if len(parts) == 1:
+        return parts[0]
+    return memoryview(b"".join(parts))
+
+
+def parse_telegram(telegram: bytes) -> SecuredApdu:
+    """split a telegram into system title, frame counter, ciphertext and tag"""
+    payload = telegram_payload(telegram)
+    if payload[0] != GENERAL_GLO_CIPHERING:
+        raise ValueError(f"no general-glo-ciphering APDU (0x{payload[0]:02X})")
+    pos = 2 + payload[1]
+    system_title = payload[2:pos]
+    length = payload[pos]
+    pos += 1
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(payload[pos : pos + size], "big")
+        pos += size
+    end = pos + length
+    if end > len(payload):
+        raise ValueError(f"ciphered APDU truncated ({len(payload)} of {end} bytes)")
+    security_control = payload[pos]
+    frame_counter = payload[pos + 1 : pos + 5]
+    tag = None
+    if security_control & AUTHENTICATION:
+        tag = payload[end - TAG_LENGTH : end]
+        end -= TAG_LENGTH
+    return SecuredApdu(
+        system_title, security_control, frame_counter, payload[pos + 5 : end], tag
+    )
+
+
+class ApduDecryptor:
+    """decrypt ciphered APDUs of one meter, the key is expanded only once"""
+
+    def __init__(self, key: str, authentication_key: str = None) -> None:
+        self.key = bytes.fromhex(key)
+        self.authentication_key = (
+            bytes.fromhex(authentication_key) if authentication_key else None
+        )
+        self.ecb = AES.new(self.key, AES.MODE_ECB)
+        self.counter_blocks = {}  # number of blocks -> counter suffixes
+
+    def decrypt(self, apdu: SecuredApdu) -> bytes:
+        """decrypt the ciphertext, the GCM tag is verified if the authentication key is known"""
+        nonce = bytes(apdu.system_title) + bytes(apdu.frame_counter)
+        if apdu.tag is not None and self.authentication_key is not None:
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=len(apdu.tag))
+            cipher.update(bytes([apdu.security_control]) + self.authentication_key)
+            return cipher.decrypt_and_verify(apdu.ciphertext, apdu.tag)
+        return self.ctr(nonce, apdu.ciphertext)
+
+    def ctr(self, nonce: bytes, ciphertext: memoryview) -> bytes:
+        """GCM decryption without tag verification: AES-CTR from counter 2"""
+        length = len(ciphertext)
+        blocks = (length + 15) // 16
+        suffixes = self.counter_blocks.get(blocks)
+        if suffixes is None:
+            suffixes = [(i + 2).to_bytes(4, "big") for i in range(blocks)]
+            self.counter_blocks[blocks] = suffixes
+        key_stream = self.ecb.encrypt(nonce.join([b""] + suffixes))
+        plain = int.from_bytes(ciphertext, "big") ^ int.from_bytes(
+            key_stream[:length], "big"
+        )
+        return plain.to_bytes(length, "big")
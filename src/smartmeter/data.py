@@ -1,19 +1,82 @@
-import sys
-import serial
+import os
 from datetime import datetime
 from binascii import unhexlify
-from gurux_dlms.GXDLMSTranslator import GXDLMSTranslator
-from gurux_dlms.TranslatorOutputType import TranslatorOutputType
-from bs4 import BeautifulSoup
 from Cryptodome.Cipher import AES
-from time import sleep
-from typing import Any
-import xml.etree.ElementTree as ET
 import logging
+from time import perf_counter
 
 
+from src.smartmeter import crypto, dlms
+from dev.definitions import ROOT_DIR
 from src.smartmeter.config import Configuration
+from src.smartmeter.framecounter import FrameCounterTracker
+from src.smartmeter.live import LivePublisher
+from src.smartmeter.logs import HexBytes, event, limited
+from src.smartmeter.metrics import METRICS
+from src.smartmeter.obis import ObisRegistry
+from src.smartmeter.reading import Reading
 from src.smartmeter.postgresql_tasks import PostgresTasks
+from src.smartmeter.spool import Spool, SpoolDrainer
+
+TELEGRAMS = METRICS.counter(
+    "smartmeter_telegrams_total",
+    "telegrams by result (decoded, duplicate, broken, no_data, bad_start)",
+    ("result",),
+)
+DECODER_SECONDS = METRICS.histogram(
+    "smartmeter_decoder_seconds", "time spent per telegram by stage", ("stage",)
+)
+GURUX_FALLBACKS = METRICS.counter(
+    "smartmeter_gurux_fallback_total", "APDUs decoded by the Gurux translator"
+)
+
+
+def valid_mbus_start(encrypted_data: str) -> bool:
+    """check the M-Bus start sequence 68 LL LL 68 of a hex string"""
+    mbusstart = encrypted_data[0:8]
+    return (
+        mbusstart[0:2] == "68"
+        and mbusstart[2:4] == mbusstart[4:6]
+        and mbusstart[6:8] == "68"
+    )
+
+
+def show(value, digits: int = None) -> str:
+    """a value for the console, - if the meter did not send it"""
+    if value is None:
+        return "-"
+    return str(round(value, digits) if digits is not None else value)
+
+
+def print_values(data: dict, meter_id: str = None) -> None:
+    """print decoded values to the console, missing values are shown as -"""
+    now = datetime.now()
+    print("\n\t\t*** KUNDENSCHNITTSTELLE ***\n\nOBIS Code\tBezeichnung\t\t\t Wert")
+    print(now.strftime("%d.%m.%Y %H:%M:%S"))
+    if meter_id is not None:
+        print("Zähler:\t" + str(meter_id))
+    print("1.0.32.7.0.255\tSpannung L1 (V):\t\t " + show(data.get("SpannungL1"), 2))
+    print("1.0.52.7.0.255\tSpannung L2 (V):\t\t " + show(data.get("SpannungL2"), 2))
+    print("1.0.72.7.0.255\tSpannung L3 (V):\t\t " + show(data.get("SpannungL3"), 2))
+    print("1.0.31.7.0.255\tStrom L1 (A):\t\t\t " + show(data.get("StromL1"), 2))
+    print("1.0.51.7.0.255\tStrom L2 (A):\t\t\t " + show(data.get("StromL2"), 2))
+    print("1.0.71.7.0.255\tStrom L3 (A):\t\t\t " + show(data.get("StromL3"), 2))
+    print(
+        "1.0.1.7.0.255\tWirkleistung Bezug [W]: \t "
+        + show(data.get("MomentanleistungP"))
+    )
+    print(
+        "1.0.2.7.0.255\tWirkleistung Lieferung [W]:\t "
+        + show(data.get("MomentanleistungN"))
+    )
+    print("1.0.1.8.0.255\tWirkenergie Bezug [Wh]:\t " + show(data.get("WirkenergieP")))
+    print(
+        "1.0.2.8.0.255\tWirkenergie Lieferung [Wh]:\t " + show(data.get("WirkenergieN"))
+    )
+    print("-------------\tLeistungsfaktor:\t\t " + show(data.get("Leistungsfaktor")))
+    bezug, lieferung = data.get("MomentanleistungP"), data.get("MomentanleistungN")
+    total = None if bezug is None or lieferung is None else bezug - lieferung
+    print("-------------\tWirkleistunggesamt [w]:\t\t " + show(total))
 
 
 class SmartmeterToPostgres:
@@ -22,21 +85,23 @@ class SmartmeterToPostgres:
         config: Configuration,
         client: PostgresTasks,
     ) -> None:
-        self.config_postgres = config.postgresql_config()
+        self.config = config  # passed on to worker processes
         self.config_yaml = config.yaml_config()
         self.config_env = config.env_config()
         self.client = client
+        self.registry = ObisRegistry.from_config(self.config_yaml)  # stored OBIS codes
+        self.use_meter_time = self.config_yaml.get("useMeterTime", True)
         self.data: dict[int] = {}  # processed data - ready to store
-        self.ser = None  # serial port
-        self.translator = GXDLMSTranslator()
-
-    def get_hex_string(
-        self,
-    ) -> str:
-        """receive encrypted hex string by smartmeter and return parts of the hex string as a dict"""
-        encrypted_data = self.ser.read(size=282).hex()
-        logging.debug(f"hex string(encrypted_data): {encrypted_data}")
-        return encrypted_data
+        self.writer = None  # batched postgresQL writer
+        self.spool = None  # durable spool in front of the writer, see open_writer
+        self.drainer = None  # ships the spool to the writer
+        # by (key, authentication key), see decryptor
+        self.decryptors: dict[tuple[str, str], crypto.ApduDecryptor] = {}
+        self.frame_counters = (
+            FrameCounterTracker()
+        )  # in memory, see open_frame_counters
+        self.translator = None  # Gurux translator, created for the first fallback
+        self.live: dict[str, LivePublisher] = {}  # live file by meter id, see open_live
 
     def split_hex_string(self, encrypted_data: str) -> dict[str]:
         mbusstart = encrypted_data[0:8]
@@ -44,16 +109,12 @@ class SmartmeterToPostgres:
         system_titel = encrypted_data[22:38]
         frame_counter = encrypted_data[44:52]
         frame = encrypted_data[52 : 12 + frame_len * 2]
-        if (
-            mbusstart[0:2] == "68"
-            and mbusstart[2:4] == mbusstart[4:6]
-            and mbusstart[6:8] == "68"
-        ):
+        if valid_mbus_start(encrypted_data):
             logging.info(f"Incomming Data ok")
-            logging.debug(f"mbusstart: {mbusstart}")
-            logging.debug(f"dataframe: {frame}")
-            logging.debug(f"system_titel: {system_titel}")
-            logging.debug(f"frame_counter: {frame_counter}")
+            logging.debug("mbusstart: %s", mbusstart)
+            logging.debug("dataframe: %s", frame)
+            logging.debug("system_titel: %s", system_titel)
+            logging.debug("frame_counter: %s", frame_counter)
             return {
                 "mbusstart": mbusstart,
                 "frame": frame,
@@ -61,11 +122,8 @@ class SmartmeterToPostgres:
                 "frame_counter": frame_counter,
             }
         else:
-            logging.warning(f"Wrong M-Bus Start, restarting", exc_info=True)
-            sleep(2.5)
-            self.ser.flushOutput()
-            self.ser.close()
-            self.ser.open()
+            TELEGRAMS.inc("bad_start")
+            limited.warning("Wrong M-Bus Start, telegram dropped")
             return False
 
     def decrypt_apdu(self, frame, key, system_titel, frame_counter) -> str:
@@ -76,208 +134,224 @@ class SmartmeterToPostgres:
         cipher = AES.new(encryption_key, AES.MODE_GCM, nonce=init_vector)
         return cipher.decrypt(frame).hex()
 
-    def translate_dlms(self, decrypted_apdu: str) -> None:
-        """translate decrypted response"""
-        octet_string_values = {}
-        octet_string_values["0100010800FF"] = "WirkenergieP"
-        octet_string_values["0100020800FF"] = "WirkenergieN"
-        octet_string_values["0100010700FF"] = "MomentanleistungP"
-        octet_string_values["0100020700FF"] = "MomentanleistungN"
-        octet_string_values["0100200700FF"] = "SpannungL1"
-        octet_string_values["0100340700FF"] = "SpannungL2"
-        octet_string_values["0100480700FF"] = "SpannungL3"
-        octet_string_values["01001F0700FF"] = "StromL1"
-        octet_string_values["0100330700FF"] = "StromL2"
-        octet_string_values["0100470700FF"] = "StromL3"
-        octet_string_values["01000D0700FF"] = "Leistungsfaktor"
+    def decryptor(
+        self, key: str, authentication_key: str = None
+    ) -> crypto.ApduDecryptor:
+        """return the decryptor of a key, the key is only parsed and expanded once
 
-        try:
-            xml = self.translator.pduToXml(
-                decrypted_apdu,
-            )
-            logging.debug(f"xml: {xml}")
-
-            root = ET.fromstring(xml)
-            found_lines = []
-            momentan = []
-
-            items = list(root.iter())
-            for i, child in enumerate(items):
-                if child.tag == "OctetString" and "Value" in child.attrib:
-                    value = child.attrib["Value"]
-                    if value in octet_string_values.keys():
-                        if "Value" in items[i + 1].attrib:
-                            if value in ["0100010700FF", "0100020700FF"]:
-                                # special handling for momentanleistung
-                                momentan.append(int(items[i + 1].attrib["Value"], 16))
-                            found_lines.append(
-                                {
-                                    "key": octet_string_values[value],
-                                    "value": int(items[i + 1].attrib["Value"], 16),
-                                }
-                            )
-
-        #        print(found_lines)
-        except BaseException as err:
-            logging.exception(f"{err}")
+        With the authentication key the GCM tag of authenticated telegrams is verified.
+        """
+        decryptor = self.decryptors.get((key, authentication_key))
+        if decryptor is None:
+            decryptor = crypto.ApduDecryptor(key, authentication_key)
+            self.decryptors[key, authentication_key] = decryptor
+        return decryptor
 
+    def decode_apdu(self, decrypted_apdu: bytes | str) -> dict[bytes, tuple]:
+        """decode the apdu natively, fall back to the Gurux translator for unknown structures"""
+        if isinstance(decrypted_apdu, str):
+            decrypted_apdu = bytes.fromhex(decrypted_apdu)
         try:
-            if len(momentan) == 2:
-                found_lines.append(
-                    {"key": "Momentanleistung", "value": momentan[0] - momentan[1]}
-                )
+            return dlms.decode_notification(decrypted_apdu)
+        except dlms.DlmsDecodeError as err:
+            # trailing data the decoder does not know is fine once all values are found
+            if self.registry.codes <= err.values.keys():
+                return err.values
+            limited.info("native decoder failed (%s), using Gurux translator", err)
+            GURUX_FALLBACKS.inc()
+            return self.decode_apdu_xml(decrypted_apdu.hex())
+
+    def decode_apdu_xml(self, decrypted_apdu: str) -> dict[bytes, tuple]:
+        """decode the apdu via the XML output of the Gurux translator"""
+        # Gurux takes longer to import than everything else, only the fallback needs it
+        import xml.etree.ElementTree as ET
+
+        if self.translator is None:
+            from gurux_dlms.GXDLMSTranslator import GXDLMSTranslator
+
+            self.translator = GXDLMSTranslator()
+        xml = self.translator.pduToXml(
+            decrypted_apdu,
+        )
+        logging.debug("xml: %s", xml)
 
-            for element in found_lines:
-                if element["key"] == "WirkenergieP":
-                    self.data["WirkenergieP"] = element["value"]
-                if element["key"] == "WirkenergieN":
-                    self.data["WirkenergieN"] = element["value"]
-
-                if element["key"] == "MomentanleistungP":
-                    self.data["MomentanleistungP"] = element["value"]
-                if element["key"] == "MomentanleistungN":
-                    self.data["MomentanleistungN"] = element["value"]
-
-                if element["key"] == "SpannungL1":
-                    self.data["SpannungL1"] = element["value"] * 0.1
-                if element["key"] == "SpannungL2":
-                    self.data["SpannungL2"] = element["value"] * 0.1
-                if element["key"] == "SpannungL3":
-                    self.data["SpannungL3"] = element["value"] * 0.1
-
-                if element["key"] == "StromL1":
-                    self.data["StromL1"] = element["value"] * 0.01
-                if element["key"] == "StromL2":
-                    self.data["StromL2"] = element["value"] * 0.01
-                if element["key"] == "StromL3":
-                    self.data["StromL3"] = element["value"] * 0.01
-
-                if element["key"] == "Leistungsfaktor":
-                    self.data["Leistungsfaktor"] = element["value"] * 0.001
+        root = ET.fromstring(xml)
+        values = {}
 
+        items = list(root.iter())
+        for i, child in enumerate(items):
+            if child.tag == "OctetString" and "Value" in child.attrib:
+                value = child.attrib["Value"]
+                if len(value) == dlms.OBIS_LENGTH * 2 and i + 1 < len(items):
+                    if "Value" in items[i + 1].attrib:
+                        values[bytes.fromhex(value)] = (
+                            int(items[i + 1].attrib["Value"], 16),
+                            None,
+                            None,
+                        )
+        return values
+
+    def translate_dlms(self, decrypted_apdu: bytes | str) -> None:
+        """translate decrypted response"""
+        try:
+            values = self.decode_apdu(decrypted_apdu)
+            self.data.update(self.registry.extract(values))
+            if "MomentanleistungP" in self.data and "MomentanleistungN" in self.data:
+                self.data["Momentanleistung"] = (
+                    self.data["MomentanleistungP"] - self.data["MomentanleistungN"]
+                )
         except BaseException as err:
             logging.exception(f"{err}")
 
         finally:
             return self.data
 
-    def run(self) -> None:
-        """endless loop to gain data and store in the database"""
-        self.ser = serial.Serial(
-            port=self.config_yaml["port"],
-            baudrate=self.config_yaml["baudrate"],
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-        )  # open serial port
-
-        logging.info(f"Application started")
-        while True:
-            # read data
-            encrypted_data = self.get_hex_string()
-            encrypted_dict = self.split_hex_string(encrypted_data)
-            if encrypted_dict == False:
-                continue
-            # decrypt data
-            apdu = self.decrypt_apdu(
-                encrypted_dict["frame"],
-                self.config_env["evn_key"],
-                encrypted_dict["system_titel"],
-                encrypted_dict["frame_counter"],
+    def decrypt_telegram(
+        self, telegram: bytes, decryptor: crypto.ApduDecryptor
+    ) -> bytes:
+        """decrypt a telegram, return None if it is broken, already seen or carries no data"""
+        started = perf_counter()
+        try:
+            secured = crypto.parse_telegram(telegram)
+            system_title = bytes(secured.system_title)
+            frame_counter = int.from_bytes(secured.frame_counter, "big")
+            # duplicates are dropped before spending time on AES
+            if self.frame_counters is not None:
+                if not self.frame_counters.is_new(system_title, frame_counter):
+                    TELEGRAMS.inc("duplicate")
+                    return None
+            apdu = decryptor.decrypt(secured)
+        except (ValueError, IndexError) as err:
+            TELEGRAMS.inc("broken")
+            limited.warning("telegram dropped: %s", err)
+            return None
+        DECODER_SECONDS.observe(perf_counter() - started, "decrypt")
+        if apdu[0:2] != b"\x0f\x80":
+            # e.g. a wrong key, the frame counter is not taken from such a telegram
+            TELEGRAMS.inc("no_data")
+            return None
+        if self.frame_counters is not None:
+            self.frame_counters.update(system_title, frame_counter)
+        self.data["FrameCounter"] = frame_counter
+        return apdu
+
+    def process_telegram(
+        self, telegram: bytes, decryptor: crypto.ApduDecryptor
+    ) -> bool:
+        """decrypt and translate a telegram, return False if it carried no data"""
+        # values of the previous telegram must not survive in a missing field
+        self.data = {}
+        apdu = self.decrypt_telegram(telegram, decryptor)
+        if apdu is None:
+            return False
+        started = perf_counter()
+        event(
+            logging.DEBUG,
+            "telegram decrypted",
+            frame_counter=self.data["FrameCounter"],
+            apdu=HexBytes(apdu),
+        )
+        self.data["DeviceTime"] = dlms.notification_utc(apdu)
+        # extract data
+        self.translate_dlms(apdu)
+        DECODER_SECONDS.observe(perf_counter() - started, "decode")
+        TELEGRAMS.inc("decoded")
+        return True
+
+    def reading(self, time: datetime, meter_id: str = None) -> Reading:
+        """return the processed data as immutable reading
+
+        The reading is stamped with the date-time sent by the meter (in UTC),
+        time (of reception) is used if the meter sent none or useMeterTime is off.
+        """
+        device_time = self.data.get("DeviceTime")
+        if device_time is not None and self.use_meter_time:
+            time = device_time
+        return Reading(
+            time,
+            meter_id if meter_id is not None else "",
+            self.data.get("FrameCounter"),
+            # None for a field the meter did not send
+            tuple(self.data.get(name) for name in self.registry.names),
+            device_time,
+        )
+
+    def open_frame_counters(self) -> None:
+        """track the frame counters persistently to drop telegrams seen before a restart"""
+        self.frame_counters = FrameCounterTracker(
+            os.path.join(
+                ROOT_DIR,
+                self.config_yaml.get("frameCounterFile", "frame_counters.json"),
             )
-            logging.debug(f"decrypted apdu: {apdu}")
-            if apdu[0:4] != "0f80":
-                continue
-            # extract data
-            self.translate_dlms(apdu)
-
-            if self.config_yaml["printValue"]:
-                now = datetime.now()
-                print(
-                    "\n\t\t*** KUNDENSCHNITTSTELLE ***\n\nOBIS Code\tBezeichnung\t\t\t Wert"
-                )
-                print(now.strftime("%d.%m.%Y %H:%M:%S"))
-                print(
-                    "1.0.32.7.0.255\tSpannung L1 (V):\t\t "
-                    + str(round(self.data["SpannungL1"], 2))
-                )
-                print(
-                    "1.0.52.7.0.255\tSpannung L2 (V):\t\t "
-                    + str(round(self.data["SpannungL2"], 2))
-                )
-                print(
-                    "1.0.72.7.0.255\tSpannung L3 (V):\t\t "
-                    + str(round(self.data["SpannungL3"], 2))
-                )
-                print(
-                    "1.0.31.7.0.255\tStrom L1 (A):\t\t\t "
-                    + str(round(self.data["StromL1"], 2))
-                )
-                print(
-                    "1.0.51.7.0.255\tStrom L2 (A):\t\t\t "
-                    + str(round(self.data["StromL2"], 2))
-                )
-                print(
-                    "1.0.71.7.0.255\tStrom L3 (A):\t\t\t "
-                    + str(round(self.data["StromL3"], 2))
-                )
-                print(
-                    "1.0.1.7.0.255\tWirkleistung Bezug [W]: \t "
-                    + str(self.data["MomentanleistungP"])
-                )
-                print(
-                    "1.0.2.7.0.255\tWirkleistung Lieferung [W]:\t "
-                    + str(self.data["MomentanleistungN"])
-                )
-                print(
-                    "1.0.1.8.0.255\tWirkenergie Bezug [Wh]:\t "
-                    + str(self.data["WirkenergieP"])
-                )
-                print(
-                    "1.0.2.8.0.255\tWirkenergie Lieferung [Wh]:\t "
-                    + str(self.data["WirkenergieN"])
-                )
-                print(
-                    "-------------\tLeistungsfaktor:\t\t "
-                    + str(self.data["Leistungsfaktor"])
-                )
-                print(
-                    "-------------\tWirkleistunggesamt [w]:\t\t "
-                    + str(
-                        self.data["MomentanleistungP"] - self.data["MomentanleistungN"]
-                    )
-                )
+        )
 
-            # save data to PostgreSQL
-            if self.config_yaml["usePostgres"]:
-                try:
-                    data_id = self.client.insert_smartmeter(
-                        self.data["WirkenergieP"],
-                        self.data["WirkenergieN"],
-                        self.data["MomentanleistungP"],
-                        self.data["MomentanleistungN"],
-                        self.data["SpannungL1"],
-                        self.data["SpannungL2"],
-                        self.data["SpannungL3"],
-                        self.data["StromL1"],
-                        self.data["StromL2"],
-                        self.data["StromL3"],
-                        self.data["Leistungsfaktor"],
-                    )
-                    # check if data was saved to the postgresQL Database
-                    if data_id is None:
-                        logging.exception(f"no Data added to postgresQL Smartmeter")
-                        sys.exit(1)
-                    else:
-                        logging.info(
-                            f"data_id: {data_id} was added to postgresQL Smartmeter"
-                        )
+    def open_writer(self) -> None:
+        """prepare the smartmeter table and create the batched writer
 
-                except BaseException as err:
-                    logging.exception(f"{err}")
+        With spoolDir configured the rows are appended to a local spool and
+        shipped by a background thread, an unreachable database does not
+        block reading the meter.
+        """
+        self.client.migrate_table_smartmeter(self.registry)
+        self.writer = self.client.writer(
+            batch_size=self.config_yaml.get("batchSize", 10),
+            max_age=self.config_yaml.get("batchMaxAge", 60),
+            registry=self.registry,
+        )
+        spool_dir = self.config_yaml.get("spoolDir")
+        if spool_dir:
+            self.spool = Spool(
+                os.path.join(ROOT_DIR, spool_dir),
+                registry=self.registry,
+                max_bytes=self.config_yaml.get("spoolMaxMB", 256) << 20,
+            )
+            self.drainer = SpoolDrainer(
+                self.spool,
+                self.writer,
+                interval=self.config_yaml.get("spoolSyncInterval", 1.0),
+            )
+            self.drainer.start()
+
+    def close_writer(self) -> None:
+        """stop the spool drainer, then write the buffered rows and close the writer
 
-            # wait 29 seconds before restarting the loop.
-            self.ser.flushOutput()
-            self.ser.close()
-            self.ser.open()
-            sleep(29)
+        Rows which are still spooled are synced to disk and shipped after the
+        next start.
+        """
+        try:
+            if self.drainer is not None:
+                self.drainer.stop()  # closes the spool
+                self.drainer = None
+                self.spool = None
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+    def open_live(self, meter_ids: list[str]) -> None:
+        """create the live file of every meter if liveDir is set, see live.py"""
+        live_dir = self.config_yaml.get("liveDir")
+        if not live_dir:
+            return
+        for meter_id in meter_ids:
+            self.live[meter_id] = LivePublisher(
+                os.path.join(ROOT_DIR, live_dir, f"{meter_id or 'meter'}.live"),
+                self.registry,
+            )
+
+    def publish(self, reading: Reading) -> None:
+        """write the reading into the live file of its meter"""
+        publisher = self.live.get(reading.meter_id)
+        if publisher is not None:
+            publisher.publish(reading)
+
+    def store_row(self, row: tuple) -> None:
+        """hand a row of the smartmeter table to the spool or the batched postgresQL writer"""
+        if self.spool is not None:
+            self.spool.append(row)
+            return
+        data_ids = self.writer.add(row)
+        if data_ids:
+            logging.info(
+                f"data_ids: {data_ids[0]}..{data_ids[-1]} were added to postgresQL Smartmeter"
+            )
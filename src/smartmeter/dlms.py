@@ -0,0 +1,196 @@
+"""native decoder for the DLMS/COSEM data-notification pushed by the smartmeter
+
+The T210-D pushes a data-notification (0x0F) whose body is a structure of
+OBIS code octet-strings, each followed by its value and an optional
+scaler-unit structure. Walking these bytes once is much cheaper than the
+XML round-trip through the Gurux translator, which stays as a fallback for
+anything this decoder does not understand.
+"""
+
+from datetime import datetime, timedelta, timezone
+from struct import unpack_from
+
+DATA_NOTIFICATION = 0x0F
+
+# A-XDR data tags
+TAG_NULL = 0x00
+TAG_ARRAY = 0x01
+TAG_STRUCTURE = 0x02
+TAG_BOOLEAN = 0x03
+TAG_BIT_STRING = 0x04
+TAG_INT32 = 0x05
+TAG_UINT32 = 0x06
+TAG_OCTET_STRING = 0x09
+TAG_VISIBLE_STRING = 0x0A
+TAG_UTF8_STRING = 0x0C
+TAG_INT8 = 0x0F
+TAG_INT16 = 0x10
+TAG_UINT8 = 0x11
+TAG_UINT16 = 0x12
+TAG_INT64 = 0x14
+TAG_UINT64 = 0x15
+TAG_ENUM = 0x16
+TAG_DATE_TIME = 0x19
+
+# fixed size integer types: tag -> (struct format, size)
+INTEGER_TAGS = {
+    TAG_BOOLEAN: (">B", 1),
+    TAG_INT32: (">i", 4),
+    TAG_UINT32: (">I", 4),
+    TAG_INT8: (">b", 1),
+    TAG_INT16: (">h", 2),
+    TAG_UINT8: (">B", 1),
+    TAG_UINT16: (">H", 2),
+    TAG_INT64: (">q", 8),
+    TAG_UINT64: (">Q", 8),
+    TAG_ENUM: (">B", 1),
+}
+
+# variable length types which are skipped (value is not needed)
+STRING_TAGS = (TAG_VISIBLE_STRING, TAG_UTF8_STRING)
+
+OBIS_LENGTH = 6
+
+# COSEM date-time: deviation (minutes, UTC = local time + deviation) and clock status
+DEVIATION_NOT_SPECIFIED = -0x8000
+CLOCK_STATUS_NOT_SPECIFIED = 0xFF
+CLOCK_INVALID = 0x01
+CLOCK_DAYLIGHT_SAVING = 0x80
+
+
+class DlmsDecodeError(ValueError):
+    """raised for APDUs the native decoder can not walk
+
+    values holds everything decoded before the error occured.
+    """
+
+    def __init__(self, message: str, values: dict = None) -> None:
+        super().__init__(message)
+        self.values = values if values is not None else {}
+
+
+def _length(apdu: bytes, pos: int) -> tuple[int, int]:
+    """read an A-XDR length at pos and return (length, new position)"""
+    length = apdu[pos]
+    pos += 1
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(apdu[pos : pos + size], "big")
+        pos += size
+    return length, pos
+
+
+def decode_notification(apdu: bytes) -> dict[bytes, tuple]:
+    """decode a data-notification and return {obis: (value, scaler, unit)}
+
+    obis is the 6 byte OBIS code, scaler and unit are None if the meter did
+    not send a scaler-unit structure. A truncated APDU ends the walk and
+    returns the values decoded so far, an unknown tag raises DlmsDecodeError.
+    """
+    values = {}
+    end = len(apdu)
+    if end == 0 or apdu[0] != DATA_NOTIFICATION:
+        raise DlmsDecodeError("no data-notification", values)
+    # long-invoke-id-and-priority
+    pos = 5
+    try:
+        # optional date-time as length prefixed octet-string
+        length, pos = _length(apdu, pos)
+        pos += length
+
+        obis = None
+        while pos < end:
+            tag = apdu[pos]
+            pos += 1
+            if tag in INTEGER_TAGS:
+                fmt, size = INTEGER_TAGS[tag]
+                if pos + size > end:
+                    break
+                value = unpack_from(fmt, apdu, pos)[0]
+                pos += size
+                if obis is None:
+                    continue
+                scaler = unit = None
+                # scaler-unit structure: 02 02 0F <scaler> 16 <unit>
+                if (
+                    pos + 6 <= end
+                    and apdu[pos] == TAG_STRUCTURE
+                    and apdu[pos + 1] == 2
+                    and apdu[pos + 2] == TAG_INT8
+                    and apdu[pos + 4] == TAG_ENUM
+                ):
+                    scaler = unpack_from(">b", apdu, pos + 3)[0]
+                    unit = apdu[pos + 5]
+                    pos += 6
+                values[obis] = (value, scaler, unit)
+                obis = None
+            elif tag == TAG_OCTET_STRING:
+                length, pos = _length(apdu, pos)
+                if pos + length > end:
+                    break
+                obis = apdu[pos : pos + length] if length == OBIS_LENGTH else None
+                pos += length
+            elif tag in (TAG_STRUCTURE, TAG_ARRAY):
+                # the content follows inline, only the element count is skipped
+                length, pos = _length(apdu, pos)
+            elif tag in STRING_TAGS:
+                length, pos = _length(apdu, pos)
+                pos += length
+                obis = None
+            elif tag == TAG_DATE_TIME:
+                pos += 12
+                obis = None
+            elif tag == TAG_NULL:
+                obis = None
+            else:
+                raise DlmsDecodeError(
+                    f"unknown tag 0x{tag:02X} at position {pos - 1}", values
+                )
+    except IndexError:
+        # truncated length field
+        pass
+    return values
+
+
+def parse_datetime(octets: bytes) -> datetime:
+    """parse a COSEM date-time (12 octets) into a naive datetime of the meter clock
+
+    returns None if the date or time is not specified.
+    """
+    year = int.from_bytes(octets[0:2], "big")
+    month, day = octets[2], octets[3]
+    hour, minute, second, hundredths = octets[5], octets[6], octets[7], octets[8]
+    if year == 0xFFFF or not 1 <= month <= 12 or not 1 <= day <= 31:
+        return None
+    if hour > 23 or minute > 59:
+        return None
+    if second > 59:
+        second = 0
+    microsecond = hundredths * 10000 if hundredths < 100 else 0
+    return datetime(year, month, day, hour, minute, second, microsecond)
+
+
+def parse_utc_datetime(octets: bytes) -> datetime:
+    """parse a COSEM date-time (12 octets) into a naive UTC datetime
+
+    The deviation of the meter is applied, without one the meter clock is
+    taken as local time of this computer. returns None if the date-time is
+    not specified or the meter marks its clock as invalid.
+    """
+    time = parse_datetime(octets)
+    if time is None:
+        return None
+    status = octets[11]
+    if status != CLOCK_STATUS_NOT_SPECIFIED and status & CLOCK_INVALID:
+        return None
+    deviation = int.from_bytes(octets[9:11], "big", signed=True)
+    if deviation == DEVIATION_NOT_SPECIFIED:
+        return time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time + timedelta(minutes=deviation)
+
+
+def notification_utc(apdu: bytes) -> datetime:
+    """return the date-time of a data-notification in UTC or None if it is missing"""
+    if len(apdu) < 18 or apdu[0] != DATA_NOTIFICATION or apdu[5] != 12:
+        return None
+    return parse_utc_datetime(apdu[6:18])
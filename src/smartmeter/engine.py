@@ -0,0 +1,143 @@
+"""decode telegrams in a process pool, for archives and reprocessing
+
+    with DecodeEngine(config, {"haus": key}, workers=8) as engine:
+        for batch in engine.decode((meter_id, telegram, time) for ...):
+            ...
+
+Every worker process creates its decoder and the decryptors of all meters
+once (initializer) from the configuration of the caller, so a task carries
+only telegrams. The telegrams are sent
+in chunks of one meter (chunk_size telegrams) and come back as a ReadingBatch,
+whose columns are arrays pickled as plain bytes instead of a Python object
+per value. Batches are yielded in the order the chunks were formed, so the
+readings of every meter stay in order. At most two chunks per worker are in
+flight, memory does not depend on the size of the archive.
+
+A telegram without a time is stamped with the date-time sent by the meter,
+telegrams with neither are skipped. Duplicates are not dropped here.
+"""
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Iterable, Iterator
+
+from src.smartmeter.config import Configuration
+from src.smartmeter.data import SmartmeterToPostgres
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from src.smartmeter.reading import ReadingBatch
+
+# decoder and decryptors by meter id of a worker process, see init_engine_worker
+engine_decoder = None
+engine_decryptors = {}
+
+
+def init_engine_worker(
+    config: Configuration,
+    keys: dict[str, str],
+    authentication_keys: dict[str, str] = None,
+) -> None:
+    """create the decoder and the decryptors of a worker process once"""
+    global engine_decoder, engine_decryptors
+    authentication_keys = authentication_keys or {}
+    engine_decoder = SmartmeterToPostgres(config, PostgresTasks(config))
+    # telegrams of an archive are not checked against the live frame counters
+    engine_decoder.frame_counters = None
+    engine_decryptors = {
+        meter_id: engine_decoder.decryptor(key, authentication_keys.get(meter_id))
+        for meter_id, key in keys.items()
+    }
+
+
+def decode_chunk(meter_id: str, telegrams: list[bytes], times: list) -> ReadingBatch:
+    """decode the telegrams of one meter into a column-wise batch"""
+    decoder = engine_decoder
+    decryptor = engine_decryptors[meter_id]
+    batch = ReadingBatch(decoder.registry)
+    for telegram, time in zip(telegrams, times):
+        try:
+            if not decoder.process_telegram(telegram, decryptor):
+                continue
+            reading = decoder.reading(time or decoder.data["DeviceTime"], meter_id)
+            if reading.time is not None:
+                batch.append(reading)
+        except Exception as err:
+            logging.debug("telegram skipped: %s", err)
+    return batch
+
+
+class DecodeEngine:
+    """decode (meter id, telegram, time) in chunks on several processes
+
+    With workers=0 the chunks are decoded in the calling process.
+    """
+
+    def __init__(
+        self,
+        config: Configuration,
+        keys: dict[str, str],
+        workers: int = None,
+        chunk_size: int = 2000,
+        authentication_keys: dict[str, str] = None,
+    ) -> None:
+        self.config = config  # sent to the worker processes
+        self.keys = dict(keys)  # EVN key by meter id
+        # verifies the GCM tag of authenticated telegrams, by meter id
+        self.authentication_keys = dict(authentication_keys or {})
+        self.workers = os.cpu_count() if workers is None else workers
+        self.chunk_size = chunk_size
+        self.pool = None
+
+    def __enter__(self) -> "DecodeEngine":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def start(self) -> None:
+        initargs = (self.config, self.keys, self.authentication_keys)
+        if self.workers:
+            self.pool = ProcessPoolExecutor(
+                self.workers, initializer=init_engine_worker, initargs=initargs
+            )
+        else:
+            init_engine_worker(*initargs)
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def chunks(self, frames: Iterable[tuple]) -> Iterator[tuple]:
+        """group the frames into chunks of one meter, in order per meter"""
+        pending: dict[str, tuple[list, list]] = {}
+        for meter_id, telegram, time in frames:
+            if meter_id not in self.keys:
+                raise KeyError(f"no key for meter {meter_id}")
+            telegrams, times = pending.setdefault(meter_id, ([], []))
+            telegrams.append(telegram)
+            times.append(time)
+            if len(telegrams) >= self.chunk_size:
+                yield meter_id, telegrams, times
+                del pending[meter_id]
+        for meter_id, (telegrams, times) in pending.items():
+            yield meter_id, telegrams, times
+
+    def decode(
+        self, frames: Iterable[tuple[str, bytes, datetime]]
+    ) -> Iterator[ReadingBatch]:
+        """yield the readings of (meter id, telegram, time or None) as batches"""
+        if self.pool is None:
+            for chunk in self.chunks(frames):
+                yield decode_chunk(*chunk)
+            return
+        pending = deque()
+        for chunk in self.chunks(frames):
+            pending.append(self.pool.submit(decode_chunk, *chunk))
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
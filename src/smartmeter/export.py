@@ -0,0 +1,313 @@
+"""read the stored readings back and export them
+
+usage: python -m src.smartmeter export --start 2023-01-01 [--end 2024-01-01]
+           [--meter-id haus] [--bucket 15min] [--format csv|ndjson|parquet] output
+
+The smartmeter table is read month by month, every query touches one
+partition only and the server sorts a month at a time. CSV is streamed with
+COPY TO straight into the file, the other formats and ReadingReader.chunks
+use a server-side (named) cursor and fetch chunk_size rows at a time, so the
+memory needed does not depend on the time range.
+
+With a bucket (seconds or 10s, 15min, 1h, 1d) the rows are downsampled on the
+server like the rollup tables: the maximum of the energy counters, the
+average of the other values and the number of samples per bucket and meter.
+
+NumPy (ReadingReader.arrays) and pyarrow (parquet) are optional.
+"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+from datetime import datetime, timezone
+from typing import Iterator
+
+import psycopg2
+
+from src.smartmeter.config import Configuration
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.schema import month_start, next_month
+
+BUCKET_UNITS = {"s": 1, "min": 60, "h": 3600, "d": 86400}
+FORMATS = ("csv", "ndjson", "parquet")
+
+
+def parse_bucket(bucket) -> int:
+    """seconds of a bucket given as 900, "900", "15min", "1h" or "1d" """
+    match = re.fullmatch(r"\s*(\d+)\s*(s|min|h|d)?\s*", str(bucket))
+    if match is None or int(match[1]) <= 0:
+        raise ValueError(f"invalid bucket {bucket}")
+    return int(match[1]) * BUCKET_UNITS[match[2] or "s"]
+
+
+def month_ranges(start: datetime, end: datetime) -> Iterator[tuple[datetime, datetime]]:
+    """split [start, end) at the month boundaries, i.e. the partitions"""
+    while start < end:
+        month = next_month(month_start(start))
+        boundary = datetime(month.year, month.month, 1)
+        yield start, min(boundary, end)
+        start = boundary
+
+
+class ReadingReader:
+    """stream readings of a time range from the smartmeter table"""
+
+    def __init__(self, params: dict, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        self.params = params  # connection parameters (database.ini)
+        self.registry = registry
+        self.conn = None
+
+    def connect(self) -> None:
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.params)
+            self.conn.set_session(readonly=True)
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def columns(self, bucket: int = None) -> tuple:
+        if bucket:
+            return ("time", "meter_id", "samples") + self.registry.columns
+        return self.registry.row_columns
+
+    def query(self, bucket: int = None, meter_id: str = None) -> str:
+        """SELECT of a time range (%(start)s, %(end)s), ordered by time"""
+        where = "time >= %(start)s AND time < %(end)s"
+        if meter_id is not None:
+            where += " AND meter_id = %(meter_id)s"
+        if not bucket:
+            return f"SELECT {', '.join(self.registry.row_columns)} FROM smartmeter WHERE {where} ORDER BY time, meter_id"
+        # the averages keep the type of the column (avg of FLOAT4 is a double)
+        values = [
+            (
+                f"max({field.column}) AS {field.column}"
+                if field.integer
+                else f"avg({field.column})::{field.sql_type} AS {field.column}"
+            )
+            for field in self.registry.fields
+        ]
+        return f"""SELECT to_timestamp(floor(extract(epoch FROM time) / {bucket}) * {bucket})
+                AT TIME ZONE 'UTC' AS time,
+                meter_id,
+                count(*) AS samples,
+                {', '.join(values)}
+            FROM smartmeter WHERE {where}
+            GROUP BY 1, 2 ORDER BY 1, 2"""
+
+    def ranges(self, start: datetime, end: datetime, bucket: int = None):
+        """the time ranges queried one after the other
+
+        Raw rows are read per partition. A downsampled result is small, it is
+        queried at once so no bucket is split at a month boundary.
+        """
+        if bucket:
+            return [(start, end)]
+        return list(month_ranges(start, end))
+
+    def chunks(
+        self,
+        start: datetime,
+        end: datetime,
+        meter_id: str = None,
+        bucket: int = None,
+        chunk_size: int = 50000,
+    ) -> Iterator[dict[str, list]]:
+        """yield the readings as dicts of column -> list of at most chunk_size values"""
+        columns = self.columns(bucket)
+        sql = self.query(bucket, meter_id)
+        self.connect()
+        try:
+            for first, last in self.ranges(start, end, bucket):
+                # named: the rows stay on the server until fetched
+                with self.conn.cursor(name="smartmeter_export") as cur:
+                    cur.itersize = chunk_size
+                    cur.execute(
+                        sql, {"start": first, "end": last, "meter_id": meter_id}
+                    )
+                    while True:
+                        rows = cur.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield dict(zip(columns, map(list, zip(*rows))))
+        finally:
+            self.conn.rollback()
+
+    def arrays(self, start: datetime, end: datetime, **kwargs) -> Iterator[dict]:
+        """like chunks, the columns as NumPy arrays
+
+        Integer columns with NULLs are masked arrays.
+        """
+        import numpy as np
+
+        integers = {"frame_counter", "samples"} | {
+            field.column for field in self.registry.fields if field.integer
+        }
+        for chunk in self.chunks(start, end, **kwargs):
+            arrays = {}
+            for column, values in chunk.items():
+                if column == "time":
+                    arrays[column] = np.array(values, dtype="datetime64[us]")
+                elif column == "meter_id":
+                    arrays[column] = np.array(values, dtype=object)
+                elif column in integers:
+                    mask = [value is None for value in values]
+                    data = np.array(
+                        [0 if value is None else value for value in values],
+                        dtype=np.int64,
+                    )
+                    arrays[column] = np.ma.array(data, mask=mask) if any(mask) else data
+                else:
+                    arrays[column] = np.array(values, dtype=np.float64)
+            yield arrays
+
+    def copy_csv(
+        self,
+        file,
+        start: datetime,
+        end: datetime,
+        meter_id: str = None,
+        bucket: int = None,
+    ) -> None:
+        """write the readings as CSV with a header, the server formats the rows"""
+        sql = self.query(bucket, meter_id)
+        self.connect()
+        try:
+            with self.conn.cursor() as cur:
+                for i, (first, last) in enumerate(self.ranges(start, end, bucket)):
+                    query = cur.mogrify(
+                        sql, {"start": first, "end": last, "meter_id": meter_id}
+                    ).decode()
+                    header = " HEADER" if i == 0 else ""
+                    cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV{header}", file)
+        finally:
+            self.conn.rollback()
+
+
+def write_ndjson(chunks, file) -> int:
+    count = 0
+    for chunk in chunks:
+        columns = list(chunk)
+        for row in zip(*chunk.values()):
+            record = dict(zip(columns, row))
+            record["time"] = record["time"].isoformat()
+            file.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+def arrow_schema(reader: ReadingReader, bucket: int = None):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise Exception("parquet needs pyarrow: pip install pyarrow") from None
+
+    types = {"time": pa.timestamp("us"), "meter_id": pa.string()}
+    for field in reader.registry.fields:
+        if field.integer:
+            types[field.column] = pa.int64()
+        else:
+            types[field.column] = pa.float32()
+    return pa.schema(
+        [(column, types.get(column, pa.int64())) for column in reader.columns(bucket)]
+    )
+
+
+def write_parquet(chunks, path: str, schema) -> int:
+    """write every chunk as a row group of a parquet file"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pydict(chunk, schema=schema))
+            count += len(chunk["time"])
+    return count
+
+
+def export(
+    reader: ReadingReader,
+    path: str,
+    start: datetime,
+    end: datetime,
+    meter_id: str = None,
+    bucket: int = None,
+    format: str = "csv",
+    chunk_size: int = 50000,
+) -> int:
+    """export a time range to a file ("-": stdout), return the rows written (None for csv)"""
+    if format not in FORMATS:
+        raise ValueError(f"unknown format {format}")
+    if format == "parquet":
+        if path == "-":
+            raise ValueError("parquet can not be written to stdout")
+        # before the query, pyarrow may be missing
+        schema = arrow_schema(reader, bucket)
+    chunks = reader.chunks(start, end, meter_id, bucket, chunk_size)
+    if format == "parquet":
+        return write_parquet(chunks, path, schema)
+    file = sys.stdout if path == "-" else open(path, "w", newline="")
+    try:
+        if format == "csv":
+            reader.copy_csv(file, start, end, meter_id, bucket)
+            return None
+        return write_ndjson(chunks, file)
+    finally:
+        if file is not sys.stdout:
+            file.close()
+
+
+def parse_time(value: str) -> datetime:
+    """date or date-time in UTC"""
+    time = datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def main(argv: list[str] = None, config: Configuration = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m src.smartmeter export",
+        description="export stored smartmeter readings",
+    )
+    parser.add_argument("output", help="output file, - for stdout")
+    parser.add_argument("--start", type=parse_time, required=True, help="UTC")
+    parser.add_argument("--end", type=parse_time, help="UTC, default: now")
+    parser.add_argument("--meter-id")
+    parser.add_argument("--bucket", type=parse_bucket, help="e.g. 60, 15min, 1h")
+    parser.add_argument("--format", choices=FORMATS, help="default: file extension")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    format = args.format
+    if format is None:
+        extension = args.output.rsplit(".", 1)[-1].lower()
+        format = extension if extension in FORMATS else "csv"
+    end = args.end or datetime.now(timezone.utc).replace(tzinfo=None)
+    config = config or Configuration()
+    reader = ReadingReader(
+        config.postgresql_config(), ObisRegistry.from_config(config.yaml_config())
+    )
+    try:
+        count = export(
+            reader,
+            args.output,
+            args.start,
+            end,
+            meter_id=args.meter_id,
+            bucket=args.bucket,
+            format=format,
+            chunk_size=args.chunk_size,
+        )
+    finally:
+        reader.close()
+    if count is not None:
+        logging.info(f"{count} rows exported to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
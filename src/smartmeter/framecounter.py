@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+from time import monotonic
+
+from src.smartmeter.logs import HexBytes
+
+
+class FrameCounterTracker:
+    """track the frame counter of every meter (system title) to drop duplicate telegrams
+
+    A telegram is new if its frame counter is higher than the last accepted
+    one, skipped counters are counted as lost telegrams. The high-water marks
+    are saved to a JSON file (at most every save_interval seconds) so a restart
+    does not ingest the same telegrams again.
+    """
+
+    def __init__(self, path: str = None, save_interval: float = 60.0) -> None:
+        self.path = path  # None: kept in memory only
+        self.save_interval = save_interval
+        self.counters: dict[bytes, int] = {}
+        self.duplicates = 0  # telegrams dropped, counter not increasing
+        self.lost = 0  # telegrams missing between two accepted counters
+        self.saved_at = monotonic()
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self) -> None:
+        with open(self.path) as file:
+            counters = json.load(file)
+        self.counters = {
+            bytes.fromhex(system_title): counter
+            for system_title, counter in counters.items()
+        }
+
+    def save(self) -> None:
+        """write the high-water marks atomically"""
+        if self.path is None:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(
+                {
+                    system_title.hex(): counter
+                    for system_title, counter in self.counters.items()
+                },
+                file,
+            )
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+        self.saved_at = monotonic()
+        self.changed = False
+
+    def is_new(self, system_title: bytes, frame_counter: int) -> bool:
+        """True if the telegram was not seen before"""
+        last = self.counters.get(system_title)
+        if last is not None and frame_counter <= last:
+            self.duplicates += 1
+            logging.info(
+                "telegram %s of %s dropped, last was %s",
+                frame_counter,
+                HexBytes(system_title),
+                last,
+            )
+            return False
+        return True
+
+    def update(self, system_title: bytes, frame_counter: int) -> None:
+        """remember the frame counter of an accepted telegram"""
+        last = self.counters.get(system_title)
+        if last is not None and frame_counter <= last:
+            return  # not newer than the mark, the mark stays
+        if last is not None and frame_counter > last + 1:
+            self.lost += frame_counter - last - 1
+        self.counters[system_title] = frame_counter
+        self.changed = True
+        if monotonic() - self.saved_at >= self.save_interval:
+            self.save()
+
+    def close(self) -> None:
+        if self.changed:
+            self.save()
@@ -0,0 +1,124 @@
+import os
+import signal
+import threading
+
+from dev.definitions import ROOT_DIR
+from src.smartmeter.capture import FrameCapture
+from src.smartmeter.config import Configuration
+from src.smartmeter.data import SmartmeterToPostgres
+from src.smartmeter.logs import limited
+from src.smartmeter.metrics import serve_metrics
+from src.smartmeter.pipeline import Pipeline
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from src.smartmeter.profiler import start_profiler
+from src.smartmeter.sinks import open_sinks
+
+
+def terminate(signum, frame) -> None:
+    raise SystemExit(f"terminated by signal {signum}")
+
+
+class Gateway:
+    """read one or several smartmeters from one process
+
+    The meters are listed under meters in main_config.yaml, without that list
+    the single meter of port and meterId is read. The telegrams of all meters
+    are decoded by one SmartmeterToPostgres instance and handed to the sinks,
+    see Pipeline.
+    """
+
+    def __init__(
+        self,
+        config: Configuration,
+        client: PostgresTasks,
+    ) -> None:
+        self.decoder = SmartmeterToPostgres(config, client)
+        self.config_yaml = self.decoder.config_yaml
+        self.meters = self.meter_configs()
+
+    def meter_configs(self) -> list[dict]:
+        """read the meters of main_config.yaml, the keys are given directly or by the name of an environment variable"""
+        meters = []
+        configured = self.config_yaml.get("meters") or [
+            {
+                "meterId": self.config_yaml.get("meterId") or "",
+                "port": self.config_yaml["port"],
+                "authenticationKeyEnv": self.config_yaml.get("authenticationKeyEnv"),
+            }
+        ]
+        for meter in configured:
+            meter_id = str(meter["meterId"])
+            key = meter.get("key") or os.getenv(meter.get("keyEnv", "EVN_SCHLUESSEL"))
+            if not key:
+                raise Exception(f"no key found for meter {meter_id}")
+            authentication_key = meter.get("authenticationKey")
+            if not authentication_key and meter.get("authenticationKeyEnv"):
+                authentication_key = os.getenv(meter["authenticationKeyEnv"])
+                if not authentication_key:
+                    raise Exception(f"no authentication key found for meter {meter_id}")
+            meters.append(
+                {
+                    "meterId": meter_id,
+                    "port": meter["port"],
+                    "baudrate": meter.get("baudrate", self.config_yaml["baudrate"]),
+                    "key": key,
+                    "authenticationKey": authentication_key,
+                    "decryptor": self.decoder.decryptor(key, authentication_key),
+                }
+            )
+        return meters
+
+    def open_captures(self) -> dict[str, FrameCapture]:
+        """the raw capture file of every meter if captureDir is set"""
+        capture_dir = self.config_yaml.get("captureDir")
+        if not capture_dir:
+            return {}
+        return {
+            meter["meterId"]: FrameCapture(
+                os.path.join(
+                    ROOT_DIR, capture_dir, f"{meter['meterId'] or 'meter'}.bin"
+                ),
+                max_bytes=self.config_yaml.get("captureMaxMB", 16) << 20,
+                backups=self.config_yaml.get("captureFiles", 5),
+            )
+            for meter in self.meters
+        }
+
+    def run(self) -> None:
+        """read, decode and store the telegrams of all meters"""
+        limited.interval = self.config_yaml.get("logRateLimit", 60)
+        if self.config_yaml.get("metricsPort"):
+            serve_metrics(
+                self.config_yaml["metricsPort"],
+                self.config_yaml.get("metricsHost", "127.0.0.1"),
+            )
+        profiler = start_profiler(self.config_yaml)
+        handler = None
+        if threading.current_thread() is threading.main_thread():
+            # SIGTERM unwinds like Ctrl-C, the sinks are stopped below
+            handler = signal.signal(signal.SIGTERM, terminate)
+        sinks = open_sinks(self.config_yaml, self.decoder)
+        sinks.start()
+        self.decoder.open_frame_counters()
+        self.decoder.open_live([meter["meterId"] for meter in self.meters])
+
+        try:
+            Pipeline(
+                self.decoder,
+                self.meters,
+                sinks,
+                queue_size=self.config_yaml.get("queueSize", 64),
+                workers=self.config_yaml.get("decodeWorkers", 0),
+                stats_interval=self.config_yaml.get("statsInterval", 60),
+                captures=self.open_captures(),
+            ).run()
+        finally:
+            try:
+                # the buffered readings, the open windows and the writer batch, see PostgresSink
+                sinks.stop()
+            finally:
+                self.decoder.frame_counters.close()
+                if profiler is not None:
+                    profiler.stop()
+                if handler is not None:
+                    signal.signal(signal.SIGTERM, handler)
@@ -0,0 +1,211 @@
+"""latest reading of every meter in a memory-mapped file, for local consumers
+
+With liveDir set in main_config.yaml every decoded reading is written to
+<liveDir>/<meterId>.live (e.g. liveDir: "/dev/shm/smartmeter", a tmpfs).
+Other processes read the latest values from the file without a database
+query and without a lock:
+
+    from src.smartmeter.live import LiveReader
+
+    reader = LiveReader("/dev/shm/smartmeter/haus.live")
+    reading = reader.read()
+    reading.values["MomentanleistungP"]
+
+The file has a fixed layout (little-endian):
+
+    0   header  magic "SMLV", layout version (u16), number of values (u16)
+    16  names   32 bytes per value, the names of the OBIS registry (UTF-8)
+    ..  slot    sequence (u64), time (µs since 1970, i64), frame counter (i64),
+                meter id (32 bytes), values (f64, NaN: missing), CRC-32
+
+The slot is guarded by a seqlock: the writer makes the sequence odd, writes
+the slot and makes it even again. A reader retries if the sequence was odd
+or changed while it read, the CRC catches a torn read where the stores are
+not ordered. The names are written once, so readers built against another
+registry still find their values.
+
+    python -m src.smartmeter.live [--watch] haus.live
+
+prints the latest values, the console output is not done by the reader.
+"""
+
+import argparse
+import math
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime
+from time import monotonic, sleep
+from typing import NamedTuple
+
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.reading import Reading, from_micros, to_micros
+
+MAGIC = b"SMLV"
+LAYOUT = 1
+HEADER = struct.Struct("<4sHH8x")
+NAME_SIZE = 32
+SEQUENCE = struct.Struct("<Q")
+NAN = float("nan")
+
+
+def slot_format(count: int) -> struct.Struct:
+    """time, frame counter, meter id and the values, followed by the CRC"""
+    return struct.Struct(f"<qq{NAME_SIZE}s{count}d")
+
+
+def sequence_offset(count: int) -> int:
+    return HEADER.size + NAME_SIZE * count
+
+
+def file_size(count: int) -> int:
+    return sequence_offset(count) + SEQUENCE.size + slot_format(count).size + 4
+
+
+class LiveReading(NamedTuple):
+    time: datetime
+    meter_id: str
+    frame_counter: int
+    values: dict  # name -> value, None if the meter sent none
+    sequence: int  # increases with every published reading
+
+
+class LivePublisher:
+    """write the latest reading of a meter into the live file, one writer per file"""
+
+    def __init__(self, path: str, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        self.path = path
+        count = len(registry.names)
+        self.slot = slot_format(count)
+        self.sequence_at = sequence_offset(count)
+        self.slot_at = self.sequence_at + SEQUENCE.size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, file_size(count))
+            self.map = mmap.mmap(fd, file_size(count))
+        finally:
+            os.close(fd)
+        self.sequence = 0
+        if HEADER.unpack_from(self.map, 0) == (MAGIC, LAYOUT, count):
+            # continue the sequence of the previous run, readers wait for a change
+            (sequence,) = SEQUENCE.unpack_from(self.map, self.sequence_at)
+            self.sequence = sequence + (sequence & 1)
+        names = b"".join(
+            name.encode("utf-8")[:NAME_SIZE].ljust(NAME_SIZE, b"\0")
+            for name in registry.names
+        )
+        self.map[HEADER.size : self.sequence_at] = names
+        HEADER.pack_into(self.map, 0, MAGIC, LAYOUT, count)
+
+    def publish(self, reading: Reading) -> None:
+        values = [NAN if value is None else value for value in reading.values]
+        data = self.slot.pack(
+            to_micros(reading.time),
+            reading.frame_counter if reading.frame_counter is not None else -1,
+            reading.meter_id.encode("utf-8")[:NAME_SIZE],
+            *values,
+        )
+        end = self.slot_at + len(data)
+        self.sequence += 1
+        SEQUENCE.pack_into(self.map, self.sequence_at, self.sequence)
+        self.map[self.slot_at : end] = data
+        self.map[end : end + 4] = zlib.crc32(data).to_bytes(4, "little")
+        self.sequence += 1
+        SEQUENCE.pack_into(self.map, self.sequence_at, self.sequence)
+
+    def close(self) -> None:
+        self.map.close()
+
+
+class LiveReader:
+    """read the latest reading from a live file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, layout, count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or layout != LAYOUT:
+            raise ValueError(f"{path} is no live file of layout {LAYOUT}")
+        self.names = tuple(
+            self.map[offset : offset + NAME_SIZE].rstrip(b"\0").decode("utf-8")
+            for offset in range(HEADER.size, sequence_offset(count), NAME_SIZE)
+        )
+        self.slot = slot_format(count)
+        self.sequence_at = sequence_offset(count)
+        self.slot_at = self.sequence_at + SEQUENCE.size
+
+    def sequence(self) -> int:
+        """the sequence of the latest reading, cheap to poll for changes"""
+        return SEQUENCE.unpack_from(self.map, self.sequence_at)[0]
+
+    def read(self, retries: int = 1000) -> LiveReading:
+        """the latest reading, None if nothing was published yet"""
+        slot, crc_at = self.slot, self.slot_at + self.slot.size
+        for _ in range(retries):
+            before = SEQUENCE.unpack_from(self.map, self.sequence_at)[0]
+            if before & 1:
+                continue  # being written
+            if before == 0:
+                return None
+            data = self.map[self.slot_at : crc_at]
+            crc = int.from_bytes(self.map[crc_at : crc_at + 4], "little")
+            after = SEQUENCE.unpack_from(self.map, self.sequence_at)[0]
+            if before == after and zlib.crc32(data) == crc:
+                time, frame_counter, meter_id, *values = slot.unpack(data)
+                return LiveReading(
+                    from_micros(time),
+                    meter_id.rstrip(b"\0").decode("utf-8"),
+                    frame_counter if frame_counter >= 0 else None,
+                    {
+                        name: None if math.isnan(value) else value
+                        for name, value in zip(self.names, values)
+                    },
+                    before,
+                )
+        raise TimeoutError(f"{self.path}: no consistent reading after {retries} tries")
+
+    def wait(
+        self, sequence: int, timeout: float = None, interval: float = 0.05
+    ) -> LiveReading:
+        """wait for a reading newer than sequence, None after timeout seconds"""
+        deadline = None if timeout is None else monotonic() + timeout
+        while self.sequence() <= sequence:
+            if deadline is not None and monotonic() >= deadline:
+                return None
+            sleep(interval)
+        return self.read()
+
+    def close(self) -> None:
+        self.map.close()
+
+
+def main() -> None:
+    from src.smartmeter.data import print_values
+
+    parser = argparse.ArgumentParser(
+        description="print the latest reading of a live file"
+    )
+    parser.add_argument("path", help="live file, e.g. /dev/shm/smartmeter/haus.live")
+    parser.add_argument("--watch", action="store_true", help="print every reading")
+    args = parser.parse_args()
+
+    reader = LiveReader(args.path)
+    reading = reader.read()
+    if reading is None and not args.watch:
+        print("no reading published yet")
+        return
+    while True:
+        if reading is not None:
+            print_values(reading.values, reading.meter_id or None)
+        if not args.watch:
+            break
+        reading = reader.wait(reading.sequence if reading is not None else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""lazy and rate-limited logging for the per-telegram path
+
+Messages on the per-telegram path use %-style arguments, so nothing is
+formatted unless the record is emitted. HexBytes defers the hex encoding
+of telegrams and APDUs, event() logs a message with key=value fields and
+returns right away if the level is disabled. Warnings which repeat for every
+telegram (a noisy serial line) go through limited, which lets a message
+through once per interval and reports how many were suppressed.
+"""
+
+import logging
+import threading
+from time import monotonic
+
+
+class HexBytes:
+    """bytes which are hex encoded only when the log record is formatted"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def __str__(self) -> str:
+        return bytes(self.data).hex()
+
+
+class Fields:
+    """key=value pairs of an event, formatted only when the record is emitted"""
+
+    __slots__ = ("message", "fields")
+
+    def __init__(self, message: str, fields: dict) -> None:
+        self.message = message
+        self.fields = fields
+
+    def __str__(self) -> str:
+        pairs = " ".join(f"{key}={value}" for key, value in self.fields.items())
+        return f"{self.message} {pairs}" if pairs else self.message
+
+
+def event(level: int, message: str, **fields) -> None:
+    """log a message with fields, the fields are also passed as extra for formatters"""
+    logger = logging.getLogger()
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s", Fields(message, fields), extra={"fields": fields})
+
+
+class RateLimitedLog:
+    """let every message through at most once per interval seconds
+
+    Messages are told apart by their format string, not the arguments, so
+    "telegram dropped: %s" is limited whatever the error was.
+    """
+
+    def __init__(self, interval: float = 60.0) -> None:
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last: dict[str, float] = {}  # message -> monotonic time logged
+        self.suppressed: dict[str, int] = {}
+
+    def log(self, level: int, message: str, *args) -> None:
+        logger = logging.getLogger()
+        if not logger.isEnabledFor(level):
+            return
+        now = monotonic()
+        with self.lock:
+            last = self.last.get(message)
+            if last is not None and now - last < self.interval:
+                self.suppressed[message] = self.suppressed.get(message, 0) + 1
+                return
+            self.last[message] = now
+            suppressed = self.suppressed.pop(message, 0)
+        if suppressed:
+            logger.log(
+                level,
+                message + " (%d more in the last %.0f s)",
+                *args,
+                suppressed,
+                self.interval,
+            )
+        else:
+            logger.log(level, message, *args)
+
+    def warning(self, message: str, *args) -> None:
+        self.log(logging.WARNING, message, *args)
+
+    def info(self, message: str, *args) -> None:
+        self.log(logging.INFO, message, *args)
+
+
+limited = RateLimitedLog()
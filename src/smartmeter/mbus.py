@@ -0,0 +1,92 @@
+"""streaming M-Bus framer for the push telegrams of the smartmeter
+
+The T210-D sends every telegram as a long frame followed by a short frame
+(68 LL LL 68 C A CI ... CS 16). The CI field numbers the segments, bit 0x10
+marks the last one. The framer buffers the bytes read from the serial port,
+resynchronizes on the start sequence and yields the frames of a telegram
+together, exactly as they were sent.
+"""
+
+from typing import Iterator
+
+from src.smartmeter.logs import limited
+
+START = 0x68
+STOP = 0x16
+HEADER_LENGTH = 4  # 68 LL LL 68
+LAST_SEGMENT = 0x10  # CI bit of the last frame of a telegram
+
+
+class MbusFramer:
+    """reassemble telegrams from a stream of bytes"""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.segments: list[bytes] = []  # frames of the current telegram
+        self.frames = 0  # valid frames
+        self.skipped = 0  # bytes dropped while searching for a start sequence
+        self.checksum_errors = 0
+        self.incomplete = 0  # telegrams dropped because a segment was lost
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """add received bytes and return the completed telegrams"""
+        self.buffer += data
+        telegrams = []
+        for frame in self.frames_in_buffer():
+            telegram = self.add_segment(frame)
+            if telegram is not None:
+                telegrams.append(telegram)
+        return telegrams
+
+    def frames_in_buffer(self) -> Iterator[bytes]:
+        """yield the valid frames in the buffer and keep an incomplete rest"""
+        buffer = self.buffer
+        pos = 0
+        while True:
+            start = buffer.find(START, pos)
+            if start < 0:
+                self.skipped += len(buffer) - pos
+                pos = len(buffer)
+                break
+            self.skipped += start - pos
+            pos = start
+            if len(buffer) - pos < HEADER_LENGTH:
+                break
+            length = buffer[pos + 1]
+            if buffer[pos + 2] != length or buffer[pos + 3] != START or length < 3:
+                # no start sequence, search again from the next byte
+                self.skipped += 1
+                pos += 1
+                continue
+            end = pos + HEADER_LENGTH + length + 2
+            if len(buffer) < end:
+                break
+            user_data = buffer[pos + HEADER_LENGTH : end - 2]
+            if buffer[end - 1] != STOP or sum(user_data) & 0xFF != buffer[end - 2]:
+                limited.warning("M-Bus frame with wrong checksum or stop byte")
+                self.checksum_errors += 1
+                self.skipped += 1
+                pos += 1
+                continue
+            self.frames += 1
+            yield bytes(buffer[pos:end])
+            pos = end
+        del buffer[:pos]
+
+    def add_segment(self, frame: bytes) -> bytes:
+        """collect the frames of a telegram, return the telegram once it is complete"""
+        ci = frame[6]
+        if (ci & 0x0F) != len(self.segments):
+            # a segment got lost, start over with this frame
+            if self.segments:
+                limited.warning("incomplete M-Bus telegram dropped")
+                self.incomplete += 1
+            self.segments = []
+            if ci & 0x0F:
+                return None
+        self.segments.append(frame)
+        if ci & LAST_SEGMENT:
+            telegram = b"".join(self.segments)
+            self.segments = []
+            return telegram
+        return None
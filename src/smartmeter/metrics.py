@@ -0,0 +1,275 @@
+"""counters and histograms of the gateway, exposed in the Prometheus text format
+
+The metrics are module level objects of the registry METRICS and cheap
+enough to stay on in production: an increment is a dict update under an
+uncontended lock, a histogram observation adds a bisect over the buckets.
+Values other parts already count (framer, sinks, queues) are read by
+callbacks when the metrics are collected instead of being counted twice.
+
+With metricsPort in main_config.yaml the metrics are served on
+http://<metricsHost>:<metricsPort>/metrics. Telegrams decoded in worker
+processes (decodeWorkers) are not counted by the decoder metrics.
+"""
+
+import logging
+import threading
+from bisect import bisect_left
+
+# seconds, from the AES of a telegram to a slow database round trip
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value) -> str:
+    if isinstance(value, float) and value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """a metric with one value per combination of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+
+    def collect(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """(name suffix, labels, value) of every exposed sample"""
+        return [
+            ("", format_labels(self.labels, labels), value)
+            for labels, value in sorted(self.collect().items())
+        ]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: int = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, *labels) -> int:
+        return self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+    def value(self, *labels):
+        return self.values.get(labels, 0)
+
+
+class Callback(Metric):
+    """values read from elsewhere when the metrics are collected
+
+    function returns {label values: value}, or the value without labels.
+    """
+
+    def __init__(
+        self, name: str, help: str, function, kind: str = "gauge", labels: tuple = ()
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.function = function
+        self.kind = kind
+
+    def collect(self) -> dict:
+        values = self.function()
+        return values if isinstance(values, dict) else {(): values}
+
+
+class Histogram(Metric):
+    """count observations in cumulative buckets, with their sum"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # per bucket (last: above all buckets), then the sum
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[labels] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+    def collect(self) -> dict:
+        with self.lock:
+            return {labels: list(counts) for labels, counts in self.values.items()}
+
+    def count(self, *labels) -> int:
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        samples = []
+        for labels, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{format_value(float(bound))}"'
+                samples.append(
+                    ("_bucket", format_labels(self.labels, labels, le), cumulative)
+                )
+            samples.append(("_sum", format_labels(self.labels, labels), counts[-1]))
+            samples.append(("_count", format_labels(self.labels, labels), cumulative))
+        return samples
+
+    def quantile(self, fraction: float, *labels) -> float:
+        """upper bound of the bucket holding the quantile, an estimate for the stats log"""
+        counts = self.values.get(labels)
+        if not counts:
+            return 0.0
+        rank = fraction * sum(counts[:-1])
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """the metrics by name, a metric registered again replaces the old one"""
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(
+        self, name: str, help: str, labels: tuple = (), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(
+        self, name: str, help: str, function, kind: str = "gauge", labels: tuple = ()
+    ) -> Callback:
+        return self.register(Callback(name, help, function, kind, labels))
+
+    def render(self) -> str:
+        """all metrics in the Prometheus text format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as err:
+                logging.warning(f"metric {metric.name} not collected: {err}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """counters and gauges summed over their labels, p50/p99 of histograms, for the stats log"""
+        summary = {}
+        for name, metric in list(self.metrics.items()):
+            if isinstance(metric, Histogram):
+                for labels in sorted(metric.collect()):
+                    key = ".".join((name,) + labels)
+                    summary[key] = {
+                        "count": metric.count(*labels),
+                        "p50": metric.quantile(0.5, *labels),
+                        "p99": metric.quantile(0.99, *labels),
+                    }
+            else:
+                try:
+                    summary[name] = sum(metric.collect().values())
+                except Exception:
+                    continue
+        return summary
+
+
+METRICS = MetricsRegistry()
+
+
+def serve_metrics(
+    port: int, host: str = "127.0.0.1", registry: MetricsRegistry = METRICS
+):
+    """serve /metrics from a daemon thread, returns the server (shutdown() stops it)"""
+    # http.server is imported only if the metrics are served
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            # scrapes are not logged
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    logging.info(f"metrics served on http://{host}:{server.server_port}/metrics")
+    return server
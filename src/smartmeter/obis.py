@@ -0,0 +1,126 @@
+"""registry of the OBIS codes which are decoded and stored
+
+Every field maps an OBIS code to the key of the processed data, the column
+of the smartmeter table and its SQL type. The value is scaled with the
+scaler the meter sends (10^scaler), the scaler of the field is only used if
+the meter sends none (e.g. the Gurux fallback). The table columns, the
+insert statements and the decoder lookup are all generated from here.
+
+Further codes are added in main_config.yaml:
+
+    obisCodes:
+      - code: "1.0.3.8.0.255"
+        name: "BlindenergieP"
+        column: "blindenergie_p"
+        type: "BIGINT"
+"""
+
+import re
+from typing import NamedTuple
+
+INTEGER_TYPES = ("BIGINT", "INTEGER", "SMALLINT")
+# columns of a row in front of the values
+ROW_PREFIX = ("time", "meter_id", "frame_counter")
+
+
+class ObisField(NamedTuple):
+    code: bytes  # 6 bytes A B C D E F
+    name: str  # key of the processed data
+    column: str  # column of the smartmeter table
+    sql_type: str = "FLOAT4"
+    scaler: int = 0  # used if the meter sends no scaler
+
+    @property
+    def integer(self) -> bool:
+        return self.sql_type.upper() in INTEGER_TYPES
+
+
+def parse_code(code: str) -> bytes:
+    """parse an OBIS code given as 1.0.32.7.0.255, 1-0:32.7.0*255 or hex 0100200700FF"""
+    code = str(code).strip()
+    if re.fullmatch(r"[0-9A-Fa-f]{12}", code):
+        return bytes.fromhex(code)
+    groups = re.split(r"[.:*-]", code)
+    if len(groups) != 6:
+        raise ValueError(f"invalid OBIS code {code}")
+    return bytes(int(group) for group in groups)
+
+
+def format_code(code: bytes) -> str:
+    return ".".join(str(group) for group in code)
+
+
+DEFAULT_FIELDS = (
+    ObisField(parse_code("1.0.1.8.0.255"), "WirkenergieP", "wirkenergie_p", "BIGINT"),
+    ObisField(parse_code("1.0.2.8.0.255"), "WirkenergieN", "wirkenergie_n", "BIGINT"),
+    ObisField(parse_code("1.0.1.7.0.255"), "MomentanleistungP", "momentanleistung_p"),
+    ObisField(parse_code("1.0.2.7.0.255"), "MomentanleistungN", "momentanleistung_n"),
+    ObisField(parse_code("1.0.32.7.0.255"), "SpannungL1", "spannung_l1", scaler=-1),
+    ObisField(parse_code("1.0.52.7.0.255"), "SpannungL2", "spannung_l2", scaler=-1),
+    ObisField(parse_code("1.0.72.7.0.255"), "SpannungL3", "spannung_l3", scaler=-1),
+    ObisField(parse_code("1.0.31.7.0.255"), "StromL1", "strom_l1", scaler=-2),
+    ObisField(parse_code("1.0.51.7.0.255"), "StromL2", "strom_l2", scaler=-2),
+    ObisField(parse_code("1.0.71.7.0.255"), "StromL3", "strom_l3", scaler=-2),
+    ObisField(
+        parse_code("1.0.13.7.0.255"), "Leistungsfaktor", "leistungsfaktor", scaler=-3
+    ),
+)
+
+
+class ObisRegistry:
+    """the stored OBIS fields with lookup tables built once"""
+
+    def __init__(self, fields=DEFAULT_FIELDS) -> None:
+        self.fields = tuple(fields)
+        self.by_code = {field.code: field for field in self.fields}
+        if len(self.by_code) != len(self.fields):
+            raise ValueError("duplicate OBIS code in the registry")
+        self.codes = frozenset(self.by_code)
+        self.names = tuple(field.name for field in self.fields)
+        self.columns = tuple(field.column for field in self.fields)
+        self.row_columns = ROW_PREFIX + self.columns
+        # 10^scaler for every int8 scaler, computed once
+        self.factors = {scaler: 10**scaler for scaler in range(-128, 128)}
+
+    @classmethod
+    def from_config(cls, config_yaml: dict) -> "ObisRegistry":
+        """the default fields and the obisCodes of main_config.yaml"""
+        fields = list(DEFAULT_FIELDS)
+        for field in config_yaml.get("obisCodes") or []:
+            fields.append(
+                ObisField(
+                    parse_code(field["code"]),
+                    field["name"],
+                    field["column"],
+                    field.get("type", "FLOAT4"),
+                    field.get("scaler", 0),
+                )
+            )
+        return cls(fields)
+
+    def scale(self, field: ObisField, value, scaler: int = None):
+        if scaler is None:
+            scaler = field.scaler
+        if scaler == 0 or not isinstance(value, (int, float)):
+            return value
+        value *= self.factors[scaler]
+        return round(value) if field.integer else value
+
+    def extract(self, values: dict) -> dict:
+        """map the decoded values (OBIS code -> (value, scaler, unit)) to scaled values by name"""
+        data = {}
+        by_code = self.by_code
+        for code, (value, scaler, _) in values.items():
+            field = by_code.get(code)
+            if field is not None:
+                data[field.name] = self.scale(field, value, scaler)
+        return data
+
+    def column_definitions(self) -> str:
+        """SQL definitions of the value columns"""
+        return ",\n    ".join(
+            f"{field.column} {field.sql_type}" for field in self.fields
+        )
+
+
+DEFAULT_REGISTRY = ObisRegistry()
@@ -0,0 +1,411 @@
+"""staged asyncio pipeline: serial readers -> framer -> decoder -> storage
+
+Every serial port is read by its own thread which hands the received bytes
+to the event loop and never waits for the stages behind it, if the first
+queue is full the bytes are dropped and counted. The stages are connected
+by bounded queues, so a slow stage backs up the stages in front of it
+instead of growing memory. Decoding runs in the event loop or, with
+decodeWorkers set, in a process pool: the frame counter of a telegram is
+taken when it is sent to a worker, so a duplicate is dropped even before the
+first copy is decoded, and the readings are collected in the order the
+telegrams were sent, so the readings of a meter stay in order. The readings are handed to the sinks,
+every sink buffers and writes them in its own thread, a slow database does
+not stall framing and decoding.
+
+The depth of every queue and the latency since the bytes were received
+are kept per stage, logged every statsInterval seconds together with a
+summary of the metrics and exported as metrics (see metrics.py).
+"""
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic, sleep
+
+import serial
+
+from src.smartmeter import crypto
+from src.smartmeter.capture import FrameCapture
+from src.smartmeter.config import Configuration
+from src.smartmeter.data import SmartmeterToPostgres
+from src.smartmeter.mbus import MbusFramer
+from src.smartmeter.metrics import METRICS
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from src.smartmeter.reading import Reading
+from src.smartmeter.sinks import Fanout
+
+# decoder of a worker process, see init_worker
+worker_decoder = None
+
+LATENCY = METRICS.histogram(
+    "smartmeter_pipeline_latency_seconds",
+    "seconds from receiving the bytes to the end of a stage",
+    ("stage",),
+)
+# counters of the framer, exported per meter
+FRAMER_COUNTERS = {
+    "frames": "valid M-Bus frames",
+    "skipped": "bytes dropped while searching for a start sequence",
+    "checksum_errors": "M-Bus frames with a wrong checksum or stop byte",
+    "incomplete": "telegrams dropped because a segment was lost",
+}
+
+
+def decode_telegram(
+    decoder: SmartmeterToPostgres,
+    decryptor: crypto.ApduDecryptor,
+    telegram: bytes,
+    time: datetime,
+    meter_id: str,
+) -> Reading:
+    """return the reading of a telegram, None if it carried no data"""
+    if not decoder.process_telegram(telegram, decryptor):
+        return None
+    return decoder.reading(time, meter_id)
+
+
+def init_worker(config: Configuration) -> None:
+    """create the decoder of a worker process once, with the configuration of the gateway"""
+    global worker_decoder
+    worker_decoder = SmartmeterToPostgres(config, PostgresTasks(config))
+    # duplicates are dropped by the pipeline before a telegram is sent to a worker
+    worker_decoder.frame_counters = None
+
+
+def decode_in_worker(
+    key: str, authentication_key: str, telegram: bytes, time: datetime, meter_id: str
+):
+    decryptor = worker_decoder.decryptor(key, authentication_key)
+    return decode_telegram(worker_decoder, decryptor, telegram, time, meter_id)
+
+
+class StageStats:
+    """counters of a pipeline stage"""
+
+    def __init__(self, name: str, queue: asyncio.Queue = None) -> None:
+        self.name = name
+        self.queue = queue  # queue in front of the next stage
+        self.processed = 0
+        self.dropped = 0
+        self.latency_sum = 0.0  # seconds since the bytes were received
+        self.latency_max = 0.0
+
+    def record(self, received: float) -> None:
+        latency = monotonic() - received
+        self.processed += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        LATENCY.observe(latency, self.name)
+
+    def snapshot(self) -> dict:
+        return {
+            "depth": self.queue.qsize() if self.queue is not None else 0,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "latency_avg_ms": (
+                1000 * self.latency_sum / self.processed if self.processed else 0.0
+            ),
+            "latency_max_ms": 1000 * self.latency_max,
+        }
+
+
+class SerialReader(threading.Thread):
+    """read the bytes of one smartmeter and hand them to the pipeline"""
+
+    def __init__(self, meter: dict, deliver, capture: FrameCapture = None) -> None:
+        super().__init__(name=f"meter-{meter['meterId']}", daemon=True)
+        self.meter = meter
+        self.deliver = deliver  # called with (meter, bytes, monotonic time, utc time)
+        self.capture = capture  # raw bytes are appended here, optional
+        self.ser = None  # serial port
+
+    def open(self) -> None:
+        """open the serial port, retry until it is available"""
+        while True:
+            try:
+                self.ser = serial.Serial(
+                    port=self.meter["port"],
+                    baudrate=self.meter["baudrate"],
+                    bytesize=serial.EIGHTBITS,
+                    parity=serial.PARITY_NONE,
+                    stopbits=serial.STOPBITS_ONE,
+                )
+                return
+            except serial.SerialException as err:
+                logging.error(f"meter {self.meter['meterId']}: {err}")
+                sleep(10)
+
+    def reopen(self) -> None:
+        """close a port which failed (e.g. the USB adapter was unplugged) and open it again"""
+        try:
+            self.ser.close()
+        except serial.SerialException:
+            pass
+        sleep(10)
+        self.open()
+
+    def run(self) -> None:
+        self.open()
+        while True:
+            try:
+                # block for at least one byte, then take everything already received
+                data = self.ser.read(max(1, self.ser.in_waiting))
+            except serial.SerialException as err:
+                logging.error(f"meter {self.meter['meterId']}: {err}, reopening")
+                self.reopen()
+                continue
+            if self.capture is not None:
+                self.capture.write(data)
+            self.deliver(
+                self.meter,
+                data,
+                monotonic(),
+                datetime.now(timezone.utc).replace(tzinfo=None),
+            )
+
+
+class Pipeline:
+    """read, frame, decode and store the telegrams of several meters"""
+
+    def __init__(
+        self,
+        decoder: SmartmeterToPostgres,
+        meters: list[dict],
+        sinks: Fanout,
+        queue_size: int = 64,
+        workers: int = 0,
+        stats_interval: float = 60.0,
+        captures: dict[str, FrameCapture] = None,
+    ) -> None:
+        self.decoder = decoder  # frame counters and decryptors
+        self.meters = meters  # see Gateway.meter_configs
+        self.sinks = sinks  # started by the caller
+        self.queue_size = queue_size
+        self.workers = workers  # decoder processes, 0: decode in the event loop
+        self.stats_interval = stats_interval
+        self.captures = captures or {}  # raw capture by meter id
+        self.loop = None
+        self.pool = None
+        self.framers = {meter["meterId"]: MbusFramer() for meter in meters}
+        self.tasks = []
+
+    def start(self) -> None:
+        """create the queues and stage tasks, call from within the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.chunks = asyncio.Queue(self.queue_size)
+        self.telegrams = asyncio.Queue(self.queue_size)
+        # telegrams being decoded by the workers, in the order they were sent
+        self.decoding = asyncio.Queue(max(1, 2 * self.workers))
+        self.readings = asyncio.Queue(self.queue_size)
+        self.stages = {
+            "read": StageStats("read", self.chunks),
+            "frame": StageStats("frame", self.telegrams),
+            "decode": StageStats("decode", self.readings),
+            "store": StageStats("store"),
+        }
+        decoders = [self.decode]
+        if self.workers:
+            self.pool = ProcessPoolExecutor(
+                self.workers, initializer=init_worker, initargs=(self.decoder.config,)
+            )
+            decoders = [self.dispatch, self.collect]
+        self.tasks = [
+            asyncio.create_task(self.frame()),
+            *(asyncio.create_task(decoder()) for decoder in decoders),
+            asyncio.create_task(self.store()),
+        ]
+        self.register_metrics()
+
+    def register_metrics(self) -> None:
+        """export the counters of the stages, framers, sinks and frame counters"""
+        stages = self.stages
+        METRICS.callback(
+            "smartmeter_queue_depth",
+            "entries waiting in front of the next stage",
+            lambda: {(n,): s.queue.qsize() for n, s in stages.items() if s.queue},
+            labels=("stage",),
+        )
+        for counter in ("processed", "dropped"):
+            METRICS.callback(
+                f"smartmeter_pipeline_{counter}_total",
+                f"entries {counter} by the stage",
+                lambda counter=counter: {
+                    (name,): getattr(stage, counter) for name, stage in stages.items()
+                },
+                kind="counter",
+                labels=("stage",),
+            )
+        framers = self.framers
+        for counter, help in FRAMER_COUNTERS.items():
+            METRICS.callback(
+                f"smartmeter_mbus_{counter}_total",
+                help,
+                lambda counter=counter: {
+                    (meter,): getattr(framer, counter)
+                    for meter, framer in framers.items()
+                },
+                kind="counter",
+                labels=("meter",),
+            )
+        sinks = self.sinks
+        METRICS.callback(
+            "smartmeter_sink_rows_total",
+            "readings written, dropped (buffer full) or failed by the sink",
+            lambda: {
+                (name, result): stats[result]
+                for name, stats in sinks.stats().items()
+                for result in ("written", "dropped", "failed")
+            },
+            kind="counter",
+            labels=("sink", "result"),
+        )
+        METRICS.callback(
+            "smartmeter_sink_depth",
+            "readings buffered by the sink",
+            lambda: {(name,): stats["depth"] for name, stats in sinks.stats().items()},
+            labels=("sink",),
+        )
+        decoder = self.decoder
+        METRICS.callback(
+            "smartmeter_telegrams_lost_total",
+            "telegrams missing between two frame counters",
+            lambda: decoder.frame_counters.lost if decoder.frame_counters else 0,
+            kind="counter",
+        )
+
+    def deliver(self, meter: dict, data: bytes, received: float, time) -> None:
+        """hand received bytes to the event loop, called by the reader threads"""
+        self.loop.call_soon_threadsafe(self.receive, meter, data, received, time)
+
+    def receive(self, meter: dict, data: bytes, received: float, time) -> None:
+        try:
+            self.chunks.put_nowait((meter, data, received, time))
+            self.stages["read"].record(received)
+        except asyncio.QueueFull:
+            # the reader must not wait, the framer resynchronizes on the next telegram
+            self.stages["read"].dropped += 1
+
+    async def frame(self) -> None:
+        while True:
+            meter, data, received, time = await self.chunks.get()
+            for telegram in self.framers[meter["meterId"]].feed(data):
+                await self.telegrams.put((meter, telegram, received, time))
+                self.stages["frame"].record(received)
+            self.chunks.task_done()
+
+    def frame_counter(self, telegram: bytes) -> tuple[bytes, int]:
+        secured = crypto.parse_telegram(telegram)
+        return bytes(secured.system_title), int.from_bytes(secured.frame_counter, "big")
+
+    def reserve(self, telegram: bytes) -> bool:
+        """drop duplicate telegrams before they are sent to a worker process
+
+        The frame counter of a new telegram is taken right away, a copy
+        received while the first one is still decoded is dropped as well. A
+        telegram the worker fails on is not decoded again.
+        """
+        frame_counters = self.decoder.frame_counters
+        if frame_counters is None:
+            return True
+        system_title, frame_counter = self.frame_counter(telegram)
+        if not frame_counters.is_new(system_title, frame_counter):
+            return False
+        frame_counters.update(system_title, frame_counter)
+        return True
+
+    async def decode(self) -> None:
+        while True:
+            meter, telegram, received, time = await self.telegrams.get()
+            try:
+                result = decode_telegram(
+                    self.decoder,
+                    meter["decryptor"],
+                    telegram,
+                    time,
+                    meter["meterId"],
+                )
+                if result is not None:
+                    await self.readings.put((meter, result, received))
+                    self.stages["decode"].record(received)
+            except Exception as err:
+                logging.exception(f"meter {meter['meterId']}: {err}")
+            finally:
+                self.telegrams.task_done()
+
+    async def dispatch(self) -> None:
+        """send new telegrams to the workers, at most 2 per worker are in flight"""
+        while True:
+            meter, telegram, received, time = await self.telegrams.get()
+            try:
+                if self.reserve(telegram):
+                    result = self.loop.run_in_executor(
+                        self.pool,
+                        decode_in_worker,
+                        meter["key"],
+                        meter["authenticationKey"],
+                        telegram,
+                        time,
+                        meter["meterId"],
+                    )
+                    await self.decoding.put((meter, result, received))
+            except Exception as err:
+                logging.exception(f"meter {meter['meterId']}: {err}")
+            finally:
+                self.telegrams.task_done()
+
+    async def collect(self) -> None:
+        """hand on the readings of the workers in the order the telegrams were sent"""
+        while True:
+            meter, result, received = await self.decoding.get()
+            try:
+                reading = await result
+                if reading is not None:
+                    await self.readings.put((meter, reading, received))
+                    self.stages["decode"].record(received)
+            except Exception as err:
+                logging.exception(f"meter {meter['meterId']}: {err}")
+            finally:
+                self.decoding.task_done()
+
+    async def store(self) -> None:
+        while True:
+            meter, reading, received = await self.readings.get()
+            # the live file first, local consumers see the reading right away
+            self.decoder.publish(reading)
+            # the sinks never block, a full sink drops the reading
+            self.sinks.put(reading)
+            self.stages["store"].record(received)
+            self.readings.task_done()
+
+    async def drain(self) -> None:
+        """wait until everything received so far went through all stages"""
+        await self.chunks.join()
+        await self.telegrams.join()
+        await self.decoding.join()
+        await self.readings.join()
+
+    def stats(self) -> dict:
+        """queue depth, throughput and latency of every stage and the sinks"""
+        stats = {name: stage.snapshot() for name, stage in self.stages.items()}
+        stats["sinks"] = self.sinks.stats()
+        return stats
+
+    async def report(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logging.info(f"pipeline stats: {self.stats()}")
+            logging.info(f"metrics: {METRICS.summary()}")
+
+    async def main(self) -> None:
+        self.start()
+        for meter in self.meters:
+            SerialReader(
+                meter, self.deliver, self.captures.get(meter["meterId"])
+            ).start()
+        logging.info(f"Pipeline started for {len(self.meters)} meters")
+        await asyncio.gather(self.report(), *self.tasks)
+
+    def run(self) -> None:
+        asyncio.run(self.main())
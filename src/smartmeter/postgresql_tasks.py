@@ -1,50 +1,82 @@
 #!/usr/bin/python
 
+from datetime import datetime
+
 import psycopg2
 from src.smartmeter.config import Configuration
+from src.smartmeter.export import ReadingReader
+from src.smartmeter.metrics import METRICS
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.postgresql_writer import PostgresWriter
+from src.smartmeter.schema import SchemaManager
+
+TASK_ERRORS = METRICS.counter(
+    "smartmeter_db_task_errors_total", "failed schema tasks and single inserts"
+)
 
 
 class PostgresTasks:
-    config = Configuration()
+    def __init__(self, config: Configuration = None) -> None:
+        self.config = config or Configuration()  # parsed once, shared with the caller
+        self.obis_registry = None  # see registry()
 
-    def create_table_smartmeter(self) -> None:
-        """create table smartmeter in the PostgreSQL database (specified in config.py)"""
-        command = """
-            CREATE TABLE smartmeter (
-            data_id SERIAL PRIMARY KEY,
-            time TIMESTAMP NOT NULL,
-            wirkenergie_p FLOAT4,
-            wirkenergie_n FLOAT4,
-            momentanleistung_p FLOAT4,
-            momentanleistung_n FLOAT4,
-            spannung_l1 FLOAT4,
-            spannung_l2 FLOAT4,
-            spannung_l3 FLOAT4,
-            strom_l1 FLOAT4,
-            strom_l2 FLOAT4,
-            strom_l3 FLOAT4,
-            leistungsfaktor FLOAT4
-        )
-        """
+    def registry(self) -> ObisRegistry:
+        """the OBIS registry of main_config.yaml, loaded once"""
+        if self.obis_registry is None:
+            self.obis_registry = ObisRegistry.from_config(self.config.yaml_config())
+        return self.obis_registry
+
+    def create_table_smartmeter(self, registry: ObisRegistry = None) -> None:
+        """create table smartmeter (monthly partitions) and its rollup tables in the PostgreSQL database (specified in config.py)"""
+        self.schema_task(SchemaManager(registry or self.registry()).create)
+
+    def migrate_table_smartmeter(self, registry: ObisRegistry = None) -> None:
+        """bring an existing smartmeter table to the partitioned schema, create it if it is missing"""
+        self.schema_task(SchemaManager(registry or self.registry()).migrate)
+
+    def schema_task(self, task) -> None:
+        """run a SchemaManager method in its own transaction"""
         conn = None
         try:
             # read the connection parameters
-            params = PostgresTasks.config.postgresql_config()
+            params = self.config.postgresql_config()
             # connect to the PostgreSQL server
             conn = psycopg2.connect(**params)
             cur = conn.cursor()
-            # create table one by one
-            cur.execute(command)
+            task(cur)
             # close communication with the PostgreSQL database server
             cur.close()
             # commit the changes
             conn.commit()
         except (Exception, psycopg2.DatabaseError) as error:
+            TASK_ERRORS.inc()
             print(error)
         finally:
             if conn is not None:
                 conn.close()
 
+    def writer(
+        self,
+        batch_size: int = 10,
+        max_age: float = 60.0,
+        registry: ObisRegistry = None,
+    ) -> PostgresWriter:
+        """create a batched writer with a persistent connection to the smartmeter table"""
+        registry = registry or self.registry()
+        return PostgresWriter(
+            self.config.postgresql_config(),
+            batch_size=batch_size,
+            max_age=max_age,
+            schema=SchemaManager(registry),
+            registry=registry,
+        )
+
+    def reader(self, registry: ObisRegistry = None) -> ReadingReader:
+        """create a reader which streams stored readings, see export.py"""
+        return ReadingReader(
+            self.config.postgresql_config(), registry or self.registry()
+        )
+
     def insert_smartmeter(
         self,
         WirkenergieP,
@@ -58,15 +90,17 @@ class PostgresTasks:
         StromL2,
         StromL3,
         Leistungsfaktor,
+        time: datetime = None,
     ) -> int:
-        """insert a new data row into the smartmeter table"""
-        sql = """INSERT INTO smartmeter(time, wirkenergie_p, wirkenergie_n, momentanleistung_p, momentanleistung_n, spannung_l1, spannung_l2, spannung_l3, strom_l1, strom_l2, strom_l3, leistungsfaktor)
-            VALUES((NOW() AT TIME ZONE 'UTC'), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING data_id;"""
+        """insert a new data row into the smartmeter table, time (UTC) defaults to now"""
+        columns = DEFAULT_REGISTRY.columns
+        sql = f"""INSERT INTO smartmeter(time, {', '.join(columns)})
+            VALUES(COALESCE(%s, NOW() AT TIME ZONE 'UTC'), {', '.join(['%s'] * len(columns))}) RETURNING data_id;"""
         conn = None
         data_id = None
         try:
             # read database configuration
-            params = PostgresTasks.config.postgresql_config()
+            params = self.config.postgresql_config()
             # connect to the PostgreSQL database
             conn = psycopg2.connect(**params)
             # create a new cursor
@@ -75,6 +109,7 @@ class PostgresTasks:
             cur.execute(
                 sql,
                 (
+                    time,
                     WirkenergieP,
                     WirkenergieN,
                     MomentanleistungP,
@@ -95,6 +130,7 @@ class PostgresTasks:
             # close communication with the database
             cur.close()
         except (Exception, psycopg2.DatabaseError) as error:
+            TASK_ERRORS.inc()
             print(error)
         finally:
             if conn is not None:
@@ -105,7 +141,7 @@ class PostgresTasks:
 
 # to test a specific function via "python postgresql_tasks.py" in the powershell
 if __name__ == "__main__":
-    postgres_task = PostgresTasks()
-    postgres_task.create_table_smartmeter()
+    postgres_task = PostgresTasks(Configuration())
+    postgres_task.migrate_table_smartmeter()
 #   postgres_task.insert_smartmeter(1234.1339491293948, 45.2, 0.023, 2.39, 230,
 #                   240.3, 222.23, 50, 51.4, 49.3, 0.56)
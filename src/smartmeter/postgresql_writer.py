@@ -0,0 +1,295 @@
+import io
+import logging
+from time import monotonic, perf_counter
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from src.smartmeter.aggregate import upsert_window_sql
+from src.smartmeter.metrics import METRICS
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+
+DB_SECONDS = METRICS.histogram(
+    "smartmeter_db_write_seconds",
+    "duration of a batch written to postgreSQL",
+    ("method",),
+)
+DB_ROWS = METRICS.counter(
+    "smartmeter_db_rows_total", "rows sent to postgreSQL", ("method",)
+)
+DB_CONNECTS = METRICS.counter(
+    "smartmeter_db_connects_total", "connections opened to postgreSQL"
+)
+DB_ERRORS = METRICS.counter("smartmeter_db_errors_total", "failed batches", ("method",))
+DB_REJECTED = METRICS.counter(
+    "smartmeter_db_rejected_rows_total", "rows dropped, rejected by postgreSQL"
+)
+
+# the server can not be reached, rows are kept until it is back
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# characters with a meaning in the text format of COPY
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+# SQL types of time, meter_id and frame_counter, see obis.ROW_PREFIX
+PREFIX_TYPES = ("TIMESTAMP", "VARCHAR(32)", "BIGINT")
+# a telegram stored before, the unique index covers it only with the same time
+# (useMeterTime: False stamps a telegram received twice with two times)
+NOT_STORED = """NOT EXISTS (SELECT 1 FROM smartmeter s
+    WHERE s.meter_id = v.meter_id AND s.frame_counter = v.frame_counter
+    AND s.time BETWEEN v.time - INTERVAL '1 day' AND v.time + INTERVAL '1 day')"""
+
+
+class PostgresWriter:
+    """long-lived writer which buffers smartmeter rows and inserts them in batches
+
+    The connection is kept open between flushes and reopened transparently if
+    the server went away. Rows are flushed once batch_size rows are buffered or
+    the oldest buffered row is older than max_age seconds.
+    """
+
+    columns = DEFAULT_REGISTRY.row_columns
+
+    def __init__(
+        self,
+        params: dict,
+        batch_size: int = 10,
+        max_age: float = 60.0,
+        max_buffer: int = 10000,
+        schema=None,
+        registry: ObisRegistry = None,
+    ) -> None:
+        if registry is not None:
+            self.columns = registry.row_columns  # ordered as the rows
+        fields = (registry or DEFAULT_REGISTRY).fields
+        types = PREFIX_TYPES + tuple(field.sql_type for field in fields)
+        self.window_sql = upsert_window_sql(registry or DEFAULT_REGISTRY)
+        self.params = params  # connection parameters (database.ini)
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_buffer = max_buffer  # rows kept while the database is unreachable
+        self.schema = schema  # SchemaManager: partitions and rollups, optional
+        self.conn = None
+        self.rows: list[tuple] = []
+        self.first_row_at = None  # monotonic time of the oldest buffered row
+        columns = ", ".join(self.columns)
+        # telegrams already stored (same meter and frame counter) are skipped
+        self.sql = (
+            f"INSERT INTO smartmeter({columns}) SELECT {columns} FROM (VALUES %s)"
+            f" AS v({columns}) WHERE {NOT_STORED} ON CONFLICT DO NOTHING RETURNING data_id"
+        )
+        # the values are typed, a column which is NULL in every row is no text
+        self.template = f"({', '.join(f'%s::{sql_type}' for sql_type in types)})"
+        self.copy_sql = f"COPY smartmeter_load ({columns}) FROM STDIN"
+        self.load_sql = (
+            f"INSERT INTO smartmeter({columns}) SELECT {columns} FROM smartmeter_load v"
+            f" WHERE {NOT_STORED} ON CONFLICT DO NOTHING"
+        )
+
+    def connect(self) -> None:
+        """open the connection if there is none"""
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.params)
+            DB_CONNECTS.inc()
+            logging.info(f"connected to postgresQL {self.params.get('host')}")
+
+    def close(self) -> None:
+        """flush remaining rows and close the connection"""
+        try:
+            if self.rows:
+                self.flush()
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def due(self) -> bool:
+        """True if the buffered rows should be flushed"""
+        if not self.rows:
+            return False
+        return (
+            len(self.rows) >= self.batch_size
+            or monotonic() - self.first_row_at >= self.max_age
+        )
+
+    def add(self, row: tuple) -> list[int]:
+        """buffer a row (ordered as columns) and return the data_ids of a flush, if any"""
+        if not self.rows:
+            self.first_row_at = monotonic()
+        self.rows.append(row)
+        if len(self.rows) > self.max_buffer:
+            del self.rows[0]
+            logging.warning(f"write buffer full, dropped oldest row")
+        if self.due():
+            return self.flush()
+        return []
+
+    def flush(self) -> list[int]:
+        """insert all buffered rows in one statement and return their data_ids
+
+        A broken connection is reopened once. If the insert still fails the
+        rows stay buffered and the error is raised. A batch rejected for its
+        data (e.g. a value out of range) is inserted row by row, the rejected
+        rows are logged and dropped.
+        """
+        if not self.rows:
+            return []
+        try:
+            try:
+                data_ids = self._insert(self.rows)
+            except CONNECTION_ERRORS as error:
+                logging.warning(f"postgresQL connection lost ({error}), reconnecting")
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                data_ids = self._insert(self.rows)
+        except CONNECTION_ERRORS:
+            raise
+        except psycopg2.Error as error:
+            logging.warning(
+                f"batch rejected by postgresQL ({error}), inserting row by row"
+            )
+            data_ids = self.insert_each(self.rows)
+        self.rows = []
+        self.first_row_at = None
+        return data_ids
+
+    def insert_each(self, rows: list[tuple]) -> list[int]:
+        """insert the rows one at a time, dropping the ones postgresQL rejects"""
+        data_ids = []
+        for i, row in enumerate(rows):
+            try:
+                data_ids += self._insert([row])
+            except CONNECTION_ERRORS:
+                self.rows = rows[i:]  # kept for the next flush
+                raise
+            except psycopg2.Error as error:
+                DB_REJECTED.inc()
+                logging.error(f"row dropped, rejected by postgresQL ({error}): {row}")
+        return data_ids
+
+    def copy(self, rows: list[tuple]) -> int:
+        """bulk-load rows (ordered as columns) and return the number of new rows
+
+        Meant for backfills, the rows are not buffered and no data_ids are
+        returned. The rows are copied into a temporary table first, COPY can
+        not skip telegrams which are already stored.
+        """
+        lines = []
+        for row in rows:
+            lines.append(
+                "\t".join(
+                    "\\N" if value is None else str(value).translate(COPY_ESCAPES)
+                    for value in row
+                )
+            )
+        data = io.StringIO("\n".join(lines) + "\n")
+        started = perf_counter()
+        self.connect()
+        try:
+            with self.conn.cursor() as cur:
+                self.prepare(cur, rows)
+                cur.execute(
+                    f"CREATE TEMPORARY TABLE IF NOT EXISTS smartmeter_load ON COMMIT DELETE ROWS AS SELECT {', '.join(self.columns)} FROM smartmeter WITH NO DATA"
+                )
+                cur.copy_expert(self.copy_sql, data)
+                cur.execute(self.load_sql)
+                count = cur.rowcount
+            self.conn.commit()
+        except psycopg2.Error:
+            DB_ERRORS.inc("copy")
+            self.rollback()
+            raise
+        DB_SECONDS.observe(perf_counter() - started, "copy")
+        DB_ROWS.inc("copy", amount=len(rows))
+        self.touch(rows)
+        self.maintain()
+        return count
+
+    def write_windows(self, rows: list[tuple]) -> None:
+        """upsert rows of WindowAggregator into smartmeter_window, not buffered"""
+        self.execute(self.window_sql, rows, "window")
+
+    def execute(self, sql: str, rows: list[tuple], method: str) -> None:
+        """run an INSERT ... VALUES %s with rows right away, reconnecting once"""
+        try:
+            self._execute(sql, rows, method)
+        except CONNECTION_ERRORS as error:
+            logging.warning(f"postgresQL connection lost ({error}), reconnecting")
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            self._execute(sql, rows, method)
+
+    def _execute(self, sql: str, rows: list[tuple], method: str) -> None:
+        started = perf_counter()
+        self.connect()
+        try:
+            with self.conn.cursor() as cur:
+                execute_values(cur, sql, rows, page_size=len(rows))
+            self.conn.commit()
+        except psycopg2.Error:
+            DB_ERRORS.inc(method)
+            self.rollback()
+            raise
+        DB_SECONDS.observe(perf_counter() - started, method)
+        DB_ROWS.inc(method, amount=len(rows))
+
+    def _insert(self, rows: list[tuple]) -> list[int]:
+        started = perf_counter()
+        self.connect()
+        try:
+            with self.conn.cursor() as cur:
+                self.prepare(cur, rows)
+                result = execute_values(
+                    cur,
+                    self.sql,
+                    rows,
+                    template=self.template,
+                    page_size=len(rows),
+                    fetch=True,
+                )
+            self.conn.commit()
+        except psycopg2.Error:
+            DB_ERRORS.inc("insert")
+            self.rollback()
+            raise
+        DB_SECONDS.observe(perf_counter() - started, "insert")
+        DB_ROWS.inc("insert", amount=len(rows))
+        self.touch(rows)
+        self.maintain()
+        return [data_id for (data_id,) in result]
+
+    def prepare(self, cur, rows: list[tuple]) -> None:
+        """create the partitions the rows are stored in"""
+        if self.schema is not None:
+            self.schema.ensure_partitions_for(cur, (row[0] for row in rows))
+
+    def touch(self, rows: list[tuple]) -> None:
+        """let the next rollup refresh start at the oldest row stored"""
+        if self.schema is not None and rows:
+            self.schema.touch(min(row[0] for row in rows))
+
+    def maintain(self) -> None:
+        """create upcoming partitions and refresh the rollups from time to time"""
+        if self.schema is None or not self.schema.maintenance_due():
+            return
+        touched_since = self.schema.touched_since
+        try:
+            with self.conn.cursor() as cur:
+                self.schema.maintain(cur)
+            self.conn.commit()
+        except psycopg2.Error as error:
+            logging.warning(f"schema maintenance failed: {error}")
+            self.rollback()
+            # refreshed in the next maintenance
+            if touched_since is not None:
+                self.schema.touch(touched_since)
+
+    def rollback(self) -> None:
+        """roll back a failed transaction, partitions created in it are gone as well"""
+        if self.schema is not None:
+            self.schema.partitions.clear()
+        if not self.conn.closed:
+            try:
+                self.conn.rollback()
+            except psycopg2.Error:
+                self.conn.close()
@@ -0,0 +1,146 @@
+"""decoded readings and column-wise batches of them
+
+A Reading is immutable and can be handed to other threads and processes.
+A ReadingBatch keeps many readings in one array per column (8 bytes per
+value instead of a Python object per value), the sinks buffer and ship
+readings in these batches.
+"""
+
+import math
+from array import array
+from datetime import datetime, timedelta
+from typing import Iterator
+
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+NONE = -(1 << 63)  # int64 column value of None
+
+
+def to_micros(time: datetime) -> int:
+    return NONE if time is None else (time - EPOCH) // MICROSECOND
+
+
+def from_micros(micros: int) -> datetime:
+    return None if micros == NONE else EPOCH + micros * MICROSECOND
+
+
+class Reading:
+    """the values of one telegram, ordered as the fields of the OBIS registry"""
+
+    __slots__ = ("time", "meter_id", "frame_counter", "values", "device_time")
+
+    def __init__(
+        self,
+        time: datetime,
+        meter_id: str,
+        frame_counter: int,
+        values: tuple,
+        device_time: datetime = None,
+    ) -> None:
+        set_slot = object.__setattr__
+        # UTC, the clock of the meter or the time of reception, see useMeterTime
+        set_slot(self, "time", time)
+        set_slot(self, "meter_id", meter_id)
+        set_slot(self, "frame_counter", frame_counter)
+        set_slot(self, "values", tuple(values))
+        set_slot(self, "device_time", device_time)  # date-time sent by the meter, UTC
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Reading is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Reading is immutable")
+
+    def __reduce__(self):
+        return (
+            Reading,
+            (
+                self.time,
+                self.meter_id,
+                self.frame_counter,
+                self.values,
+                self.device_time,
+            ),
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Reading):
+            return NotImplemented
+        return self.row() == other.row() and self.device_time == other.device_time
+
+    def __repr__(self) -> str:
+        return f"Reading{self.row()!r}"
+
+    def row(self) -> tuple:
+        """the reading as row of the smartmeter table"""
+        return (self.time, self.meter_id, self.frame_counter, *self.values)
+
+
+class ReadingBatch:
+    """readings stored column-wise, integer columns as int64, the others as double"""
+
+    def __init__(self, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        self.registry = registry
+        self.integers = tuple(field.integer for field in registry.fields)
+        self.meter_ids: list[str] = []  # distinct meter ids
+        self.meters = array("H")  # index into meter_ids
+        self.times = array("q")  # µs since epoch
+        self.device_times = array("q")
+        self.frame_counters = array("q")
+        self.columns = [array("q" if integer else "d") for integer in self.integers]
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def append(self, reading: Reading) -> None:
+        try:
+            meter = self.meter_ids.index(reading.meter_id)
+        except ValueError:
+            meter = len(self.meter_ids)
+            self.meter_ids.append(reading.meter_id)
+        self.meters.append(meter)
+        self.times.append(to_micros(reading.time))
+        self.device_times.append(to_micros(reading.device_time))
+        frame_counter = reading.frame_counter
+        self.frame_counters.append(NONE if frame_counter is None else frame_counter)
+        for column, integer, value in zip(self.columns, self.integers, reading.values):
+            if value is None:
+                value = NONE if integer else math.nan
+            column.append(value)
+
+    def extend(self, readings) -> None:
+        for reading in readings:
+            self.append(reading)
+
+    def values(self, i: int) -> tuple:
+        """the values of the i-th reading"""
+        values = []
+        for integer, column in zip(self.integers, self.columns):
+            value = column[i]
+            if (value == NONE) if integer else math.isnan(value):
+                value = None
+            values.append(value)
+        return tuple(values)
+
+    def readings(self) -> Iterator[Reading]:
+        for i in range(len(self)):
+            frame_counter = self.frame_counters[i]
+            yield Reading(
+                from_micros(self.times[i]),
+                self.meter_ids[self.meters[i]],
+                None if frame_counter == NONE else frame_counter,
+                self.values(i),
+                from_micros(self.device_times[i]),
+            )
+
+    def rows(self) -> Iterator[tuple]:
+        """the readings as rows of the smartmeter table"""
+        for reading in self.readings():
+            yield reading.row()
+
+    def nbytes(self) -> int:
+        """memory of the column arrays"""
+        arrays = [self.meters, self.times, self.device_times, self.frame_counters]
+        return sum(len(a) * a.itemsize for a in arrays + self.columns)
@@ -0,0 +1,149 @@
+"""replay recorded telegrams and bulk-load them into the smartmeter table
+
+usage: python -m src.smartmeter.replay capture.bin [capture.hex.gz ...]
+
+Capture files are raw serial dumps or text files with hex encoded bytes
+(whitespace and line breaks are ignored), both optionally gzip compressed.
+The telegrams are decoded in a process pool (DecodeEngine) and loaded with
+COPY, the row time is taken from the date-time of each telegram.
+"""
+
+import argparse
+import gzip
+import logging
+import os
+import string
+from typing import Iterator
+
+from src.smartmeter.config import Configuration
+from src.smartmeter.engine import DecodeEngine
+from src.smartmeter.mbus import MbusFramer
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from src.smartmeter.schema import SchemaManager
+
+CHUNK_SIZE = 1 << 16  # bytes read from a capture file at once
+HEX_CHARACTERS = set(string.hexdigits + string.whitespace)
+
+
+def open_capture(path: str):
+    """open a capture file in binary mode, gzip compressed files are detected by their magic number"""
+    with open(path, "rb") as file:
+        magic = file.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_capture(path: str, framer: MbusFramer = None) -> Iterator[bytes]:
+    """yield the telegrams of a capture file
+
+    The framer of the previous file completes a telegram which was split
+    between two files (e.g. rotated captures).
+    """
+    framer = framer or MbusFramer()
+    checksum_errors, incomplete = framer.checksum_errors, framer.incomplete
+    with open_capture(path) as file:
+        chunk = file.read(CHUNK_SIZE)
+        is_hex = all(chr(byte) in HEX_CHARACTERS for byte in chunk[:512])
+        pending = ""  # incomplete hex digit pair of the previous chunk
+        while chunk:
+            if is_hex:
+                digits = pending + "".join(chunk.decode("ascii").split())
+                pending = digits[len(digits) & ~1 :]
+                chunk = bytes.fromhex(digits[: len(digits) & ~1])
+            yield from framer.feed(chunk)
+            chunk = file.read(CHUNK_SIZE)
+    checksum_errors = framer.checksum_errors - checksum_errors
+    incomplete = framer.incomplete - incomplete
+    if checksum_errors or incomplete:
+        logging.warning(
+            f"{path}: {checksum_errors} broken frames, {incomplete} incomplete telegrams"
+        )
+
+
+def replay(
+    paths: list[str],
+    key: str,
+    meter_id: str = None,
+    workers: int = None,
+    chunk_size: int = 2000,
+    store: bool = True,
+    config: Configuration = None,
+    authentication_key: str = None,
+) -> int:
+    """decode the telegrams of capture files and load them, return the number of rows"""
+    meter_id = meter_id or ""
+    config = config or Configuration()
+    framer = MbusFramer()  # one for all files, in the order of paths
+    frames = (
+        (meter_id, telegram, None)
+        for path in paths
+        for telegram in read_capture(path, framer)
+    )
+    client = PostgresTasks(config)
+    writer = client.writer() if store else None
+    count = 0
+    first = None  # time of the oldest row, the rollups are refreshed from there
+
+    with DecodeEngine(
+        config,
+        {meter_id: key},
+        workers,
+        chunk_size,
+        authentication_keys={meter_id: authentication_key},
+    ) as engine:
+        for batch in engine.decode(frames):
+            if not batch:
+                continue
+            rows = list(batch.rows())
+            oldest = min(row[0] for row in rows)
+            first = oldest if first is None else min(first, oldest)
+            count += writer.copy(rows) if writer is not None else len(rows)
+    if writer is not None:
+        writer.close()
+        if first is not None:
+            client.schema_task(
+                lambda cur: SchemaManager().refresh_rollups(cur, since=first)
+            )
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="replay recorded smartmeter telegrams into the smartmeter table"
+    )
+    parser.add_argument("paths", nargs="+", help="capture files (binary or hex, gzip)")
+    parser.add_argument("--key", help="EVN key, default: EVN_SCHLUESSEL of .env")
+    parser.add_argument(
+        "--authentication-key",
+        help="verify the GCM tag, default: authenticationKeyEnv of main_config.yaml",
+    )
+    parser.add_argument("--meter-id", help="stored in the meter_id column")
+    parser.add_argument("--workers", type=int, help="decoder processes")
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="decode only, do not store"
+    )
+    args = parser.parse_args()
+
+    config = Configuration()
+    key = args.key or config.env_config()["evn_key"]
+    authentication_key = args.authentication_key
+    authentication_key_env = config.yaml_config().get("authenticationKeyEnv")
+    if not authentication_key and authentication_key_env:
+        authentication_key = os.getenv(authentication_key_env)
+    count = replay(
+        args.paths,
+        key,
+        meter_id=args.meter_id,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        store=not args.dry_run,
+        config=config,
+        authentication_key=authentication_key,
+    )
+    print(f"{count} rows {'decoded' if args.dry_run else 'loaded'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""threshold and anomaly rules evaluated on every reading
+
+The rules are listed under rules in main_config.yaml, values are referred
+to by the names of the OBIS registry:
+
+    rules:
+      - name: overvoltage_l1
+        field: SpannungL1
+        max: 253  # and/or min
+      - name: phase_imbalance
+        fields: [SpannungL1, SpannungL2, SpannungL3]
+        spread: 10  # max - min of the fields
+      - name: power_jump
+        field: MomentanleistungP
+        rate: 2000  # change per second
+      - name: power_anomaly
+        field: MomentanleistungP
+        zscore: 4  # deviation from the EWMA in standard deviations
+        alpha: 0.05  # weight of the newest value
+        warmup: 60  # readings before the rule is evaluated
+
+Every rule keeps constant state per meter and does constant work per
+reading. An event is emitted when a rule becomes active (raised) and when
+it is no longer active (cleared), not for every reading in between. The
+events are evaluated by the rules sink, which stores them in the table
+smartmeter_events and/or runs a hook command with the event as JSON on stdin:
+
+    sinks:
+      - type: rules
+        store: postgres
+        hook: "/usr/local/bin/smartmeter-alert"
+"""
+
+import json
+import logging
+import subprocess
+from datetime import datetime
+from math import sqrt
+from typing import NamedTuple
+
+from src.smartmeter.config import ConfigError
+from src.smartmeter.metrics import METRICS
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.reading import Reading
+
+EVENTS = METRICS.counter(
+    "smartmeter_events_total", "events of the rules", ("rule", "state")
+)
+
+CREATE_EVENTS = """
+    CREATE TABLE IF NOT EXISTS smartmeter_events (
+    event_id BIGSERIAL PRIMARY KEY,
+    time TIMESTAMP NOT NULL,
+    meter_id VARCHAR(32),
+    rule VARCHAR(64) NOT NULL,
+    state VARCHAR(8) NOT NULL,
+    value FLOAT8,
+    message TEXT
+    )
+"""
+CREATE_EVENTS_INDEX = (
+    "CREATE INDEX IF NOT EXISTS smartmeter_events_time ON smartmeter_events (time)"
+)
+INSERT_EVENTS = "INSERT INTO smartmeter_events (time, meter_id, rule, state, value, message) VALUES %s"
+
+
+class Event(NamedTuple):
+    time: datetime
+    meter_id: str
+    rule: str
+    state: str  # raised or cleared
+    value: float
+    message: str
+
+    def json(self) -> str:
+        return json.dumps(dict(self._asdict(), time=self.time.isoformat()))
+
+
+class Rule:
+    """a condition on the values of a reading, subclasses implement check
+
+    check returns the value the condition was evaluated on and whether the
+    rule is active, or None if the reading has no value to check.
+    """
+
+    def __init__(self, name: str, positions: tuple[int, ...]) -> None:
+        self.name = name
+        self.positions = positions  # indexes of the fields in the values
+
+    def new_state(self) -> list:
+        """state of the rule for one meter"""
+        return []
+
+    def check(self, values: tuple, time: datetime, state: list):
+        raise NotImplementedError
+
+    def describe(self, value: float, active: bool) -> str:
+        """message of the event, active: raised, else cleared"""
+        raise NotImplementedError
+
+
+class ThresholdRule(Rule):
+    def __init__(self, name, positions, minimum=None, maximum=None) -> None:
+        super().__init__(name, positions)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def check(self, values, time, state):
+        value = values[self.positions[0]]
+        if value is None:
+            return None
+        active = (self.minimum is not None and value < self.minimum) or (
+            self.maximum is not None and value > self.maximum
+        )
+        return value, active
+
+    def describe(self, value, active):
+        if self.maximum is not None and value > self.maximum:
+            return f"{value} above {self.maximum}"
+        if self.minimum is not None and value < self.minimum:
+            return f"{value} below {self.minimum}"
+        if self.minimum is None:
+            return f"{value} no longer above {self.maximum}"
+        if self.maximum is None:
+            return f"{value} no longer below {self.minimum}"
+        return f"{value} within {self.minimum}..{self.maximum}"
+
+
+class SpreadRule(Rule):
+    """difference between the largest and the smallest of several fields"""
+
+    def __init__(self, name, positions, limit) -> None:
+        super().__init__(name, positions)
+        self.limit = limit
+
+    def check(self, values, time, state):
+        selected = [values[i] for i in self.positions]
+        if None in selected:
+            return None
+        spread = max(selected) - min(selected)
+        return spread, spread > self.limit
+
+    def describe(self, value, active):
+        if active:
+            return f"spread {value:.2f} above {self.limit}"
+        return f"spread {value:.2f} no longer above {self.limit}"
+
+
+class RateRule(Rule):
+    """change per second between two readings of a meter"""
+
+    def __init__(self, name, positions, limit) -> None:
+        super().__init__(name, positions)
+        self.limit = limit
+
+    def new_state(self):
+        return [None, None]  # time, value of the last reading
+
+    def check(self, values, time, state):
+        value = values[self.positions[0]]
+        if value is None:
+            return None
+        last_time, last_value = state
+        state[0], state[1] = time, value
+        if last_time is None:
+            return None
+        seconds = (time - last_time).total_seconds()
+        if seconds <= 0:
+            return None
+        rate = abs(value - last_value) / seconds
+        return rate, rate > self.limit
+
+    def describe(self, value, active):
+        if active:
+            return f"change {value:.2f}/s above {self.limit}/s"
+        return f"change {value:.2f}/s no longer above {self.limit}/s"
+
+
+class ZScoreRule(Rule):
+    """deviation from the exponentially weighted moving average and variance"""
+
+    def __init__(self, name, positions, limit, alpha=0.05, warmup=60) -> None:
+        super().__init__(name, positions)
+        self.limit = limit
+        self.alpha = alpha
+        self.warmup = warmup
+
+    def new_state(self):
+        return [0, 0.0, 0.0]  # readings, mean, variance
+
+    def check(self, values, time, state):
+        value = values[self.positions[0]]
+        if value is None:
+            return None
+        count, mean, variance = state
+        deviation = value - mean
+        # against the statistics before this value
+        zscore = deviation / sqrt(variance) if variance > 0 else None
+        if count == 0:
+            mean = value
+        else:
+            increment = self.alpha * deviation
+            mean += increment
+            variance = (1 - self.alpha) * (variance + deviation * increment)
+        state[0], state[1], state[2] = count + 1, mean, variance
+        if count < self.warmup or zscore is None:
+            return None
+        return zscore, abs(zscore) > self.limit
+
+    def describe(self, value, active):
+        if active:
+            return f"z-score {value:.2f} beyond {self.limit}"
+        return f"z-score {value:.2f} no longer beyond {self.limit}"
+
+
+def rules_from_config(
+    config_yaml: dict, registry: ObisRegistry = DEFAULT_REGISTRY
+) -> list[Rule]:
+    """the rules of main_config.yaml"""
+    rules = []
+    for entry in config_yaml.get("rules") or []:
+        name = entry["name"]
+        fields = entry.get("fields") or [entry.get("field")]
+        if any(field not in registry.names for field in fields):
+            raise ConfigError(f"rule {name}: unknown field in {fields}")
+        positions = tuple(registry.names.index(field) for field in fields)
+        if "spread" in entry:
+            rules.append(SpreadRule(name, positions, entry["spread"]))
+        elif "rate" in entry:
+            rules.append(RateRule(name, positions, entry["rate"]))
+        elif "zscore" in entry:
+            rules.append(
+                ZScoreRule(
+                    name,
+                    positions,
+                    entry["zscore"],
+                    entry.get("alpha", 0.05),
+                    entry.get("warmup", 60),
+                )
+            )
+        elif "min" in entry or "max" in entry:
+            rules.append(
+                ThresholdRule(name, positions, entry.get("min"), entry.get("max"))
+            )
+        else:
+            raise ConfigError(f"rule {name} needs min, max, spread, rate or zscore")
+    return rules
+
+
+class RuleEngine:
+    """evaluate the rules on every reading, keeping the state per meter"""
+
+    def __init__(self, rules: list[Rule]) -> None:
+        self.rules = rules
+        self.states: dict[str, list] = {}  # meter id -> state of every rule
+        self.active: dict[str, list[bool]] = {}
+
+    def evaluate(self, reading: Reading) -> list[Event]:
+        """the events of the rules which were raised or cleared by the reading"""
+        meter_id = reading.meter_id
+        states = self.states.get(meter_id)
+        if states is None:
+            states = self.states[meter_id] = [rule.new_state() for rule in self.rules]
+            self.active[meter_id] = [False] * len(self.rules)
+        active = self.active[meter_id]
+        events = []
+        for i, rule in enumerate(self.rules):
+            result = rule.check(reading.values, reading.time, states[i])
+            if result is None or result[1] == active[i]:
+                continue
+            value, active[i] = result
+            state = "raised" if active[i] else "cleared"
+            EVENTS.inc(rule.name, state)
+            events.append(
+                Event(
+                    reading.time,
+                    meter_id,
+                    rule.name,
+                    state,
+                    value,
+                    rule.describe(value, active[i]),
+                )
+            )
+        return events
+
+
+def run_hook(command: str, event: Event, timeout: float = 10.0) -> None:
+    """run the hook command with the event as JSON on stdin"""
+    try:
+        subprocess.run(
+            command,
+            shell=True,
+            input=event.json(),
+            text=True,
+            timeout=timeout,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as err:
+        logging.warning(f"event hook {command} failed: {err}")
@@ -0,0 +1,375 @@
+"""time-series schema of the smartmeter table
+
+The smartmeter table is partitioned by month on time, every partition gets
+the BRIN index on time (cheap for append-only data) and the unique index
+which drops duplicate telegrams. Rollup tables with 1 minute, 15 minute and
+1 hour buckets are refreshed incrementally from the raw rows. The sinks
+with windows upsert their aggregates into smartmeter_window (aggregate.py),
+the rules sink stores its events in smartmeter_events (rules.py).
+
+usage: python -m src.smartmeter.schema [create|migrate|refresh|maintain]
+"""
+
+import argparse
+import logging
+from datetime import date, datetime, timedelta
+from time import monotonic
+
+import psycopg2
+
+from src.smartmeter.aggregate import create_window_sql, field_columns
+from src.smartmeter.config import Configuration
+from src.smartmeter.obis import DEFAULT_FIELDS, DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.rules import CREATE_EVENTS, CREATE_EVENTS_INDEX
+
+# rollup table -> bucket length in seconds
+ROLLUPS = {
+    "smartmeter_1min": 60,
+    "smartmeter_15min": 900,
+    "smartmeter_1h": 3600,
+}
+
+FUTURE_PARTITIONS = 2  # months created ahead of the current month
+LATE_ROWS = timedelta(minutes=15)  # recomputed before the last rollup refresh
+EPOCH = datetime(1970, 1, 1)
+
+CREATE_SMARTMETER = """
+    CREATE TABLE smartmeter (
+    data_id BIGSERIAL,
+    time TIMESTAMP NOT NULL,
+    meter_id VARCHAR(32) NOT NULL DEFAULT '',
+    frame_counter BIGINT,
+    {columns},
+    PRIMARY KEY (data_id, time)
+    ) PARTITION BY RANGE (time)
+"""
+
+CREATE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS smartmeter_time_brin ON smartmeter USING BRIN (time)",
+    # a telegram is stored only once, inserts use ON CONFLICT DO NOTHING; rows of
+    # the same telegram with another time (useMeterTime: False) are skipped by
+    # PostgresWriter
+    """CREATE UNIQUE INDEX IF NOT EXISTS smartmeter_meter_frame_counter
+    ON smartmeter (meter_id, frame_counter, time)""",
+)
+
+CREATE_ROLLUP = """
+    CREATE TABLE IF NOT EXISTS {table} (
+    bucket TIMESTAMP NOT NULL,
+    meter_id VARCHAR(32) NOT NULL,
+    samples INTEGER NOT NULL,
+    wirkenergie_p BIGINT,
+    wirkenergie_n BIGINT,
+    momentanleistung_p FLOAT4,
+    momentanleistung_p_max FLOAT4,
+    momentanleistung_n FLOAT4,
+    momentanleistung_n_max FLOAT4,
+    spannung_l1 FLOAT4,
+    spannung_l2 FLOAT4,
+    spannung_l3 FLOAT4,
+    strom_l1 FLOAT4,
+    strom_l2 FLOAT4,
+    strom_l3 FLOAT4,
+    leistungsfaktor FLOAT4,
+    PRIMARY KEY (meter_id, bucket)
+    )
+"""
+
+CREATE_ROLLUP_STATE = """
+    CREATE TABLE IF NOT EXISTS smartmeter_rollup_state (
+    rollup VARCHAR(32) PRIMARY KEY,
+    refreshed_until TIMESTAMP NOT NULL
+    )
+"""
+
+# recompute the buckets of [start, end) and upsert them
+REFRESH_ROLLUP = """
+    INSERT INTO {table}
+    SELECT to_timestamp(floor(extract(epoch FROM time) / {seconds}) * {seconds})
+        AT TIME ZONE 'UTC' AS bucket,
+        meter_id,
+        count(*),
+        max(wirkenergie_p),
+        max(wirkenergie_n),
+        avg(momentanleistung_p),
+        max(momentanleistung_p),
+        avg(momentanleistung_n),
+        max(momentanleistung_n),
+        avg(spannung_l1),
+        avg(spannung_l2),
+        avg(spannung_l3),
+        avg(strom_l1),
+        avg(strom_l2),
+        avg(strom_l3),
+        avg(leistungsfaktor)
+    FROM smartmeter
+    WHERE time >= %(start)s AND time < %(end)s
+    GROUP BY 1, 2
+    ON CONFLICT (meter_id, bucket) DO UPDATE SET
+        samples = excluded.samples,
+        wirkenergie_p = excluded.wirkenergie_p,
+        wirkenergie_n = excluded.wirkenergie_n,
+        momentanleistung_p = excluded.momentanleistung_p,
+        momentanleistung_p_max = excluded.momentanleistung_p_max,
+        momentanleistung_n = excluded.momentanleistung_n,
+        momentanleistung_n_max = excluded.momentanleistung_n_max,
+        spannung_l1 = excluded.spannung_l1,
+        spannung_l2 = excluded.spannung_l2,
+        spannung_l3 = excluded.spannung_l3,
+        strom_l1 = excluded.strom_l1,
+        strom_l2 = excluded.strom_l2,
+        strom_l3 = excluded.strom_l3,
+        leistungsfaktor = excluded.leistungsfaktor
+"""
+
+# copy a former (not partitioned) smartmeter table into the partitioned one
+COPY_LEGACY = """
+    INSERT INTO smartmeter (data_id, time, meter_id, frame_counter, wirkenergie_p,
+        wirkenergie_n, momentanleistung_p, momentanleistung_n, spannung_l1,
+        spannung_l2, spannung_l3, strom_l1, strom_l2, strom_l3, leistungsfaktor)
+    SELECT data_id, time, COALESCE(meter_id, ''), frame_counter,
+        round(wirkenergie_p)::BIGINT, round(wirkenergie_n)::BIGINT,
+        momentanleistung_p, momentanleistung_n, spannung_l1, spannung_l2,
+        spannung_l3, strom_l1, strom_l2, strom_l3, leistungsfaktor
+    FROM smartmeter_legacy
+    ON CONFLICT DO NOTHING
+"""
+
+
+def month_start(time: date) -> date:
+    return date(time.year, time.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+class SchemaManager:
+    """create, migrate and maintain the partitioned smartmeter table and its rollups
+
+    The methods take a cursor, so the schema can be maintained on the
+    connection of a writer as well as from the command line.
+    """
+
+    def __init__(
+        self,
+        registry: ObisRegistry = DEFAULT_REGISTRY,
+        maintenance_interval: float = 300.0,
+    ) -> None:
+        self.registry = registry  # value columns of the smartmeter table
+        self.maintenance_interval = maintenance_interval
+        self.maintained_at = None  # monotonic time of the last maintenance
+        self.partitions: set[date] = set()  # months known to exist
+        self.touched_since = None  # oldest time written since the last refresh
+
+    def relkind(self, cur) -> str:
+        """'p' for a partitioned smartmeter table, 'r' for a plain one, None if missing"""
+        cur.execute(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass('smartmeter')"
+        )
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def create(self, cur) -> None:
+        """create the partitioned table, its indexes and the rollup tables"""
+        cur.execute(
+            CREATE_SMARTMETER.format(columns=self.registry.column_definitions())
+        )
+        for command in CREATE_INDEXES:
+            cur.execute(command)
+        self.create_rollups(cur)
+        self.create_windows(cur)
+        self.create_events(cur)
+        self.ensure_future_partitions(cur)
+
+    def create_rollups(self, cur) -> None:
+        for table in ROLLUPS:
+            cur.execute(CREATE_ROLLUP.format(table=table))
+        cur.execute(CREATE_ROLLUP_STATE)
+
+    def create_windows(self, cur) -> None:
+        """the table of the windows aggregated by the sinks, see aggregate.py"""
+        cur.execute(create_window_sql(self.registry))
+
+    def create_events(self, cur) -> None:
+        """the table of the events of the rules sink, see rules.py"""
+        cur.execute(CREATE_EVENTS)
+        cur.execute(CREATE_EVENTS_INDEX)
+
+    def migrate(self, cur) -> None:
+        """bring an existing installation to the current schema, creating it if necessary"""
+        relkind = self.relkind(cur)
+        if relkind is None:
+            logging.info(f"creating partitioned table smartmeter")
+            self.create(cur)
+        elif relkind == "r":
+            self.migrate_legacy(cur)
+        else:
+            self.create_windows(cur)
+            self.create_events(cur)
+            self.add_columns(cur)
+            for command in CREATE_INDEXES:
+                cur.execute(command)
+            self.create_rollups(cur)
+            self.ensure_future_partitions(cur)
+
+    def add_columns(self, cur) -> None:
+        """add the columns of OBIS codes configured after the table was created"""
+        cur.execute(
+            "ALTER TABLE smartmeter_window ADD COLUMN IF NOT EXISTS latest TIMESTAMP"
+        )
+        for field in self.registry.fields:
+            if field not in DEFAULT_FIELDS:
+                cur.execute(
+                    f"ALTER TABLE smartmeter ADD COLUMN IF NOT EXISTS {field.column} {field.sql_type}"
+                )
+            # the window columns of every field, the counts came later
+            for column, sql_type in field_columns(field):
+                cur.execute(
+                    f"ALTER TABLE smartmeter_window ADD COLUMN IF NOT EXISTS {column} {sql_type}"
+                )
+
+    def migrate_legacy(self, cur) -> None:
+        """move a plain smartmeter table into the partitioned table in place"""
+        logging.warning(f"migrating table smartmeter to monthly partitions")
+        # columns added after the first release
+        cur.execute(
+            "ALTER TABLE smartmeter ADD COLUMN IF NOT EXISTS meter_id VARCHAR(32)"
+        )
+        cur.execute(
+            "ALTER TABLE smartmeter ADD COLUMN IF NOT EXISTS frame_counter BIGINT"
+        )
+        # free the names of the table, its sequence and its indexes
+        cur.execute("ALTER TABLE smartmeter RENAME TO smartmeter_legacy")
+        cur.execute(
+            "ALTER SEQUENCE IF EXISTS smartmeter_data_id_seq RENAME TO smartmeter_legacy_data_id_seq"
+        )
+        cur.execute(
+            "ALTER INDEX IF EXISTS smartmeter_pkey RENAME TO smartmeter_legacy_pkey"
+        )
+        cur.execute("DROP INDEX IF EXISTS smartmeter_meter_frame_counter")
+        self.create(cur)
+        cur.execute("SELECT min(time), max(time) FROM smartmeter_legacy")
+        first, last = cur.fetchone()
+        if first is not None:
+            self.ensure_partitions(cur, month_start(first), month_start(last))
+        cur.execute(COPY_LEGACY)
+        logging.warning(f"{cur.rowcount} rows migrated to the partitioned table")
+        cur.execute(
+            "SELECT setval('smartmeter_data_id_seq', COALESCE((SELECT max(data_id) FROM smartmeter), 0) + 1, false)"
+        )
+        cur.execute("DROP TABLE smartmeter_legacy")
+        # the rollups of the migrated rows are computed from the start
+        cur.execute("DELETE FROM smartmeter_rollup_state")
+
+    def ensure_partitions(self, cur, first: date, last: date) -> None:
+        """create the monthly partitions from first to last (both included)"""
+        month = month_start(first)
+        while month <= last:
+            if month not in self.partitions:
+                cur.execute(f"""CREATE TABLE IF NOT EXISTS smartmeter_{month:%Y_%m}
+                    PARTITION OF smartmeter
+                    FOR VALUES FROM ('{month}') TO ('{next_month(month)}')""")
+                self.partitions.add(month)
+            month = next_month(month)
+
+    def ensure_future_partitions(self, cur) -> None:
+        """create the partitions of the current and the next months"""
+        last = month_start(date.today())
+        for _ in range(FUTURE_PARTITIONS):
+            last = next_month(last)
+        self.ensure_partitions(cur, date.today(), last)
+
+    def ensure_partitions_for(self, cur, times) -> None:
+        """create the partitions needed to store rows with the given times"""
+        months = {month_start(time) for time in times} - self.partitions
+        for month in sorted(months):
+            self.ensure_partitions(cur, month, month)
+
+    def touch(self, first: datetime) -> None:
+        """rows from first on were written, the next refresh recomputes their buckets"""
+        if self.touched_since is None or first < self.touched_since:
+            self.touched_since = first
+
+    def refresh_rollups(self, cur, since: datetime = None) -> None:
+        """recompute the rollup buckets touched since the last refresh (or since)"""
+        cur.execute("SELECT (now() AT TIME ZONE 'UTC')::TIMESTAMP")
+        end = cur.fetchone()[0]
+        for table, seconds in ROLLUPS.items():
+            start = since
+            if start is None:
+                cur.execute(
+                    "SELECT refreshed_until FROM smartmeter_rollup_state WHERE rollup = %s",
+                    (table,),
+                )
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute("SELECT min(time) FROM smartmeter")
+                    row = cur.fetchone()
+                start = row[0]
+            if start is None:
+                continue
+            # rows of buffered writers arrive late, recompute their buckets as well
+            if since is None:
+                start -= LATE_ROWS
+                # older rows, e.g. drained from the spool or stamped by the meter
+                if self.touched_since is not None:
+                    start = min(start, self.touched_since)
+            start = EPOCH + timedelta(
+                seconds=(start - EPOCH).total_seconds() // seconds * seconds
+            )
+            cur.execute(
+                REFRESH_ROLLUP.format(table=table, seconds=seconds),
+                {"start": start, "end": end},
+            )
+            cur.execute(
+                """INSERT INTO smartmeter_rollup_state (rollup, refreshed_until)
+                VALUES (%s, %s) ON CONFLICT (rollup)
+                DO UPDATE SET refreshed_until = excluded.refreshed_until""",
+                (table, end),
+            )
+        self.touched_since = None
+
+    def maintain(self, cur) -> None:
+        """create upcoming partitions and refresh the rollups"""
+        self.ensure_future_partitions(cur)
+        self.refresh_rollups(cur)
+        self.maintained_at = monotonic()
+
+    def maintenance_due(self) -> bool:
+        return (
+            self.maintained_at is None
+            or monotonic() - self.maintained_at >= self.maintenance_interval
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="manage the smartmeter tables")
+    parser.add_argument(
+        "command",
+        choices=("create", "migrate", "refresh", "maintain"),
+        help="create: new installation, migrate: update an existing one, "
+        "refresh: recompute all rollups, maintain: partitions and incremental rollups",
+    )
+    args = parser.parse_args()
+
+    config = Configuration()
+    schema = SchemaManager(ObisRegistry.from_config(config.yaml_config()))
+    conn = psycopg2.connect(**config.postgresql_config())
+    try:
+        with conn.cursor() as cur:
+            if args.command == "create":
+                schema.create(cur)
+            elif args.command == "migrate":
+                schema.migrate(cur)
+            elif args.command == "refresh":
+                schema.refresh_rollups(cur, since=EPOCH)
+            else:
+                schema.maintain(cur)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+"""storage backends for the decoded readings
+
+A sink receives column-wise batches of readings (ReadingBatch). Every sink
+runs in its own thread behind a bounded buffer (BufferedSink), a slow or
+broken sink drops its own readings instead of stalling the others.
+
+The sinks are listed under sinks in main_config.yaml:
+
+    sinks:
+      - type: postgres
+        windows: [10, 60]  # seconds, 0: every reading
+      - type: sqlite
+        path: smartmeter.sqlite
+      - type: csv  # or ndjson
+        path: smartmeter.csv
+        batchSize: 100
+      - type: stdout
+      - type: rules  # events of the rules, see rules.py
+        store: postgres
+
+Without that list usePostgres and printValue select the postgres and stdout
+sinks. With windows the postgres and sqlite sinks aggregate the readings in
+windows of the given seconds and store only the aggregates (smartmeter_window,
+see aggregate.py), 0 stores every reading in the smartmeter table as well.
+"""
+
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+from time import monotonic
+
+from dev.definitions import ROOT_DIR
+from src.smartmeter.aggregate import (
+    aggregators,
+    create_window_sql,
+    field_columns,
+    upsert_window_sql,
+    window_columns,
+)
+from src.smartmeter.data import SmartmeterToPostgres, print_values
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.reading import Reading, ReadingBatch
+from src.smartmeter.rules import INSERT_EVENTS, RuleEngine, run_hook, rules_from_config
+
+
+class Sink:
+    """receives batches of readings, subclasses implement write"""
+
+    def write(self, batch: ReadingBatch) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class WindowSink(Sink):
+    """aggregate the readings in windows, subclasses store the raw and the window rows"""
+
+    def __init__(self, windows=(), registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        self.raw, self.aggregators = aggregators(windows, registry)
+
+    def write(self, batch: ReadingBatch) -> None:
+        if self.raw:
+            self.write_rows(batch.rows())
+        if self.aggregators:
+            rows = []
+            for reading in batch.readings():
+                for aggregator in self.aggregators:
+                    rows += aggregator.add(reading)
+            if rows:
+                self.write_windows(rows)
+
+    def write_rows(self, rows) -> None:
+        raise NotImplementedError
+
+    def write_windows(self, rows: list[tuple]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """store the open windows"""
+        rows = [row for aggregator in self.aggregators for row in aggregator.flush()]
+        if rows:
+            self.write_windows(rows)
+
+
+class PostgresSink(WindowSink):
+    """hand the rows to the spool or the batched writer of the decoder
+
+    The windows are upserted by a writer of their own, the writer of the
+    decoder may be used by the spool drainer.
+    """
+
+    def __init__(self, decoder: SmartmeterToPostgres, windows=()) -> None:
+        super().__init__(windows, decoder.registry)
+        self.decoder = decoder
+        self.window_writer = None
+        if decoder.writer is None:
+            decoder.open_writer()
+        if self.aggregators:
+            self.window_writer = decoder.client.writer(registry=decoder.registry)
+
+    def write_rows(self, rows) -> None:
+        for row in rows:
+            self.decoder.store_row(row)
+
+    def write_windows(self, rows: list[tuple]) -> None:
+        self.window_writer.write_windows(rows)
+
+    def close(self) -> None:
+        """store the open windows and the rows still buffered by the writer"""
+        try:
+            super().close()
+        finally:
+            try:
+                if self.window_writer is not None:
+                    self.window_writer.close()
+            finally:
+                self.decoder.close_writer()
+
+
+class SqliteSink(WindowSink):
+    """store the rows in a local SQLite database, telegrams stored before are skipped"""
+
+    def __init__(
+        self, path: str, registry: ObisRegistry = DEFAULT_REGISTRY, windows=()
+    ) -> None:
+        super().__init__(windows, registry)
+        columns = registry.row_columns
+        # the connection is used by the thread of the BufferedSink only
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS smartmeter ({', '.join(columns)}, UNIQUE (meter_id, frame_counter, time))"
+        )
+        self.sql = f"INSERT OR IGNORE INTO smartmeter ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        if self.aggregators:
+            self.conn.execute(create_window_sql(registry))
+            self.add_window_columns(registry)
+            width = len(window_columns(registry))
+            # SQLite has no GREATEST and LEAST, its scalar max and min do the same
+            self.window_sql = upsert_window_sql(
+                registry, f"({', '.join('?' * width)})", "max", "min"
+            )
+
+    def add_window_columns(self, registry: ObisRegistry) -> None:
+        """add the columns missing in a window table of an earlier release"""
+        existing = {
+            row[1] for row in self.conn.execute("PRAGMA table_info(smartmeter_window)")
+        }
+        if "latest" not in existing:
+            self.conn.execute("ALTER TABLE smartmeter_window ADD COLUMN latest TEXT")
+        for field in registry.fields:
+            for column, sql_type in field_columns(field):
+                if column not in existing:
+                    self.conn.execute(
+                        f"ALTER TABLE smartmeter_window ADD COLUMN {column} {sql_type}"
+                    )
+
+    def write_rows(self, rows) -> None:
+        with self.conn:
+            self.conn.executemany(
+                self.sql, ((row[0].isoformat(sep=" "),) + row[1:] for row in rows)
+            )
+
+    def write_windows(self, rows: list[tuple]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                self.window_sql,
+                (
+                    (row[0].isoformat(sep=" "),)
+                    + row[1:4]
+                    + (row[4].isoformat(sep=" ", timespec="microseconds"),)
+                    + row[5:]
+                    for row in rows
+                ),
+            )
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.conn.close()
+
+
+class CsvSink(Sink):
+    """append the rows to a CSV file, the header is written to a new file"""
+
+    def __init__(self, path: str, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(registry.row_columns)
+
+    def write(self, batch: ReadingBatch) -> None:
+        self.writer.writerows(batch.rows())
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class NdjsonSink(Sink):
+    """append the rows to a file as one JSON object per line"""
+
+    def __init__(self, path: str, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        self.file = open(path, "a")
+        self.columns = registry.row_columns
+
+    def write(self, batch: ReadingBatch) -> None:
+        for row in batch.rows():
+            record = dict(zip(self.columns, row))
+            record["time"] = row[0].isoformat()
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class StdoutSink(Sink):
+    """print the readings to the console"""
+
+    def __init__(self, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        self.names = registry.names
+
+    def write(self, batch: ReadingBatch) -> None:
+        for reading in batch.readings():
+            print_values(
+                dict(zip(self.names, reading.values)), reading.meter_id or None
+            )
+
+
+class RulesSink(Sink):
+    """evaluate the rules of main_config.yaml on the readings, see rules.py
+
+    The events are stored in smartmeter_events (store: postgres) and passed
+    to the hook command and the hook functions.
+    """
+
+    def __init__(self, engine: RuleEngine, writer=None, hook: str = None) -> None:
+        self.engine = engine
+        self.writer = writer  # PostgresWriter of the events, optional
+        self.hook = hook  # command, gets the event as JSON on stdin
+        self.hooks = []  # functions called with every event
+
+    def write(self, batch: ReadingBatch) -> None:
+        events = []
+        for reading in batch.readings():
+            events += self.engine.evaluate(reading)
+        if not events:
+            return
+        for event in events:
+            logging.warning(
+                f"{event.rule} {event.state} ({event.meter_id}): {event.message}"
+            )
+            for hook in self.hooks:
+                hook(event)
+            if self.hook:
+                run_hook(self.hook, event)
+        if self.writer is not None:
+            self.writer.execute(INSERT_EVENTS, events, "event")
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+class BufferedSink(threading.Thread):
+    """feed a sink from a bounded buffer in batches
+
+    The readings are buffered column-wise. A batch is written once batch_size
+    readings are collected or the oldest one waited max_age seconds. Readings
+    are dropped if the buffer is full or the sink fails, the other sinks are
+    not affected.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        sink: Sink,
+        batch_size: int = 1,
+        max_age: float = 5.0,
+        queue_size: int = 10000,
+        registry: ObisRegistry = DEFAULT_REGISTRY,
+    ) -> None:
+        super().__init__(name=f"sink-{name}", daemon=True)
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.queue_size = queue_size  # readings buffered at most
+        self.registry = registry
+        self.batch = ReadingBatch(registry)
+        self.first_at = None  # monotonic time of the oldest buffered reading
+        self.condition = threading.Condition()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0  # readings lost in a failed write
+        self.stopped = False
+
+    def put(self, reading: Reading) -> None:
+        """buffer a reading, never blocks"""
+        with self.condition:
+            if len(self.batch) >= self.queue_size:
+                self.dropped += 1
+                return
+            if not self.batch:
+                self.first_at = monotonic()
+            self.batch.append(reading)
+            # wake the writer for the first reading (max_age starts) and a full batch
+            if len(self.batch) == 1 or len(self.batch) >= self.batch_size:
+                self.condition.notify()
+
+    def collect(self) -> ReadingBatch:
+        """wait for the next batch, an empty one once stopped"""
+        with self.condition:
+            while not self.stopped:
+                if len(self.batch) >= self.batch_size:
+                    break
+                if self.batch:
+                    timeout = self.first_at + self.max_age - monotonic()
+                    if timeout <= 0:
+                        break
+                else:
+                    timeout = None
+                self.condition.wait(timeout)
+            batch = self.batch
+            self.batch = ReadingBatch(self.registry)
+            return batch
+
+    def write(self, batch: ReadingBatch) -> None:
+        try:
+            self.sink.write(batch)
+            self.written += len(batch)
+        except Exception as err:
+            self.failed += len(batch)
+            logging.exception(f"{self.name}: {err}")
+
+    def run(self) -> None:
+        while not self.stopped:
+            batch = self.collect()
+            if batch:
+                self.write(batch)
+
+    def stop(self) -> None:
+        """write the buffered readings and close the sink"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+        if self.batch:
+            self.write(self.collect())
+        self.sink.close()
+
+    def snapshot(self) -> dict:
+        return {
+            "depth": len(self.batch),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+class Fanout:
+    """hand every reading to all sinks"""
+
+    def __init__(self, sinks: dict[str, BufferedSink]) -> None:
+        self.sinks = sinks
+
+    def put(self, reading: Reading) -> None:
+        for sink in self.sinks.values():
+            sink.put(reading)
+
+    def start(self) -> None:
+        for sink in self.sinks.values():
+            sink.start()
+
+    def stop(self) -> None:
+        for sink in self.sinks.values():
+            sink.stop()
+
+    def stats(self) -> dict:
+        return {name: sink.snapshot() for name, sink in self.sinks.items()}
+
+
+def sink_configs(config_yaml: dict) -> list[dict]:
+    """the sinks of main_config.yaml, derived from usePostgres and printValue without a list"""
+    if "sinks" in config_yaml:
+        return config_yaml["sinks"] or []
+    configs = []
+    if config_yaml.get("usePostgres"):
+        configs.append({"type": "postgres"})
+    if config_yaml.get("printValue"):
+        configs.append({"type": "stdout"})
+    return configs
+
+
+def open_sink(config: dict, decoder: SmartmeterToPostgres) -> Sink:
+    kind = config["type"]
+    windows = config.get("windows")
+    if windows and kind not in ("postgres", "sqlite"):
+        raise Exception(f"windows are not supported by the {kind} sink")
+    if kind == "postgres":
+        return PostgresSink(decoder, windows)
+    if kind == "stdout":
+        return StdoutSink(decoder.registry)
+    if kind == "rules":
+        rules = rules_from_config(decoder.config_yaml, decoder.registry)
+        if not rules:
+            raise Exception("the rules sink needs rules in main_config.yaml")
+        writer = None
+        if config.get("store") == "postgres":
+            decoder.client.migrate_table_smartmeter(decoder.registry)
+            writer = decoder.client.writer(registry=decoder.registry)
+        return RulesSink(RuleEngine(rules), writer, config.get("hook"))
+    files = {"sqlite": SqliteSink, "csv": CsvSink, "ndjson": NdjsonSink}
+    if kind not in files:
+        raise Exception(f"unknown sink type {kind}")
+    path = os.path.join(ROOT_DIR, config.get("path", f"smartmeter.{kind}"))
+    if kind == "sqlite":
+        return SqliteSink(path, decoder.registry, windows)
+    return files[kind](path, decoder.registry)
+
+
+def open_sinks(config_yaml: dict, decoder: SmartmeterToPostgres) -> Fanout:
+    """create the sinks of main_config.yaml, each with its own buffer and thread"""
+    sinks = {}
+    for config in sink_configs(config_yaml):
+        name = config.get("name", config["type"])
+        sinks[name] = BufferedSink(
+            name,
+            open_sink(config, decoder),
+            batch_size=config.get("batchSize", 1),
+            max_age=config.get("batchMaxAge", 5),
+            queue_size=config.get("queueSize", 10000),
+            registry=decoder.registry,
+        )
+    return Fanout(sinks)
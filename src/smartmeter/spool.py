@@ -0,0 +1,323 @@
+"""durable local spool between the serial loop and the database
+
+Rows are appended to segment files as fixed size binary records (with a
+CRC), the drainer thread fsyncs them in batches and ships them to
+PostgreSQL whenever it is reachable. The position of the last shipped
+record is kept in a checkpoint file, so a restart continues where the
+drainer stopped. Shipping is at-least-once, the unique index of the
+smartmeter table drops rows which were already stored.
+"""
+
+import logging
+import math
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timedelta
+from time import monotonic
+
+import psycopg2
+
+from src.smartmeter.metrics import METRICS
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry
+from src.smartmeter.postgresql_writer import CONNECTION_ERRORS
+from src.smartmeter.reading import NONE
+
+EPOCH = datetime(1970, 1, 1)
+CRC = struct.Struct("<I")
+SEGMENT_SUFFIX = ".seg"
+
+SPOOL_ROWS = METRICS.counter(
+    "smartmeter_spool_rows_total",
+    "rows appended, shipped, dropped or quarantined",
+    ("result",),
+)
+
+
+class RecordFormat:
+    """fixed size binary layout of a row
+
+    time (µs since epoch), meter id, frame counter and the values of the
+    OBIS registry: integer columns as int64 (NONE: none), the others as double
+    (NaN: none). Every record starts with the CRC32 of the rest.
+    """
+
+    def __init__(self, registry: ObisRegistry = DEFAULT_REGISTRY) -> None:
+        # frame counter and values
+        self.integers = (True,) + tuple(field.integer for field in registry.fields)
+        self.layout = "<q32s" + "".join("q" if i else "d" for i in self.integers)
+        self.record = struct.Struct(self.layout)
+        self.size = CRC.size + self.record.size
+
+    def pack(self, row: tuple) -> bytes:
+        """pack a row (ordered as the columns of PostgresWriter) into a record"""
+        record = self.record.pack(
+            (row[0] - EPOCH) // timedelta(microseconds=1),
+            (row[1] or "").encode(),
+            *(
+                (NONE if integer else math.nan) if value is None else value
+                for integer, value in zip(self.integers, row[2:])
+            ),
+        )
+        return CRC.pack(zlib.crc32(record)) + record
+
+    def unpack(self, data: bytes) -> tuple:
+        """return the row of a record or None if it is corrupt"""
+        (crc,) = CRC.unpack_from(data)
+        record = data[CRC.size :]
+        if zlib.crc32(record) != crc:
+            return None
+        time, meter_id, *values = self.record.unpack(record)
+        return (
+            EPOCH + timedelta(microseconds=time),
+            # a meter id cut within a character loses the partial character
+            meter_id.rstrip(b"\0").decode("utf-8", "ignore"),
+            *(
+                None if (value == NONE if integer else math.isnan(value)) else value
+                for integer, value in zip(self.integers, values)
+            ),
+        )
+
+
+class Spool:
+    """append-only segment files with a checkpoint of the shipped position"""
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = 1 << 20,
+        max_bytes: int = 256 << 20,
+        registry: ObisRegistry = DEFAULT_REGISTRY,
+    ) -> None:
+        self.directory = directory
+        self.format = RecordFormat(registry)
+        self.segment_size = segment_size  # bytes before a new segment is started
+        self.max_bytes = max_bytes  # oldest segments are dropped beyond this
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoint_path = os.path.join(directory, "checkpoint")
+        self.position = self.load_checkpoint()  # (segment, offset) shipped up to
+        segments = self.segments()
+        self.check_layout(segments)
+        # always append to a new segment, the last one may end in a torn record
+        self.segment = (segments[-1] if segments else self.position[0]) + 1
+        self.file = open(self.path(self.segment), "ab")
+        self.size = 0
+        self.unsynced = False
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:016d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> list[int]:
+        return sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def load_checkpoint(self) -> tuple[int, int]:
+        try:
+            with open(self.checkpoint_path) as file:
+                segment, offset = file.read().split()
+            return int(segment), int(offset)
+        except FileNotFoundError:
+            return 0, 0
+
+    def check_layout(self, segments: list[int]) -> None:
+        """refuse spooled records of another layout, e.g. after obisCodes changed"""
+        path = os.path.join(self.directory, "layout")
+        if os.path.exists(path):
+            with open(path) as file:
+                layout = file.read()
+            if layout == self.format.layout:
+                return
+            if any(os.path.getsize(self.path(segment)) for segment in segments):
+                raise Exception(
+                    f"{self.directory} holds records of another layout ({layout}), ship or remove them first"
+                )
+        with open(path, "w") as file:
+            file.write(self.format.layout)
+
+    def append(self, row: tuple) -> None:
+        """append a row (ordered as the columns of PostgresWriter), not synced yet"""
+        record = self.format.pack(row)
+        with self.lock:
+            if self.size + len(record) > self.segment_size:
+                self.rotate()
+            self.file.write(record)
+            self.size += len(record)
+            self.unsynced = True
+        SPOOL_ROWS.inc("appended")
+
+    def rotate(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.path(self.segment), "ab")
+        self.size = 0
+        self.enforce_limit()
+
+    def enforce_limit(self) -> None:
+        """drop the oldest segments if the spool grows beyond max_bytes"""
+        segments = self.segments()
+        sizes = {segment: os.path.getsize(self.path(segment)) for segment in segments}
+        total = sum(sizes.values())
+        for segment in segments[:-1]:
+            if total <= self.max_bytes:
+                break
+            logging.warning(
+                f"spool full, dropped segment {segment} ({sizes[segment] // self.format.size} rows)"
+            )
+            os.remove(self.path(segment))
+            SPOOL_ROWS.inc("dropped", amount=sizes[segment] // self.format.size)
+            total -= sizes[segment]
+            if self.position[0] <= segment:
+                self.position = (segment + 1, 0)
+
+    def sync(self) -> None:
+        """write the appended rows to disk"""
+        with self.lock:
+            if self.unsynced:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+    def read(self, limit: int) -> tuple[list[tuple], tuple[int, int]]:
+        """return up to limit rows after the checkpoint and the position after them"""
+        size = self.format.size
+        with self.lock:
+            self.file.flush()
+            segment, offset = self.position
+            rows = []
+            while len(rows) < limit and segment <= self.segment:
+                try:
+                    with open(self.path(segment), "rb") as file:
+                        file.seek(offset)
+                        data = file.read((limit - len(rows)) * size)
+                except FileNotFoundError:
+                    data = b""
+                complete = len(data) - len(data) % size
+                for start in range(0, complete, size):
+                    row = self.format.unpack(data[start : start + size])
+                    if row is None:
+                        logging.warning(f"corrupt record in spool segment {segment}")
+                    else:
+                        rows.append(row)
+                offset += complete
+                if complete < len(data) or not data:
+                    # end of the segment (a torn record is skipped)
+                    if segment == self.segment:
+                        break
+                    segment, offset = segment + 1, 0
+            return rows, (segment, offset)
+
+    def commit(self, position: tuple[int, int]) -> None:
+        """remember the shipped position and delete segments which are shipped completely"""
+        with self.lock:
+            temporary = self.checkpoint_path + ".tmp"
+            with open(temporary, "w") as file:
+                file.write(f"{position[0]} {position[1]}")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.checkpoint_path)
+            self.position = position
+            for segment in self.segments():
+                if segment < position[0] and segment != self.segment:
+                    os.remove(self.path(segment))
+
+    def quarantine(self, rows: list[tuple]) -> str:
+        """keep rows the database rejects in quarantine/, named by their spool position"""
+        directory = os.path.join(self.directory, "quarantine")
+        os.makedirs(directory, exist_ok=True)
+        segment, offset = self.position
+        path = os.path.join(directory, f"{segment:016d}-{offset}{SEGMENT_SUFFIX}")
+        with open(path, "ab") as file:
+            file.write(b"".join(self.format.pack(row) for row in rows))
+            file.flush()
+            os.fsync(file.fileno())
+        return path
+
+    def close(self) -> None:
+        self.sync()
+        with self.lock:
+            self.file.close()
+
+
+class SpoolDrainer(threading.Thread):
+    """fsync the spool in batches and ship it to the database in the background"""
+
+    def __init__(
+        self,
+        spool: Spool,
+        writer,
+        batch_size: int = 5000,
+        interval: float = 1.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        super().__init__(name="spool-drainer", daemon=True)
+        self.spool = spool
+        self.writer = writer  # PostgresWriter, rows are loaded with copy()
+        self.batch_size = batch_size
+        self.interval = interval  # seconds between fsyncs when idle
+        self.max_backoff = max_backoff
+        self.backoff = interval
+        self.stopped = threading.Event()
+
+    def drain(self) -> int:
+        """ship the spooled rows once, return the number of rows shipped"""
+        shipped = 0
+        while True:
+            rows, position = self.spool.read(self.batch_size)
+            if position == self.spool.position:
+                return shipped
+            if rows:
+                try:
+                    self.writer.copy(rows)
+                except CONNECTION_ERRORS:
+                    raise
+                except psycopg2.Error as error:
+                    # retrying would fail again, move the rows aside and go on
+                    path = self.spool.quarantine(rows)
+                    logging.error(
+                        f"{len(rows)} spooled rows rejected by postgresQL ({error}), moved to {path}"
+                    )
+                    SPOOL_ROWS.inc("quarantined", amount=len(rows))
+                else:
+                    shipped += len(rows)
+                    SPOOL_ROWS.inc("shipped", amount=len(rows))
+            self.spool.commit(position)
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            started = monotonic()
+            self.spool.sync()
+            try:
+                shipped = self.drain()
+                if shipped:
+                    logging.info(f"{shipped} spooled rows shipped to postgresQL")
+                self.backoff = self.interval
+            except psycopg2.Error as error:
+                logging.warning(
+                    f"postgresQL not reachable ({error}), retrying in {self.backoff:.0f} s"
+                )
+                self.retry_later()
+                continue
+            except Exception as error:
+                # the thread must not end, the spool would grow until it is full
+                logging.exception(
+                    f"spool drainer failed ({error}), retrying in {self.backoff:.0f} s"
+                )
+                self.retry_later()
+                continue
+            self.stopped.wait(max(0.0, self.interval - (monotonic() - started)))
+
+    def retry_later(self) -> None:
+        self.stopped.wait(self.backoff)
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+        self.spool.close()
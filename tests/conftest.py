@@ -0,0 +1,42 @@
+"""fixtures shared by the test modules, see helpers.py for the builders"""
+
+import pytest
+from src.smartmeter.config import Configuration
+from src.smartmeter.data import SmartmeterToPostgres
+from src.smartmeter.gateway import Gateway
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from tests.helpers import EVN_KEY
+
+
+# create instance of Class SmartmeterToPostgres
+@pytest.fixture
+def smartmeterpostgres():
+    config = Configuration()
+    client = PostgresTasks(config)
+    return SmartmeterToPostgres(config, client)
+
+
+# evn test  based on the official documentation "218_13_SmartMeter_Kundenschnittstelle_2604_web.pdf"
+@pytest.fixture
+def evn_smartmeterpostgres(monkeypatch):
+    # the configuration is read-only, the key is read from the environment once
+    monkeypatch.setenv("EVN_SCHLUESSEL", EVN_KEY)
+    config = Configuration()
+    return SmartmeterToPostgres(config, PostgresTasks(config))
+
+
+# gateway configured with two meters in a temporary main_config.yaml
+@pytest.fixture
+def gateway(tmp_path, monkeypatch):
+    monkeypatch.setenv("EVN_SCHLUESSEL_2", EVN_KEY)
+    url_yaml_config = tmp_path / "main_config.yaml"
+    url_yaml_config.write_text(
+        "baudrate: 2400\n"
+        "printValue: False\n"
+        "usePostgres: False\n"
+        "meters:\n"
+        f"  - {{meterId: 1, port: /dev/ttyUSB0, key: {EVN_KEY}}}\n"
+        "  - {meterId: zwei, port: /dev/ttyUSB1, keyEnv: EVN_SCHLUESSEL_2, baudrate: 9600}\n"
+    )
+    config = Configuration(url_yaml_config=url_yaml_config)
+    return Gateway(config, PostgresTasks(config))
@@ -0,0 +1,50 @@
+"""sample telegrams and builders of rows and readings shared by the test modules"""
+
+from datetime import datetime, timedelta
+
+from src.smartmeter.obis import DEFAULT_REGISTRY
+from src.smartmeter.reading import Reading, ReadingBatch
+
+# sample frames: EVN_* from the official documentation, MY_* read from an own smartmeter
+EVN_KEY = "36C66639E48A8CA4D6BC8B282A793BBB"
+EVN_ENCRYPTED_APDU = "68FAFA6853FF000167DB084B464D675000000981F8200000002388D5AB4F97515AAFC6B88D2F85DAA7A0E3C0C40D004535C397C9D037AB7DBDA329107615444894A1A0DD7E85F02D496CECD3FF46AF5FB3C9229CFE8F3EE4606AB2E1F409F36AAD2E50900A4396FC6C2E083F373233A69616950758BFC7D63A9E9B6E99E21B2CBC2B934772CA51FD4D69830711CAB1F8CFF25F0A329337CBA51904F0CAED88D61968743C8454BA922EB00038182C22FE316D16F2A9F544D6F75D51A4E92A1C4EF8AB19A2B7FEAA32D0726C0ED80229AE6C0F7621A4209251ACE2B2BC66FF0327A653BB686C756BE033C7A281F1D2A7E1FA31C3983E15F8FD16CC5787E6F517166814146853FF110167419A3CFDA44BE438C96F0E38BF83D98316"
+EVN_DECRYPTED_APDU = "0F8006870E0C07E5091B01092F0F00FF88800223090C07E5091B01092F0F00FF888009060100010800FF060000328902020F00161E09060100020800FF060000000002020F00161E09060100010700FF060000000002020F00161B09060100020700FF060000000002020F00161B09060100200700FF12092102020FFF162309060100340700FF12000002020FFF162309060100480700FF12000002020FFF1623090601001F0700FF12000002020FFE162109060100330700FF12000002020FFE162109060100470700FF12000002020FFE1621090601000D0700FF1203E802020FFD16FF090C313831323230303030303039"
+MY_DECRYPTED_APDU = "0f8006870e0c07e5091b01092f0f00ff88800223090c07e5091b01092f0f00ff888009060100010800ff060000328902020f00161e09060100020800ff060000000002020f00161e09060100010700ff060000000002020f00161b09060100020700ff060000000002020f00161b09060100200700ff12092102020fff162309060100340700ff12000002020fff162309060100480700ff12000002020fff1623090601001f0700ff12000002020ffe162109060100330700ff12000002020ffe162109060100470700ff12000002020ffe1621090601000d0700ff1203e802020ffd16a985"
+
+
+TIME = datetime(2023, 5, 1, 12, 0, 0, 250000)
+
+
+def row(i: int) -> tuple:
+    """a row of the smartmeter table, 5 s after the previous one"""
+    return (
+        TIME + timedelta(seconds=5 * i),
+        "haus",
+        i,
+        12937 + i,
+        0,
+        150,
+        0,
+        230.1,
+        229.8,
+        231.0,
+        0.61,
+        0.52,
+        0.43,
+        0.9,
+    )
+
+
+def reading(i: int, meter_id: str = "haus", **changes) -> Reading:
+    """the reading of row(i), values changed by name"""
+    time, _, frame_counter, *values = row(i)
+    names = list(DEFAULT_REGISTRY.names)
+    for name, value in changes.items():
+        values[names.index(name)] = value
+    return Reading(time, meter_id, frame_counter, values)
+
+
+def batch(*numbers: int) -> ReadingBatch:
+    batch = ReadingBatch()
+    batch.extend(reading(i) for i in numbers)
+    return batch
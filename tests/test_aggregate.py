@@ -0,0 +1,130 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from src.smartmeter import aggregate, sinks
+from src.smartmeter.aggregate import WindowAggregator, window_columns
+from src.smartmeter.obis import DEFAULT_REGISTRY
+from src.smartmeter.reading import Reading, ReadingBatch
+from tests.helpers import batch, reading
+
+
+def record(row: tuple) -> dict:
+    return dict(zip(window_columns(), row))
+
+
+def test_bucket_is_aligned_to_the_clock():
+    aggregator = WindowAggregator(60)
+    assert aggregator.bucket(datetime(2023, 5, 1, 12, 0, 59, 999)) == datetime(
+        2023, 5, 1, 12, 0
+    )
+    assert WindowAggregator(900).bucket(datetime(2023, 5, 1, 12, 29)) == datetime(
+        2023, 5, 1, 12, 15
+    )
+
+
+def test_window_closed_by_a_later_reading():
+    aggregator = WindowAggregator(10)
+    # readings every 5 s from 12:00:00.25, two per window
+    assert aggregator.add(reading(0)) == []
+    assert aggregator.add(reading(1)) == []
+    (row,) = aggregator.add(reading(2))
+    window = record(row)
+    assert window["bucket"] == datetime(2023, 5, 1, 12, 0)
+    assert window["seconds"] == 10
+    assert window["meter_id"] == "haus"
+    assert window["samples"] == 2
+    assert (window["wirkenergie_p_first"], window["wirkenergie_p_last"]) == (
+        12937,
+        12938,
+    )
+    assert window["momentanleistung_p_min"] == window["momentanleistung_p_max"]
+    assert window["spannung_l1_mean"] == pytest.approx(230.1)
+    # the open window is stored on shutdown
+    (row,) = aggregator.flush()
+    assert record(row)["samples"] == 1
+    assert aggregator.flush() == []
+
+
+def test_late_reading_is_dropped():
+    aggregator = WindowAggregator(10)
+    aggregator.add(reading(2))
+    assert aggregator.add(reading(0)) == []
+    assert aggregator.late == 1
+    (row,) = aggregator.flush()
+    assert record(row)["samples"] == 1
+
+
+def test_aggregators_of_a_sink():
+    raw, aggregators = aggregate.aggregators([0, 10, 60])
+    assert raw and [a.seconds for a in aggregators] == [10, 60]
+    raw, aggregators = aggregate.aggregators([10])
+    assert not raw
+    assert aggregate.aggregators(None) == (True, [])
+
+
+def test_sqlite_stores_only_windows_and_merges(tmp_path):
+    path = str(tmp_path / "smartmeter.sqlite")
+    sink = sinks.SqliteSink(path, windows=[10])
+    sink.write(batch(0, 1, 2))
+    sink.close()
+    # a restart in the middle of the window: the rows are merged
+    sink = sinks.SqliteSink(path, windows=[10])
+    sink.write(batch(3, 4))
+    sink.close()
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT count(*) FROM smartmeter").fetchone() == (0,)
+    rows = conn.execute(
+        "SELECT bucket, samples, wirkenergie_p_first, wirkenergie_p_last"
+        " FROM smartmeter_window ORDER BY bucket"
+    ).fetchall()
+    assert rows == [
+        ("2023-05-01 12:00:00", 2, 12937, 12938),
+        ("2023-05-01 12:00:10", 2, 12939, 12940),
+        ("2023-05-01 12:00:20", 1, 12941, 12941),
+    ]
+
+
+def test_merged_mean_counts_values_only(tmp_path):
+    path = str(tmp_path / "smartmeter.sqlite")
+    position = DEFAULT_REGISTRY.names.index("SpannungL1")
+    first = reading(0)
+    values = list(first.values)
+    values[position] = None
+    sink = sinks.SqliteSink(path, windows=[10])
+    readings = ReadingBatch()
+    readings.append(Reading(first.time, first.meter_id, first.frame_counter, values))
+    sink.write(readings)
+    sink.close()
+    # the rest of the window after a restart, now with a voltage
+    sink = sinks.SqliteSink(path, windows=[10])
+    sink.write(batch(1))
+    sink.close()
+    conn = sqlite3.connect(path)
+    row = conn.execute(
+        "SELECT samples, spannung_l1_mean, spannung_l1_count, spannung_l2_count"
+        " FROM smartmeter_window"
+    ).fetchone()
+    assert row[0] == 2
+    # not halved by the sample without a value
+    assert row[1] == pytest.approx(230.1)
+    assert row[2:] == (1, 2)
+
+
+def test_window_written_twice_is_stored_once(tmp_path):
+    path = str(tmp_path / "smartmeter.sqlite")
+    sink = sinks.SqliteSink(path, windows=[10])
+    aggregator = WindowAggregator(10)
+    aggregator.add(reading(0))
+    rows = aggregator.flush()
+    # e.g. retried after the commit was lost with the connection
+    sink.write_windows(rows)
+    sink.write_windows(rows)
+    aggregator.add(reading(1))
+    sink.write_windows(aggregator.flush())
+    sink.close()
+    conn = sqlite3.connect(path)
+    assert conn.execute(
+        "SELECT samples, latest, wirkenergie_p_last FROM smartmeter_window"
+    ).fetchone() == (2, "2023-05-01 12:00:05.250000", 12938)
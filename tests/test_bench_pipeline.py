@@ -0,0 +1,57 @@
+from datetime import datetime
+
+import pytest
+
+from dev import bench_pipeline
+from tests.helpers import EVN_DECRYPTED_APDU, EVN_ENCRYPTED_APDU, EVN_KEY
+
+
+def test_encrypt_telegram_as_the_meter():
+    telegram = bench_pipeline.encrypt_telegram(
+        EVN_KEY, bytes.fromhex(EVN_DECRYPTED_APDU), 0x23
+    )
+    assert telegram == bytes.fromhex(EVN_ENCRYPTED_APDU)
+
+
+def test_synthetic_telegrams_decode(gateway):
+    decoder = gateway.decoder
+    decryptor = decoder.decryptor(bench_pipeline.BENCH_KEY)
+    telegrams = bench_pipeline.synthetic_telegrams(3, first_frame_counter=7)
+    for i, (telegram, values) in enumerate(telegrams):
+        assert decoder.process_telegram(telegram, decryptor)
+        assert decoder.data["FrameCounter"] == 7 + i
+        assert decoder.data["WirkenergieP"] == values[bytes([1, 0, 1, 8, 0, 255])]
+        assert decoder.data["SpannungL1"] == pytest.approx(
+            values[bytes([1, 0, 32, 7, 0, 255])] / 10
+        )
+    # local time 00:00:10 with a deviation of -60 minutes
+    assert decoder.data["DeviceTime"] == datetime(2023, 12, 31, 23, 0, 10)
+
+
+def test_run_benchmark_sqlite(gateway):
+    telegrams = [t for t, _ in bench_pipeline.synthetic_telegrams(25)]
+    registry = gateway.decoder.registry
+    with bench_pipeline.open_store("sqlite", registry, 10) as sink:
+        run = bench_pipeline.run_benchmark(gateway.decoder, telegrams, sink, 10)
+        count = sink.conn.execute("SELECT count(*) FROM smartmeter").fetchone()[0]
+    assert count == 25
+    result = bench_pipeline.summarize(run, 25, "sqlite", 10)
+    assert result["stored"] == 25
+    assert result["stages"]["decode"]["count"] == 25
+    assert result["stages"]["store"]["count"] == 3
+    assert result["throughput"]["end_to_end_per_s"] > 0
+
+
+def test_compare():
+    baseline = {
+        "stages": {"decode": {"p50_us": 10.0}},
+        "throughput": {"decode_per_s": 1000.0},
+    }
+    result = {
+        "stages": {"decode": {"p50_us": 11.0}},
+        "throughput": {"decode_per_s": 900.0},
+    }
+    assert bench_pipeline.compare(result, baseline) == []
+    result["stages"]["decode"]["p50_us"] = 13.0
+    result["throughput"]["decode_per_s"] = 700.0
+    assert len(bench_pipeline.compare(result, baseline)) == 2
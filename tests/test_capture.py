@@ -0,0 +1,30 @@
+from src.smartmeter import replay
+from src.smartmeter.capture import FrameCapture
+from tests.helpers import EVN_ENCRYPTED_APDU
+
+TELEGRAM = bytes.fromhex(EVN_ENCRYPTED_APDU)
+
+
+def test_capture_rotates(tmp_path):
+    path = str(tmp_path / "capture" / "haus.bin")
+    capture = FrameCapture(path, max_bytes=2 * len(TELEGRAM), backups=2)
+    for _ in range(7):
+        capture.write(TELEGRAM)
+    capture.close()
+    files = capture.files()
+    assert files == [path + ".2", path + ".1", path]
+    assert [len(open(file, "rb").read()) for file in files] == [
+        2 * len(TELEGRAM),
+        2 * len(TELEGRAM),
+        len(TELEGRAM),
+    ]
+
+
+def test_capture_is_replayable(tmp_path):
+    path = str(tmp_path / "haus.bin")
+    capture = FrameCapture(path)
+    # noise between the telegrams and a telegram split across reads
+    capture.write(b"\x00\x16" + TELEGRAM[:50])
+    capture.write(TELEGRAM[50:] + b"\xff")
+    capture.close()
+    assert list(replay.read_capture(path)) == [TELEGRAM]
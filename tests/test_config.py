@@ -0,0 +1,68 @@
+import pickle
+
+import pytest
+
+from src.smartmeter.config import ConfigError, Configuration
+
+
+def configuration(tmp_path, text: str) -> Configuration:
+    url_yaml_config = tmp_path / "main_config.yaml"
+    url_yaml_config.write_text(text)
+    return Configuration(url_yaml_config=url_yaml_config)
+
+
+def test_yaml_config_loaded_once_and_read_only(tmp_path):
+    config = configuration(
+        tmp_path, "baudrate: 2400\nmeters:\n  - {meterId: 1, port: /dev/ttyUSB0}\n"
+    )
+    config_yaml = config.yaml_config()
+    assert config.yaml_config() is config_yaml
+    assert config_yaml["meters"][0]["port"] == "/dev/ttyUSB0"
+    with pytest.raises(TypeError):
+        config_yaml["baudrate"] = 9600
+    with pytest.raises(AttributeError):
+        config_yaml["meters"].append({})
+
+
+def test_pickled_config_keeps_the_parsed_files(tmp_path):
+    # worker processes get the configuration of the gateway
+    config = configuration(
+        tmp_path, "baudrate: 9600\nmeters:\n  - {meterId: 1, port: /dev/ttyUSB0}\n"
+    )
+    config.yaml_config()
+    (tmp_path / "main_config.yaml").unlink()
+    config_yaml = pickle.loads(pickle.dumps(config)).yaml_config()
+    assert config_yaml["baudrate"] == 9600
+    with pytest.raises(TypeError):
+        config_yaml["meters"][0]["port"] = "/dev/ttyUSB1"
+
+
+def test_default_config_is_valid():
+    config_yaml = Configuration().yaml_config()
+    assert config_yaml["baudrate"] == 2400
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "baudrate: fast\n",
+        "batchSize: 0\n",
+        "printValue: 1\n",
+        "queueSize: True\n",
+        "meters:\n  - {meterId: 1}\n",
+        "sinks:\n  - {path: x.csv}\n",
+        "meterId: wärmepumpe-keller-hauptverteilung\n",
+        "meters:\n  - {meterId: wärmepumpe-keller-hauptverteilung, port: x}\n",
+        "obisCodes:\n  - {code: 1.0.32.36.0.255, name: Sag, column: sag; DROP TABLE smartmeter}\n",
+        "obisCodes:\n  - {code: 1.0.32.36.0.255, name: Sag, column: Sag}\n",
+        "obisCodes:\n  - {code: 1.0.32.36.0.255, name: Sag, column: sag, type: TEXT}\n",
+    ],
+)
+def test_invalid_config(tmp_path, text):
+    with pytest.raises(ConfigError):
+        configuration(tmp_path, text).yaml_config()
+
+
+def test_unknown_key_is_logged(tmp_path, caplog):
+    configuration(tmp_path, "batchsize: 10\n").yaml_config()
+    assert "unknown key batchsize" in caplog.text
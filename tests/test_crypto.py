@@ -0,0 +1,50 @@
+import pytest
+from Cryptodome.Cipher import AES
+from src.smartmeter import crypto
+from tests.helpers import EVN_DECRYPTED_APDU, EVN_ENCRYPTED_APDU, EVN_KEY
+
+TELEGRAM = bytes.fromhex(EVN_ENCRYPTED_APDU)
+
+
+def test_parse_telegram():
+    apdu = crypto.parse_telegram(TELEGRAM)
+    assert bytes(apdu.system_title) == bytes.fromhex("4B464D6750000009")
+    assert apdu.security_control == 0x20
+    assert bytes(apdu.frame_counter) == bytes.fromhex("00000023")
+    # long frame payload and short frame payload, without checksums and stop bytes
+    assert bytes(apdu.ciphertext) == TELEGRAM[26:254] + TELEGRAM[265:280]
+    assert apdu.tag is None
+
+
+def test_decrypt():
+    decryptor = crypto.ApduDecryptor(EVN_KEY)
+    apdu = decryptor.decrypt(crypto.parse_telegram(TELEGRAM))
+    assert apdu == bytes.fromhex(EVN_DECRYPTED_APDU)
+
+
+def test_decrypt_authenticated():
+    key = bytes.fromhex(EVN_KEY)
+    authentication_key = bytes(range(16))
+    system_title = bytes.fromhex("4B464D6750000009")
+    frame_counter = bytes.fromhex("00000024")
+    cipher = AES.new(key, AES.MODE_GCM, nonce=system_title + frame_counter, mac_len=12)
+    cipher.update(b"\x30" + authentication_key)
+    ciphertext, tag = cipher.encrypt_and_digest(bytes.fromhex(EVN_DECRYPTED_APDU))
+    apdu = crypto.SecuredApdu(
+        memoryview(system_title),
+        0x30,
+        memoryview(frame_counter),
+        memoryview(ciphertext),
+        memoryview(tag),
+    )
+    decryptor = crypto.ApduDecryptor(EVN_KEY, authentication_key.hex())
+    assert decryptor.decrypt(apdu) == bytes.fromhex(EVN_DECRYPTED_APDU)
+    with pytest.raises(ValueError):
+        decryptor.decrypt(apdu._replace(tag=memoryview(bytes(12))))
+
+
+def test_decrypt_telegram_duplicate(smartmeterpostgres):
+    decryptor = smartmeterpostgres.decryptor(EVN_KEY)
+    assert smartmeterpostgres.decrypt_telegram(TELEGRAM, decryptor) is not None
+    assert smartmeterpostgres.data["FrameCounter"] == 0x23
+    assert smartmeterpostgres.decrypt_telegram(TELEGRAM, decryptor) is None
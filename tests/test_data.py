@@ -1,33 +1,28 @@
+from datetime import datetime
+
+import psycopg2
 import pytest
-from src.smartmeter.postgresql_tasks import PostgresTasks
 from src.smartmeter.config import Configuration
-from src.smartmeter.data import SmartmeterToPostgres
-
-
-# create instance of Class SmartmeterToPostgres
-@pytest.fixture
-def smartmeterpostgres():
-    config = Configuration()
-    client = PostgresTasks()
-    return SmartmeterToPostgres(config, client)
-
-
-# evn test  based on the official documentation "218_13_SmartMeter_Kundenschnittstelle_2604_web.pdf"
-@pytest.fixture
-def evn_smartmeterpostgres(smartmeterpostgres):
-    smartmeterpostgres.config_env["evn_key"] = "36C66639E48A8CA4D6BC8B282A793BBB"
-    return smartmeterpostgres
+from src.smartmeter.data import SmartmeterToPostgres, print_values
+from src.smartmeter.framecounter import FrameCounterTracker
+from src.smartmeter.obis import DEFAULT_FIELDS, ObisField, ObisRegistry, parse_code
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from src.smartmeter.spool import Spool, SpoolDrainer
+from tests.helpers import (
+    EVN_DECRYPTED_APDU,
+    EVN_ENCRYPTED_APDU,
+    EVN_KEY,
+    MY_DECRYPTED_APDU,
+    row,
+)
 
 
 @pytest.fixture
 def evn_sample_data():
-    evn_encrypted_apdu = "68FAFA6853FF000167DB084B464D675000000981F8200000002388D5AB4F97515AAFC6B88D2F85DAA7A0E3C0C40D004535C397C9D037AB7DBDA329107615444894A1A0DD7E85F02D496CECD3FF46AF5FB3C9229CFE8F3EE4606AB2E1F409F36AAD2E50900A4396FC6C2E083F373233A69616950758BFC7D63A9E9B6E99E21B2CBC2B934772CA51FD4D69830711CAB1F8CFF25F0A329337CBA51904F0CAED88D61968743C8454BA922EB00038182C22FE316D16F2A9F544D6F75D51A4E92A1C4EF8AB19A2B7FEAA32D0726C0ED80229AE6C0F7621A4209251ACE2B2BC66FF0327A653BB686C756BE033C7A281F1D2A7E1FA31C3983E15F8FD16CC5787E6F517166814146853FF110167419A3CFDA44BE438C96F0E38BF83D98316"
-    evn_decrypted_apdu = "0F8006870E0C07E5091B01092F0F00FF88800223090C07E5091B01092F0F00FF888009060100010800FF060000328902020F00161E09060100020800FF060000000002020F00161E09060100010700FF060000000002020F00161B09060100020700FF060000000002020F00161B09060100200700FF12092102020FFF162309060100340700FF12000002020FFF162309060100480700FF12000002020FFF1623090601001F0700FF12000002020FFE162109060100330700FF12000002020FFE162109060100470700FF12000002020FFE1621090601000D0700FF1203E802020FFD16FF090C313831323230303030303039"
-    my_decrypted_apdu = "0f8006870e0c07e5091b01092f0f00ff88800223090c07e5091b01092f0f00ff888009060100010800ff060000328902020f00161e09060100020800ff060000000002020f00161e09060100010700ff060000000002020f00161b09060100020700ff060000000002020f00161b09060100200700ff12092102020fff162309060100340700ff12000002020fff162309060100480700ff12000002020fff1623090601001f0700ff12000002020ffe162109060100330700ff12000002020ffe162109060100470700ff12000002020ffe1621090601000d0700ff1203e802020ffd16a985"
     return {
-        "evn_encrypted_apdu": evn_encrypted_apdu,
-        "evn_decrypted_apdu": evn_decrypted_apdu,
-        "my_decrypted_apdu": my_decrypted_apdu,
+        "evn_encrypted_apdu": EVN_ENCRYPTED_APDU,
+        "evn_decrypted_apdu": EVN_DECRYPTED_APDU,
+        "my_decrypted_apdu": MY_DECRYPTED_APDU,
     }
 
 
@@ -91,3 +86,77 @@ def test_translate_dlms_2(evn_smartmeterpostgres, evn_sample_data):
 def test_translate_dlms_3(evn_smartmeterpostgres, evn_sample_data):
     evn_smartmeterpostgres.translate_dlms(evn_sample_data["my_decrypted_apdu"])
     assert evn_smartmeterpostgres.data["WirkenergieP"] == 12937
+
+
+def test_translate_dlms_xml(evn_smartmeterpostgres, evn_sample_data):
+    native = evn_smartmeterpostgres.decode_apdu(evn_sample_data["evn_decrypted_apdu"])
+    xml = evn_smartmeterpostgres.decode_apdu_xml(evn_sample_data["evn_decrypted_apdu"])
+    assert {obis: value[0] for obis, value in native.items()} == {
+        obis: value[0] for obis, value in xml.items()
+    }
+
+
+def test_reading_with_missing_obis_code(evn_smartmeterpostgres, capsys):
+    decoder = evn_smartmeterpostgres
+    # configured in obisCodes, but not sent by the meter
+    decoder.registry = ObisRegistry(
+        DEFAULT_FIELDS
+        + (
+            ObisField(
+                parse_code("1.0.3.8.0.255"), "BlindenergieP", "blindenergie_p", "BIGINT"
+            ),
+        )
+    )
+    assert decoder.process_telegram(
+        bytes.fromhex(EVN_ENCRYPTED_APDU), decoder.decryptor(EVN_KEY)
+    )
+    reading = decoder.reading(datetime(2023, 5, 1, 12))
+    assert reading.values[0] == 12937
+    assert reading.values[-1] is None
+    print_values(dict(zip(decoder.registry.names, reading.values)))
+    assert "Wirkenergie Bezug [Wh]:\t 12937" in capsys.readouterr().out
+    print_values({})
+    assert "Wirkleistunggesamt [w]:\t\t -" in capsys.readouterr().out
+
+
+def test_frame_counter_kept_for_undecryptable_telegram(evn_smartmeterpostgres):
+    decoder = evn_smartmeterpostgres
+    decoder.frame_counters = FrameCounterTracker()
+    telegram = bytes.fromhex(EVN_ENCRYPTED_APDU)
+    # a wrong key gives no data, the telegram is not remembered as seen
+    assert not decoder.process_telegram(telegram, decoder.decryptor("00" * 16))
+    assert decoder.frame_counters.counters == {}
+    assert decoder.process_telegram(telegram, decoder.decryptor(EVN_KEY))
+    assert not decoder.process_telegram(telegram, decoder.decryptor(EVN_KEY))
+
+
+def test_decoder_without_database_ini(tmp_path):
+    # replay --dry-run, workers and file-only sinks need no database
+    config = Configuration(url_to_database=str(tmp_path / "missing.ini"))
+    decoder = SmartmeterToPostgres(config, PostgresTasks(config))
+    assert decoder.writer is None
+
+
+def test_close_writer_stops_spool_drainer(smartmeterpostgres, tmp_path):
+    class Writer:
+        closed = False
+
+        def copy(self, rows):
+            raise psycopg2.OperationalError("connection refused")
+
+        def close(self):
+            self.closed = True
+
+    writer = Writer()
+    smartmeterpostgres.writer = writer
+    smartmeterpostgres.spool = spool = Spool(str(tmp_path))
+    smartmeterpostgres.drainer = drainer = SpoolDrainer(spool, writer, interval=0.01)
+    drainer.start()
+    smartmeterpostgres.store_row(row(1))
+    smartmeterpostgres.close_writer()
+    assert not drainer.is_alive()
+    assert spool.file.closed
+    assert writer.closed
+    assert smartmeterpostgres.writer is None
+    # the row stays spooled for the next start
+    assert Spool(str(tmp_path)).read(10)[0] == [row(1)]
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import pytest
+from src.smartmeter import dlms
+from tests.helpers import EVN_DECRYPTED_APDU, MY_DECRYPTED_APDU
+
+WIRKENERGIE_P = bytes.fromhex("0100010800FF")
+SPANNUNG_L1 = bytes.fromhex("0100200700FF")
+LEISTUNGSFAKTOR = bytes.fromhex("01000D0700FF")
+
+
+def test_decode_notification_1():
+    values = dlms.decode_notification(bytes.fromhex(EVN_DECRYPTED_APDU))
+    assert values[WIRKENERGIE_P] == (12937, 0, 0x1E)
+    assert values[SPANNUNG_L1] == (2337, -1, 0x23)
+    assert values[LEISTUNGSFAKTOR] == (1000, -3, 0xFF)
+    assert len(values) == 11
+
+
+def test_decode_notification_truncated():
+    apdu = bytes.fromhex(EVN_DECRYPTED_APDU)
+    values = dlms.decode_notification(apdu[:-60])
+    assert values[WIRKENERGIE_P] == (12937, 0, 0x1E)
+    assert LEISTUNGSFAKTOR not in values
+
+
+def test_decode_notification_trailing_garbage():
+    with pytest.raises(dlms.DlmsDecodeError) as err:
+        dlms.decode_notification(bytes.fromhex(MY_DECRYPTED_APDU))
+    assert err.value.values[LEISTUNGSFAKTOR][0] == 1000
+
+
+def test_decode_notification_no_notification():
+    with pytest.raises(dlms.DlmsDecodeError):
+        dlms.decode_notification(bytes.fromhex("C401C100"))
+
+
+def test_parse_utc_datetime():
+    # 2021-09-27 09:47:15, deviation -120 minutes, daylight saving active
+    octets = bytes.fromhex("07E5091B01092F0F00FF8880")
+    assert dlms.parse_datetime(octets) == datetime(2021, 9, 27, 9, 47, 15)
+    assert dlms.parse_utc_datetime(octets) == datetime(2021, 9, 27, 7, 47, 15)
+    assert dlms.notification_utc(bytes.fromhex(EVN_DECRYPTED_APDU)) == datetime(
+        2021, 9, 27, 7, 47, 15
+    )
+    # clock marked invalid
+    assert dlms.parse_utc_datetime(octets[:11] + b"\x01") is None
+    # winter time
+    winter = bytes.fromhex("07E50C0101092F0F00FFC400")
+    assert dlms.parse_utc_datetime(winter) == datetime(2021, 12, 1, 8, 47, 15)
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+from src.smartmeter import engine
+from src.smartmeter.config import Configuration
+from src.smartmeter.engine import DecodeEngine
+from tests.helpers import EVN_ENCRYPTED_APDU, EVN_KEY
+
+TELEGRAM = bytes.fromhex(EVN_ENCRYPTED_APDU)
+
+
+def test_decode_chunk():
+    engine.init_engine_worker(Configuration(), {"haus": EVN_KEY})
+    batch = engine.decode_chunk("haus", [TELEGRAM, TELEGRAM[:200]], [None, None])
+    assert len(batch) == 1
+    time, meter_id, frame_counter, wirkenergie_p = next(batch.rows())[:4]
+    assert meter_id == "haus"
+    assert frame_counter == 0x23
+    assert wirkenergie_p == 12937
+    # 09:47:15 with a deviation of -120 minutes (CEST)
+    assert time == datetime(2021, 9, 27, 7, 47, 15)
+
+
+def test_chunks_keep_the_order_per_meter():
+    chunks = DecodeEngine(
+        Configuration(), {"a": EVN_KEY, "b": EVN_KEY}, workers=0, chunk_size=2
+    ).chunks(
+        [
+            ("a", b"1", None),
+            ("b", b"2", None),
+            ("a", b"3", None),
+            ("b", b"4", None),
+            ("a", b"5", None),
+        ]
+    )
+    assert [(meter_id, telegrams) for meter_id, telegrams, _ in chunks] == [
+        ("a", [b"1", b"3"]),
+        ("b", [b"2", b"4"]),
+        ("a", [b"5"]),
+    ]
+
+
+def test_decode_in_workers():
+    time = datetime(2023, 5, 1, 12)
+    frames = [("haus", TELEGRAM, time)] * 5 + [("haus", TELEGRAM[:200], time)]
+    with DecodeEngine(
+        Configuration(), {"haus": EVN_KEY}, workers=2, chunk_size=2
+    ) as pool:
+        batches = list(pool.decode(frames))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    # useMeterTime: stamped with the date-time sent by the meter
+    assert {reading.time for batch in batches for reading in batch.readings()} == {
+        datetime(2021, 9, 27, 7, 47, 15)
+    }
+
+
+def test_worker_decryptors_get_the_authentication_key():
+    engine.init_engine_worker(
+        Configuration(), {"a": EVN_KEY, "b": EVN_KEY}, {"b": "00" * 16}
+    )
+    assert engine.engine_decryptors["a"].authentication_key is None
+    assert engine.engine_decryptors["b"].authentication_key == bytes(16)
@@ -0,0 +1,64 @@
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from src.smartmeter import export
+from src.smartmeter.export import ReadingReader
+from tests.helpers import row
+
+
+def test_parse_bucket():
+    assert export.parse_bucket(900) == 900
+    assert export.parse_bucket("15min") == 900
+    assert export.parse_bucket("1h") == 3600
+    assert export.parse_bucket("1d") == 86400
+    with pytest.raises(ValueError):
+        export.parse_bucket("0s")
+    with pytest.raises(ValueError):
+        export.parse_bucket("1 week")
+
+
+def test_month_ranges_follow_the_partitions():
+    assert list(
+        export.month_ranges(datetime(2023, 11, 15, 6), datetime(2024, 1, 2))
+    ) == [
+        (datetime(2023, 11, 15, 6), datetime(2023, 12, 1)),
+        (datetime(2023, 12, 1), datetime(2024, 1, 1)),
+        (datetime(2024, 1, 1), datetime(2024, 1, 2)),
+    ]
+
+
+def test_query_downsamples_like_the_rollups():
+    reader = ReadingReader({})
+    sql = reader.query(bucket=900, meter_id="haus")
+    assert "max(wirkenergie_p) AS wirkenergie_p" in sql
+    assert "avg(spannung_l1)::FLOAT4 AS spannung_l1" in sql
+    assert "meter_id = %(meter_id)s" in sql
+    assert reader.columns(900)[:3] == ("time", "meter_id", "samples")
+    # a downsampled range is queried at once
+    assert reader.ranges(datetime(2023, 1, 1), datetime(2024, 1, 1), 900) == [
+        (datetime(2023, 1, 1), datetime(2024, 1, 1))
+    ]
+    assert "meter_id =" not in reader.query()
+
+
+def test_ndjson_from_chunks(monkeypatch):
+    reader = ReadingReader({})
+    columns = reader.columns()
+
+    def chunks(*args):
+        yield dict(zip(columns, map(list, zip(row(1), row(2)))))
+
+    monkeypatch.setattr(reader, "chunks", chunks)
+    file = io.StringIO()
+    assert export.write_ndjson(reader.chunks(), file) == 2
+    record = json.loads(file.getvalue().splitlines()[1])
+    assert record["time"] == "2023-05-01T12:00:10.250000"
+    assert record["frame_counter"] == 2
+
+
+def test_parse_time_converts_to_utc():
+    assert export.parse_time("2023-05-01T14:00+02:00") == datetime(2023, 5, 1, 12)
+    assert export.parse_time("2023-05-01") == datetime(2023, 5, 1)
@@ -0,0 +1,34 @@
+from src.smartmeter.framecounter import FrameCounterTracker
+
+SYSTEM_TITLE = bytes.fromhex("4B464D6750000009")
+
+
+def test_duplicates_and_lost():
+    tracker = FrameCounterTracker()
+    assert tracker.is_new(SYSTEM_TITLE, 10)
+    tracker.update(SYSTEM_TITLE, 10)
+    assert not tracker.is_new(SYSTEM_TITLE, 10)
+    assert not tracker.is_new(SYSTEM_TITLE, 9)
+    assert tracker.is_new(SYSTEM_TITLE, 13)
+    tracker.update(SYSTEM_TITLE, 13)
+    assert tracker.duplicates == 2
+    assert tracker.lost == 2
+    # other meters are tracked separately
+    assert tracker.is_new(bytes(8), 1)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "frame_counters.json")
+    tracker = FrameCounterTracker(path)
+    tracker.update(SYSTEM_TITLE, 35)
+    tracker.close()
+    assert not FrameCounterTracker(path).is_new(SYSTEM_TITLE, 35)
+    assert FrameCounterTracker(path).is_new(SYSTEM_TITLE, 36)
+
+
+def test_update_keeps_the_highest_counter():
+    tracker = FrameCounterTracker()
+    tracker.update(SYSTEM_TITLE, 12)
+    tracker.update(SYSTEM_TITLE, 11)
+    assert not tracker.is_new(SYSTEM_TITLE, 12)
+    assert tracker.counters[SYSTEM_TITLE] == 12
@@ -0,0 +1,122 @@
+from datetime import datetime
+
+import pytest
+from Cryptodome.Cipher import AES
+from src.smartmeter.config import Configuration
+from src.smartmeter.gateway import Gateway
+from src.smartmeter.postgresql_tasks import PostgresTasks
+from tests.helpers import EVN_DECRYPTED_APDU, EVN_ENCRYPTED_APDU, EVN_KEY
+
+
+def test_meter_configs(gateway):
+    assert [meter["meterId"] for meter in gateway.meters] == ["1", "zwei"]
+    assert [meter["key"] for meter in gateway.meters] == [EVN_KEY, EVN_KEY]
+    assert [meter["baudrate"] for meter in gateway.meters] == [2400, 9600]
+
+
+def test_meter_configs_missing_key(tmp_path):
+    url_yaml_config = tmp_path / "main_config.yaml"
+    url_yaml_config.write_text(
+        "baudrate: 2400\n"
+        "meters:\n"
+        "  - {meterId: 3, port: /dev/ttyUSB0, keyEnv: NOT_SET}\n"
+    )
+    config = Configuration(url_yaml_config=url_yaml_config)
+    with pytest.raises(Exception):
+        Gateway(config, PostgresTasks(config))
+
+
+def test_reading_meter_id(gateway):
+    telegram = bytes.fromhex(EVN_ENCRYPTED_APDU)
+    assert gateway.decoder.process_telegram(telegram, gateway.meters[0]["decryptor"])
+    row = gateway.decoder.reading(None, "zwei").row()
+    assert row[1] == "zwei"
+    assert row[3] == 12937
+
+
+class InterruptedPipeline:
+    """hands one telegram to the sinks, then stops like Ctrl-C"""
+
+    def __init__(self, decoder, meters, sinks, **kwargs) -> None:
+        self.decoder, self.meters, self.sinks = decoder, meters, sinks
+
+    def run(self) -> None:
+        meter = self.meters[0]
+        telegram = bytes.fromhex(EVN_ENCRYPTED_APDU)
+        assert self.decoder.process_telegram(telegram, meter["decryptor"])
+        self.sinks.put(self.decoder.reading(datetime(2023, 5, 1), meter["meterId"]))
+        raise KeyboardInterrupt
+
+
+def test_run_stops_sinks_on_interrupt(tmp_path, monkeypatch):
+    url_yaml_config = tmp_path / "main_config.yaml"
+    url_yaml_config.write_text(
+        "baudrate: 2400\n"
+        "port: /dev/ttyUSB0\n"
+        "meterId: haus\n"
+        f"frameCounterFile: {tmp_path / 'frame_counters.json'}\n"
+        "sinks:\n"
+        f"  - {{type: ndjson, path: {tmp_path / 'readings.ndjson'}, batchSize: 100, batchMaxAge: 3600}}\n"
+    )
+    monkeypatch.setenv("EVN_SCHLUESSEL", EVN_KEY)
+    monkeypatch.setattr("src.smartmeter.gateway.Pipeline", InterruptedPipeline)
+    config = Configuration(url_yaml_config=url_yaml_config)
+    with pytest.raises(KeyboardInterrupt):
+        Gateway(config, PostgresTasks(config)).run()
+    # the buffered reading was written and the frame counter saved
+    assert len((tmp_path / "readings.ndjson").read_text().splitlines()) == 1
+    assert (tmp_path / "frame_counters.json").exists()
+
+
+def mbus_telegram(payload: bytes, size: int = 200) -> bytes:
+    """the payload in long M-Bus frames of at most size bytes each"""
+    frames = []
+    for start in range(0, len(payload), size):
+        data = b"\x53\xff\x00\x67\xdb" + payload[start : start + size]
+        frames.append(
+            bytes([0x68, len(data), len(data), 0x68])
+            + data
+            + bytes([sum(data) & 0xFF, 0x16])
+        )
+    return b"".join(frames)
+
+
+def tagged_telegram(authentication_key: bytes) -> bytes:
+    """the EVN sample, authenticated and encrypted (security control 0x30)"""
+    system_title = bytes.fromhex("4B464D6750000009")
+    frame_counter = bytes.fromhex("00000024")
+    cipher = AES.new(
+        bytes.fromhex(EVN_KEY),
+        AES.MODE_GCM,
+        nonce=system_title + frame_counter,
+        mac_len=12,
+    )
+    cipher.update(b"\x30" + authentication_key)
+    ciphertext, tag = cipher.encrypt_and_digest(bytes.fromhex(EVN_DECRYPTED_APDU))
+    secured = b"\x30" + frame_counter + ciphertext + tag
+    return mbus_telegram(
+        b"\xdb\x08" + system_title + b"\x82" + len(secured).to_bytes(2, "big") + secured
+    )
+
+
+def test_authentication_key(tmp_path, monkeypatch):
+    authentication_key = bytes(range(16))
+    monkeypatch.setenv("EVN_AUTH_SCHLUESSEL", authentication_key.hex())
+    url_yaml_config = tmp_path / "main_config.yaml"
+    url_yaml_config.write_text(
+        "baudrate: 2400\n"
+        "meters:\n"
+        f"  - {{meterId: haus, port: /dev/ttyUSB0, key: {EVN_KEY}, authenticationKeyEnv: EVN_AUTH_SCHLUESSEL}}\n"
+        f"  - {{meterId: falsch, port: /dev/ttyUSB1, key: {EVN_KEY}, authenticationKey: '{'00' * 16}'}}\n"
+    )
+    config = Configuration(url_yaml_config=url_yaml_config)
+    gateway = Gateway(config, PostgresTasks(config))
+    haus, falsch = gateway.meters
+    assert haus["authenticationKey"] == authentication_key.hex()
+    telegram = tagged_telegram(authentication_key)
+    assert gateway.decoder.process_telegram(telegram, haus["decryptor"])
+    assert gateway.decoder.data["FrameCounter"] == 0x24
+    assert gateway.decoder.data["WirkenergieP"] == 12937
+    # the tag does not match with another authentication key
+    gateway.decoder.frame_counters = None
+    assert not gateway.decoder.process_telegram(telegram, falsch["decryptor"])
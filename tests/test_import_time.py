@@ -0,0 +1,42 @@
+import subprocess
+import sys
+
+from dev.definitions import ROOT_DIR
+
+# cumulative import time of the gateway, about 120 ms on a desktop
+IMPORT_BUDGET_MS = 400
+# only needed by the Gurux fallback decoder or not at all
+LAZY_MODULES = ("gurux_dlms", "bs4", "xml.etree.ElementTree", "http.server")
+
+
+def run_python(code: str, *options: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *options, "-c", code],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_time_ms(module: str) -> float:
+    """cumulative import time of module in a fresh interpreter"""
+    stderr = run_python(f"import {module}", "-X", "importtime").stderr
+    # import time: self [us] | cumulative | imported package
+    for line in stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000
+    raise AssertionError(f"{module} not imported")
+
+
+def test_heavy_modules_are_imported_lazily():
+    code = "import sys, src.smartmeter.gateway; print(sorted(sys.modules))"
+    modules = set(eval(run_python(code).stdout))
+    assert not modules.intersection(LAZY_MODULES)
+
+
+def test_import_time_budget():
+    # the best of three runs, the first one may read from a cold disk
+    best = min(import_time_ms("src.smartmeter.gateway") for _ in range(3))
+    assert best < IMPORT_BUDGET_MS
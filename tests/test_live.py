@@ -0,0 +1,47 @@
+import struct
+from datetime import timedelta
+
+import pytest
+
+from src.smartmeter import live
+from src.smartmeter.live import LivePublisher, LiveReader
+from src.smartmeter.obis import DEFAULT_REGISTRY
+from tests.helpers import TIME, reading
+
+
+def test_publish_and_read(tmp_path):
+    path = str(tmp_path / "live" / "haus.live")
+    publisher = LivePublisher(path)
+    reader = LiveReader(path)
+    assert reader.read() is None
+    publisher.publish(reading(1, MomentanleistungN=None))
+    latest = reader.read()
+    assert latest.time == TIME + timedelta(seconds=5)
+    assert (latest.meter_id, latest.frame_counter, latest.sequence) == ("haus", 1, 2)
+    assert latest.values["WirkenergieP"] == 12938
+    assert latest.values["SpannungL1"] == pytest.approx(230.1)
+    assert latest.values["MomentanleistungN"] is None
+    assert reader.wait(latest.sequence, timeout=0) is None
+    publisher.publish(reading(2))
+    assert reader.wait(latest.sequence, timeout=0).frame_counter == 2
+    publisher.close()
+    # a restart continues the sequence
+    publisher = LivePublisher(path)
+    publisher.publish(reading(3))
+    assert reader.read().sequence == 6
+
+
+def test_read_retries_while_written(tmp_path):
+    path = str(tmp_path / "haus.live")
+    publisher = LivePublisher(path)
+    publisher.publish(reading(1))
+    # the writer stopped in the middle of a publish
+    at = live.sequence_offset(len(DEFAULT_REGISTRY.names))
+    struct.pack_into("<Q", publisher.map, at, 3)
+    with pytest.raises(TimeoutError):
+        LiveReader(path).read(retries=3)
+    # a torn slot is caught by the CRC
+    struct.pack_into("<Q", publisher.map, at, 4)
+    publisher.map[at + 8] ^= 0xFF
+    with pytest.raises(TimeoutError):
+        LiveReader(path).read(retries=3)
@@ -0,0 +1,39 @@
+import logging
+
+from src.smartmeter.logs import Fields, HexBytes, RateLimitedLog, event
+
+
+class Unformattable:
+    def __str__(self):
+        raise AssertionError("formatted although the level is disabled")
+
+
+def test_disabled_levels_do_not_format(caplog):
+    caplog.set_level(logging.WARNING)
+    logging.debug("apdu: %s", Unformattable())
+    event(logging.DEBUG, "telegram decrypted", apdu=Unformattable())
+    assert caplog.records == []
+
+
+def test_event_fields(caplog):
+    caplog.set_level(logging.DEBUG)
+    event(
+        logging.DEBUG,
+        "telegram decrypted",
+        frame_counter=35,
+        apdu=HexBytes(b"\x0f\x80"),
+    )
+    assert caplog.messages == ["telegram decrypted frame_counter=35 apdu=0f80"]
+    assert caplog.records[0].fields["frame_counter"] == 35
+    assert str(Fields("no fields", {})) == "no fields"
+
+
+def test_rate_limited(caplog):
+    limited = RateLimitedLog(interval=60)
+    for i in range(5):
+        limited.warning("telegram dropped: %s", i)
+    limited.warning("other message")
+    assert caplog.messages == ["telegram dropped: 0", "other message"]
+    limited.interval = 0
+    limited.warning("telegram dropped: %s", 5)
+    assert caplog.messages[-1] == "telegram dropped: 5 (4 more in the last 0 s)"
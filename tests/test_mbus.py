@@ -0,0 +1,37 @@
+from src.smartmeter.mbus import MbusFramer
+from tests.helpers import EVN_ENCRYPTED_APDU
+
+TELEGRAM = bytes.fromhex(EVN_ENCRYPTED_APDU)
+LONG_FRAME = TELEGRAM[:256]
+SHORT_FRAME = TELEGRAM[256:]
+
+
+def test_feed_complete_telegram():
+    framer = MbusFramer()
+    assert framer.feed(TELEGRAM) == [TELEGRAM]
+
+
+def test_feed_in_chunks_after_garbage():
+    framer = MbusFramer()
+    stream = bytes.fromhex("0016680A68") + TELEGRAM + TELEGRAM
+    telegrams = []
+    for i in range(0, len(stream), 7):
+        telegrams += framer.feed(stream[i : i + 7])
+    assert telegrams == [TELEGRAM, TELEGRAM]
+    assert framer.skipped == 5
+    assert framer.buffer == bytearray()
+
+
+def test_feed_wrong_checksum():
+    framer = MbusFramer()
+    broken = bytearray(LONG_FRAME)
+    broken[100] ^= 0xFF
+    assert framer.feed(bytes(broken) + SHORT_FRAME + TELEGRAM) == [TELEGRAM]
+    assert framer.checksum_errors == 1
+    assert framer.incomplete == 0
+
+
+def test_feed_lost_segment():
+    framer = MbusFramer()
+    assert framer.feed(LONG_FRAME + TELEGRAM) == [TELEGRAM]
+    assert framer.incomplete == 1
@@ -0,0 +1,54 @@
+import urllib.request
+
+from src.smartmeter.data import TELEGRAMS
+from src.smartmeter.metrics import MetricsRegistry, serve_metrics
+from tests.helpers import EVN_ENCRYPTED_APDU, EVN_KEY
+
+TELEGRAM = bytes.fromhex(EVN_ENCRYPTED_APDU)
+
+
+def test_render():
+    registry = MetricsRegistry()
+    telegrams = registry.counter("telegrams_total", "telegrams", ("result",))
+    telegrams.inc("decoded")
+    telegrams.inc("decoded")
+    telegrams.inc("duplicate")
+    seconds = registry.histogram("seconds", "latency", buckets=(0.1, 1.0))
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    seconds.observe(5.0)
+    registry.callback("depth", "queue depth", lambda: 3)
+    lines = registry.render().splitlines()
+    assert "# TYPE telegrams_total counter" in lines
+    assert 'telegrams_total{result="decoded"} 2' in lines
+    assert 'seconds_bucket{le="0.1"} 1' in lines
+    assert 'seconds_bucket{le="1.0"} 2' in lines
+    assert 'seconds_bucket{le="+Inf"} 3' in lines
+    assert "seconds_sum 5.55" in lines
+    assert "seconds_count 3" in lines
+    assert "depth 3" in lines
+    summary = registry.summary()
+    assert summary["telegrams_total"] == 3
+    assert summary["seconds"] == {"count": 3, "p50": 1.0, "p99": float("inf")}
+
+
+def test_decoder_counts_telegrams(smartmeterpostgres):
+    decryptor = smartmeterpostgres.decryptor(EVN_KEY)
+    decoded = TELEGRAMS.value("decoded")
+    duplicates = TELEGRAMS.value("duplicate")
+    assert smartmeterpostgres.process_telegram(TELEGRAM, decryptor)
+    assert not smartmeterpostgres.process_telegram(TELEGRAM, decryptor)
+    assert TELEGRAMS.value("decoded") == decoded + 1
+    assert TELEGRAMS.value("duplicate") == duplicates + 1
+
+
+def test_serve_metrics():
+    registry = MetricsRegistry()
+    registry.counter("telegrams_total", "telegrams").inc()
+    server = serve_metrics(0, registry=registry)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert "telegrams_total 1" in response.read().decode()
+    finally:
+        server.shutdown()
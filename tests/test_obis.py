@@ -0,0 +1,47 @@
+import pytest
+from src.smartmeter import dlms
+from src.smartmeter.obis import DEFAULT_REGISTRY, ObisRegistry, parse_code
+from tests.helpers import EVN_DECRYPTED_APDU
+
+
+def test_parse_code():
+    expected = bytes.fromhex("0100200700FF")
+    assert parse_code("1.0.32.7.0.255") == expected
+    assert parse_code("1-0:32.7.0*255") == expected
+    assert parse_code("0100200700ff") == expected
+    with pytest.raises(ValueError):
+        parse_code("1.0.32.7")
+
+
+def test_extract_uses_meter_scaler():
+    data = DEFAULT_REGISTRY.extract(
+        dlms.decode_notification(bytes.fromhex(EVN_DECRYPTED_APDU))
+    )
+    assert data["WirkenergieP"] == 12937
+    assert data["SpannungL1"] == pytest.approx(233.7)
+    assert data["Leistungsfaktor"] == pytest.approx(1.0)
+    # without a scaler from the meter (Gurux fallback) the default is used
+    code = parse_code("1.0.31.7.0.255")
+    assert DEFAULT_REGISTRY.extract({code: (123, None, None)}) == {"StromL1": 1.23}
+    assert DEFAULT_REGISTRY.extract({code: (123, -1, 33)}) == {"StromL1": 12.3}
+
+
+def test_from_config():
+    registry = ObisRegistry.from_config(
+        {
+            "obisCodes": [
+                {
+                    "code": "1.0.3.8.0.255",
+                    "name": "BlindenergieP",
+                    "column": "blindenergie_p",
+                    "type": "BIGINT",
+                }
+            ]
+        }
+    )
+    assert registry.row_columns[-1] == "blindenergie_p"
+    assert registry.names[:-1] == DEFAULT_REGISTRY.names
+    code = parse_code("1.0.3.8.0.255")
+    # integer columns stay integers after scaling
+    assert registry.extract({code: (12345, 1, 32)}) == {"BlindenergieP": 123450}
+    assert "blindenergie_p BIGINT" in registry.column_definitions()
@@ -0,0 +1,169 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import monotonic, sleep
+
+import pytest
+import serial
+
+from src.smartmeter.framecounter import FrameCounterTracker
+from src.smartmeter.metrics import METRICS
+from src.smartmeter.pipeline import Pipeline, SerialReader
+from tests.helpers import EVN_ENCRYPTED_APDU
+
+TELEGRAM = bytes.fromhex(EVN_ENCRYPTED_APDU)
+TIME = datetime(2023, 5, 1, 12, 0, 0)
+METER_TIME = datetime(2021, 9, 27, 7, 47, 15)
+
+
+# sinks which record the readings
+class FakeSinks:
+    def __init__(self) -> None:
+        self.readings = []
+
+    def put(self, reading):
+        self.readings.append(reading)
+
+    def stats(self):
+        return {}
+
+
+def run_pipeline(pipeline: Pipeline, chunks: list[bytes]) -> None:
+    async def scenario():
+        pipeline.start()
+        for chunk in chunks:
+            pipeline.receive(pipeline.meters[1], chunk, monotonic(), TIME)
+        await pipeline.drain()
+        for task in pipeline.tasks:
+            task.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_pipeline_stores_rows(gateway):
+    sinks = FakeSinks()
+    pipeline = Pipeline(gateway.decoder, gateway.meters, sinks)
+    # a telegram split across reads, followed by a duplicate of it
+    run_pipeline(pipeline, [TELEGRAM[:100], TELEGRAM[100:], TELEGRAM])
+    assert len(sinks.readings) == 1
+    # stamped with the clock of the meter (09:47:15 CEST)
+    assert sinks.readings[0].row()[:4] == (METER_TIME, "zwei", 0x23, 12937)
+    stats = pipeline.stats()
+    assert stats["read"]["processed"] == 3
+    assert stats["frame"]["processed"] == 2
+    assert stats["store"]["processed"] == 1
+    assert stats["store"]["depth"] == 0
+    metrics = METRICS.render().splitlines()
+    assert 'smartmeter_pipeline_processed_total{stage="store"} 1' in metrics
+    assert 'smartmeter_mbus_frames_total{meter="zwei"} 4' in metrics
+
+
+def test_reader_never_waits(gateway):
+    pipeline = Pipeline(gateway.decoder, gateway.meters, FakeSinks(), queue_size=2)
+
+    async def scenario():
+        pipeline.start()
+        for task in pipeline.tasks:
+            task.cancel()
+        for _ in range(5):
+            pipeline.receive(pipeline.meters[0], TELEGRAM, monotonic(), TIME)
+
+    asyncio.run(scenario())
+    assert pipeline.stats()["read"]["dropped"] == 3
+    assert pipeline.stats()["read"]["depth"] == 2
+
+
+def with_frame_counter(frame_counter: int) -> bytes:
+    # the checksum is not fixed, the telegram is handed to the decode stage directly
+    return TELEGRAM[:22] + frame_counter.to_bytes(4, "big") + TELEGRAM[26:]
+
+
+def test_worker_telegram_reserved_when_dispatched(gateway):
+    gateway.decoder.frame_counters = FrameCounterTracker()
+    pipeline = Pipeline(gateway.decoder, gateway.meters, FakeSinks())
+    assert pipeline.reserve(TELEGRAM)
+    # a copy received before the first one is decoded
+    assert not pipeline.reserve(TELEGRAM)
+    assert pipeline.reserve(with_frame_counter(0x24))
+
+
+def test_workers_keep_the_order_of_a_meter(gateway, monkeypatch):
+    gateway.decoder.frame_counters = FrameCounterTracker()
+    sinks = FakeSinks()
+    pipeline = Pipeline(gateway.decoder, gateway.meters, sinks, workers=2)
+
+    # the first telegram takes longest, the workers finish out of order
+    def decode_in_worker(key, authentication_key, telegram, time, meter_id):
+        frame_counter = int.from_bytes(telegram[22:26], "big")
+        sleep(0.05 * (4 - frame_counter))
+        return frame_counter
+
+    monkeypatch.setattr("src.smartmeter.pipeline.decode_in_worker", decode_in_worker)
+    monkeypatch.setattr(gateway.decoder, "publish", lambda reading: None)
+    finished = []
+
+    async def scenario():
+        pipeline.start()
+        pipeline.pool.shutdown()
+        pipeline.pool = ThreadPoolExecutor(2)
+        original = pipeline.loop.run_in_executor
+
+        def run_in_executor(*args):
+            future = original(*args)
+            future.add_done_callback(lambda done: finished.append(done.result()))
+            return future
+
+        pipeline.loop.run_in_executor = run_in_executor
+        meter = pipeline.meters[1]
+        for frame_counter in (1, 2, 2, 3):
+            telegram = with_frame_counter(frame_counter)
+            await pipeline.telegrams.put((meter, telegram, monotonic(), TIME))
+        await pipeline.drain()
+        for task in pipeline.tasks:
+            task.cancel()
+        pipeline.pool.shutdown()
+
+    asyncio.run(scenario())
+    assert finished != [1, 2, 3]
+    # the duplicate is dropped although the first copy was still decoded
+    assert sinks.readings == [1, 2, 3]
+
+
+# a port which fails on the first read, like an unplugged USB adapter
+class FailingSerial:
+    opened = 0
+
+    def __init__(self, **kwargs) -> None:
+        FailingSerial.opened += 1
+        self.in_waiting = 0
+        self.closed = False
+
+    def read(self, size):
+        if FailingSerial.opened == 1:
+            raise serial.SerialException(
+                "device reports readiness to read but returned no data"
+            )
+        return TELEGRAM
+
+    def close(self):
+        self.closed = True
+
+
+class Delivered(Exception):
+    pass
+
+
+def test_reader_reopens_failed_port(gateway, monkeypatch):
+    monkeypatch.setattr(serial, "Serial", FailingSerial)
+    monkeypatch.setattr("src.smartmeter.pipeline.sleep", lambda seconds: None)
+    received = []
+
+    def deliver(meter, data, received_at, time):
+        received.append(data)
+        raise Delivered
+
+    reader = SerialReader(gateway.meters[0], deliver)
+    with pytest.raises(Delivered):
+        reader.run()
+    assert FailingSerial.opened == 2
+    assert received == [TELEGRAM]
@@ -0,0 +1,140 @@
+import psycopg2
+import pytest
+from src.smartmeter.postgresql_writer import PostgresWriter
+
+
+# writer whose inserts are recorded instead of sent to a database
+@pytest.fixture
+def writer(monkeypatch):
+    writer = PostgresWriter({}, batch_size=3, max_age=60)
+    writer.inserted = []
+
+    def insert(rows):
+        writer.inserted.append(list(rows))
+        return list(range(len(rows)))
+
+    monkeypatch.setattr(writer, "_insert", insert)
+    return writer
+
+
+def test_add_flushes_by_size(writer):
+    assert writer.add((1,)) == []
+    assert writer.add((2,)) == []
+    assert writer.add((3,)) == [0, 1, 2]
+    assert writer.inserted == [[(1,), (2,), (3,)]]
+    assert writer.rows == []
+
+
+def test_add_flushes_by_age(writer):
+    writer.max_age = 0
+    assert writer.add((1,)) == [0]
+
+
+def test_flush_reconnects(writer, monkeypatch):
+    calls = []
+
+    def insert(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            raise psycopg2.OperationalError("server closed the connection")
+        return [7]
+
+    monkeypatch.setattr(writer, "_insert", insert)
+    writer.rows = [(1,)]
+    writer.first_row_at = 0
+    assert writer.flush() == [7]
+    assert len(calls) == 2
+
+
+def test_flush_keeps_rows_on_error(writer, monkeypatch):
+    def insert(rows):
+        raise psycopg2.OperationalError("database is down")
+
+    monkeypatch.setattr(writer, "_insert", insert)
+    writer.rows = [(1,)]
+    with pytest.raises(psycopg2.OperationalError):
+        writer.flush()
+    assert writer.rows == [(1,)]
+
+
+# insert failing for a batch which contains the row (2,)
+def reject_two(writer):
+    def insert(rows):
+        if (2,) in rows:
+            raise psycopg2.DataError("integer out of range")
+        writer.inserted.append(list(rows))
+        return [row[0] * 10 for row in rows]
+
+    return insert
+
+
+def test_flush_drops_rejected_rows(writer, monkeypatch):
+    monkeypatch.setattr(writer, "_insert", reject_two(writer))
+    assert writer.add((1,)) == []
+    assert writer.add((2,)) == []
+    assert writer.add((3,)) == [10, 30]
+    assert writer.inserted == [[(1,)], [(3,)]]
+    assert writer.rows == []
+    # the writer is not stuck on the rejected row
+    writer.add((4,))
+    writer.add((5,))
+    assert writer.add((6,)) == [40, 50, 60]
+
+
+def test_flush_keeps_rest_when_connection_lost_row_by_row(writer, monkeypatch):
+    insert = reject_two(writer)
+
+    def insert_until_down(rows):
+        if rows == [(3,)]:
+            raise psycopg2.OperationalError("database is down")
+        return insert(rows)
+
+    monkeypatch.setattr(writer, "_insert", insert_until_down)
+    writer.rows = [(1,), (2,), (3,)]
+    with pytest.raises(psycopg2.OperationalError):
+        writer.flush()
+    assert writer.rows == [(3,)]
+
+
+def test_insert_skips_frame_counters_stored_with_another_time():
+    writer = PostgresWriter({})
+    # useMeterTime: False, the unique index does not cover this
+    assert "s.frame_counter = v.frame_counter" in writer.sql
+    assert "s.frame_counter = v.frame_counter" in writer.load_sql
+    # every value is typed, a batch without any voltage is still no text column
+    assert writer.template.count("%s") == len(writer.columns)
+    assert writer.template.startswith("(%s::TIMESTAMP, %s::VARCHAR(32), %s::BIGINT")
+
+
+# connection which keeps the data sent with COPY
+class CopyConnection:
+    closed = False
+    rowcount = 1
+
+    def __init__(self) -> None:
+        self.copied = None
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql):
+        pass
+
+    def copy_expert(self, sql, file):
+        self.copied = file.read()
+
+    def commit(self):
+        pass
+
+
+def test_copy_escapes_the_text_format():
+    writer = PostgresWriter({})
+    writer.conn = CopyConnection()
+    assert writer.copy([(1, "a\\b\tc\nd\re", None)]) == 1
+    assert writer.conn.copied == "1\ta\\\\b\\tc\\nd\\re\t\\N\n"
@@ -0,0 +1,29 @@
+import threading
+
+from src.smartmeter.profiler import SamplingProfiler
+
+
+def busy(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profiler_writes_folded_stacks(tmp_path):
+    path = str(tmp_path / "profile.folded")
+    stop = threading.Event()
+    worker = threading.Thread(target=busy, args=(stop,), name="busy")
+    worker.start()
+    profiler = SamplingProfiler(path, interval=0.001)
+    profiler.start()
+    while profiler.samples < 20:
+        stop.wait(0.01)
+    profiler.stop()
+    stop.set()
+    worker.join()
+    with open(path) as file:
+        stacks = [line.rsplit(" ", 1) for line in file.read().splitlines()]
+    busy_stacks = [
+        (stack, count) for stack, count in stacks if stack.startswith("busy;")
+    ]
+    assert busy_stacks
+    assert all("busy (test_profiler.py" in stack for stack, _ in busy_stacks)
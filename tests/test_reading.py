@@ -0,0 +1,39 @@
+import pickle
+import sys
+
+import pytest
+from src.smartmeter.reading import Reading, ReadingBatch
+from tests.helpers import row
+
+
+def reading(i: int) -> Reading:
+    time, meter_id, frame_counter, *values = row(i)
+    return Reading(time, meter_id, frame_counter, values, device_time=time)
+
+
+def test_reading_is_immutable():
+    first = reading(1)
+    with pytest.raises(AttributeError):
+        first.frame_counter = 2
+    assert not hasattr(first, "__dict__")
+    assert pickle.loads(pickle.dumps(first)) == first
+
+
+def test_batch_round_trip():
+    batch = ReadingBatch()
+    readings = [reading(1), Reading(*row(2)[:3], (None,) * 11), reading(3)]
+    batch.extend(readings)
+    assert len(batch) == 3
+    assert list(batch.readings()) == readings
+    assert list(batch.rows())[0] == row(1)
+    assert isinstance(list(batch.rows())[0][3], int)
+
+
+def test_batch_memory_per_reading():
+    batch = ReadingBatch()
+    readings = [reading(i) for i in range(1000)]
+    batch.extend(readings)
+    # a processed data dict with its values, as buffered before
+    data = dict(zip(("FrameCounter", *map(str, range(11))), row(1)[2:]))
+    per_dict = sys.getsizeof(data) + sum(sys.getsizeof(v) for v in data.values())
+    assert batch.nbytes() / len(batch) * 5 < per_dict
@@ -0,0 +1,34 @@
+import gzip
+from src.smartmeter import replay
+from tests.helpers import EVN_ENCRYPTED_APDU, EVN_KEY
+
+TELEGRAM = bytes.fromhex(EVN_ENCRYPTED_APDU)
+
+
+def test_read_capture_binary(tmp_path):
+    path = tmp_path / "capture.bin"
+    path.write_bytes(b"\x00\x16" + TELEGRAM * 3)
+    assert list(replay.read_capture(path)) == [TELEGRAM] * 3
+
+
+def test_read_capture_hex_gzip(tmp_path):
+    path = tmp_path / "capture.hex.gz"
+    lines = [EVN_ENCRYPTED_APDU[:101], EVN_ENCRYPTED_APDU[101:], EVN_ENCRYPTED_APDU]
+    with gzip.open(path, "wt") as file:
+        file.write("\n".join(lines) + "\n")
+    assert list(replay.read_capture(path)) == [TELEGRAM] * 2
+
+
+def test_replay_dry_run(tmp_path):
+    path = tmp_path / "capture.bin"
+    path.write_bytes(TELEGRAM * 5)
+    assert replay.replay([path], EVN_KEY, workers=1, chunk_size=2, store=False) == 5
+
+
+def test_replay_telegram_split_between_files(tmp_path):
+    # a rotated capture: the first file ends within a telegram
+    first, second = tmp_path / "capture.1.bin", tmp_path / "capture.2.bin"
+    first.write_bytes(TELEGRAM * 2 + TELEGRAM[:100])
+    second.write_bytes(TELEGRAM[100:] + TELEGRAM)
+    count = replay.replay([first, second], EVN_KEY, workers=0, store=False)
+    assert count == 4
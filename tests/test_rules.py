@@ -0,0 +1,106 @@
+import json
+import sys
+from datetime import timedelta
+
+import pytest
+
+from src.smartmeter import rules, sinks
+from src.smartmeter.config import ConfigError
+from src.smartmeter.reading import ReadingBatch
+from tests.helpers import TIME, reading
+
+CONFIG = {
+    "rules": [
+        {"name": "overvoltage_l1", "field": "SpannungL1", "max": 253},
+        {
+            "name": "imbalance",
+            "fields": ["SpannungL1", "SpannungL2", "SpannungL3"],
+            "spread": 10,
+        },
+        {"name": "power_jump", "field": "MomentanleistungP", "rate": 100},
+        {
+            "name": "power_anomaly",
+            "field": "MomentanleistungP",
+            "zscore": 4,
+            "warmup": 10,
+        },
+    ]
+}
+
+
+def test_events_on_transitions_only():
+    engine = rules.RuleEngine(rules.rules_from_config(CONFIG))
+    assert engine.evaluate(reading(1)) == []
+    (event,) = engine.evaluate(
+        reading(2, SpannungL1=255.0, SpannungL2=255.0, SpannungL3=255.0)
+    )
+    assert (event.rule, event.state, event.value) == ("overvoltage_l1", "raised", 255.0)
+    # still above, no new event
+    assert (
+        engine.evaluate(
+            reading(3, SpannungL1=256.0, SpannungL2=256.0, SpannungL3=256.0)
+        )
+        == []
+    )
+    # another meter has its own state
+    assert len(engine.evaluate(reading(3, "werkstatt", SpannungL1=256.0))) == 2
+    (event,) = engine.evaluate(reading(4))
+    assert (event.rule, event.state) == ("overvoltage_l1", "cleared")
+
+
+def test_rate_and_zscore():
+    engine = rules.RuleEngine(rules.rules_from_config(CONFIG))
+    for i in range(12):
+        # a little noise, 5 s apart
+        assert engine.evaluate(reading(i, MomentanleistungP=150.0 + i % 2)) == []
+    events = engine.evaluate(reading(12, MomentanleistungP=2000.0))
+    assert {(event.rule, event.state) for event in events} == {
+        ("power_jump", "raised"),
+        ("power_anomaly", "raised"),
+    }
+    rate = next(event for event in events if event.rule == "power_jump")
+    assert rate.value == pytest.approx((2000 - 151) / 5)
+
+
+def test_messages_by_state():
+    engine = rules.RuleEngine(rules.rules_from_config(CONFIG))
+    engine.evaluate(reading(0))
+    events = engine.evaluate(reading(1, SpannungL1=256.0, MomentanleistungP=1000.0))
+    assert {event.rule: event.message for event in events} == {
+        "overvoltage_l1": "256.0 above 253",
+        "imbalance": "spread 26.20 above 10",
+        "power_jump": "change 170.00/s above 100/s",
+    }
+    events = engine.evaluate(reading(2, MomentanleistungP=1000.0))
+    assert {event.rule: (event.state, event.message) for event in events} == {
+        "overvoltage_l1": ("cleared", "230.1 no longer above 253"),
+        "imbalance": ("cleared", "spread 1.20 no longer above 10"),
+        "power_jump": ("cleared", "change 0.00/s no longer above 100/s"),
+    }
+    rule = rules.ZScoreRule("power_anomaly", (0,), 4)
+    assert rule.describe(1.5, False) == "z-score 1.50 no longer beyond 4"
+
+
+def test_invalid_rules():
+    with pytest.raises(ConfigError):
+        rules.rules_from_config(
+            {"rules": [{"name": "x", "field": "Unknown", "max": 1}]}
+        )
+    with pytest.raises(ConfigError):
+        rules.rules_from_config({"rules": [{"name": "x", "field": "SpannungL1"}]})
+
+
+def test_sink_calls_hooks(tmp_path):
+    sink = sinks.RulesSink(
+        rules.RuleEngine(rules.rules_from_config(CONFIG)),
+        hook=f"{sys.executable} -c \"import sys; open(r'{tmp_path / 'event.json'}', 'w').write(sys.stdin.read())\"",
+    )
+    received = []
+    sink.hooks.append(received.append)
+    batch = ReadingBatch()
+    batch.extend([reading(1), reading(2, SpannungL1=260.0)])
+    sink.write(batch)
+    assert [event.rule for event in received] == ["overvoltage_l1", "imbalance"]
+    event = json.loads((tmp_path / "event.json").read_text())
+    assert event["rule"] == "imbalance"
+    assert event["time"] == (TIME + timedelta(seconds=10)).isoformat()
@@ -0,0 +1,73 @@
+from datetime import date, datetime
+from src.smartmeter import schema
+
+
+# cursor recording the executed statements
+class Cursor:
+    def __init__(self, results=()):
+        self.statements = []
+        self.results = list(results)
+
+    def execute(self, statement, params=None):
+        self.statements.append((" ".join(statement.split()), params))
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+
+def test_next_month():
+    assert schema.next_month(date(2021, 9, 1)) == date(2021, 10, 1)
+    assert schema.next_month(date(2021, 12, 1)) == date(2022, 1, 1)
+
+
+def test_ensure_partitions_for():
+    manager = schema.SchemaManager()
+    cur = Cursor()
+    times = [datetime(2021, 9, 27, 9, 47), datetime(2021, 9, 30), datetime(2021, 11, 1)]
+    manager.ensure_partitions_for(cur, times)
+    manager.ensure_partitions_for(cur, times)
+    assert [statement for statement, _ in cur.statements] == [
+        "CREATE TABLE IF NOT EXISTS smartmeter_2021_09 PARTITION OF smartmeter FOR VALUES FROM ('2021-09-01') TO ('2021-10-01')",
+        "CREATE TABLE IF NOT EXISTS smartmeter_2021_11 PARTITION OF smartmeter FOR VALUES FROM ('2021-11-01') TO ('2021-12-01')",
+    ]
+
+
+def test_refresh_rollups_incremental():
+    manager = schema.SchemaManager()
+    end = datetime(2021, 9, 27, 10, 0, 3)
+    refreshed_until = datetime(2021, 9, 27, 9, 47, 15)
+    cur = Cursor([(end,)] + [(refreshed_until,)] * len(schema.ROLLUPS))
+    manager.refresh_rollups(cur)
+    starts = [
+        params["start"]
+        for statement, params in cur.statements
+        if "GROUP BY" in statement
+    ]
+    # 15 minutes before the last refresh, at the start of the bucket
+    assert starts == [
+        datetime(2021, 9, 27, 9, 32),
+        datetime(2021, 9, 27, 9, 30),
+        datetime(2021, 9, 27, 9, 0),
+    ]
+
+
+def test_refresh_rollups_late_batch():
+    manager = schema.SchemaManager()
+    end = datetime(2021, 9, 27, 10, 0, 3)
+    refreshed_until = datetime(2021, 9, 27, 9, 47, 15)
+    # a batch drained from the spool, stored after the last refresh
+    manager.touch(datetime(2021, 9, 27, 8, 5, 30))
+    manager.touch(datetime(2021, 9, 27, 9, 59))
+    cur = Cursor([(end,)] + [(refreshed_until,)] * len(schema.ROLLUPS))
+    manager.refresh_rollups(cur)
+    starts = [
+        params["start"]
+        for statement, params in cur.statements
+        if "GROUP BY" in statement
+    ]
+    assert starts == [
+        datetime(2021, 9, 27, 8, 5),
+        datetime(2021, 9, 27, 8, 0),
+        datetime(2021, 9, 27, 8, 0),
+    ]
+    assert manager.touched_since is None
@@ -0,0 +1,107 @@
+import csv
+import json
+import sqlite3
+from types import SimpleNamespace
+
+from src.smartmeter import sinks
+from src.smartmeter.obis import DEFAULT_FIELDS, ObisField, ObisRegistry, parse_code
+from src.smartmeter.postgresql_writer import PostgresWriter
+from tests.helpers import batch, reading, row
+
+
+def test_csv_and_ndjson(tmp_path):
+    csv_sink = sinks.CsvSink(str(tmp_path / "smartmeter.csv"))
+    csv_sink.write(batch(1, 2))
+    csv_sink.close()
+    with open(tmp_path / "smartmeter.csv") as file:
+        lines = list(csv.reader(file))
+    assert lines[0] == list(sinks.DEFAULT_REGISTRY.row_columns)
+    assert lines[2][1:4] == ["haus", "2", "12939"]
+
+    ndjson_sink = sinks.NdjsonSink(str(tmp_path / "smartmeter.ndjson"))
+    ndjson_sink.write(batch(1))
+    ndjson_sink.close()
+    record = json.loads((tmp_path / "smartmeter.ndjson").read_text())
+    assert record["time"] == "2023-05-01T12:00:05.250000"
+    assert record["wirkenergie_p"] == 12938
+
+
+def test_sqlite_skips_stored_rows(tmp_path):
+    path = str(tmp_path / "smartmeter.sqlite")
+    sink = sinks.SqliteSink(path)
+    sink.write(batch(1, 2))
+    sink.write(batch(2, 3))
+    sink.close()
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT count(*) FROM smartmeter").fetchone() == (3,)
+
+
+# sink which records the rows
+class RecordingSink(sinks.Sink):
+    def __init__(self) -> None:
+        self.rows = []
+
+    def write(self, batch):
+        self.rows.extend(batch.rows())
+
+
+def test_buffered_sink_drops_when_full():
+    sink = RecordingSink()
+    buffered = sinks.BufferedSink("recording", sink, batch_size=10, queue_size=2)
+    # not started: nothing is written until stop
+    for i in range(5):
+        buffered.put(reading(i))
+    assert buffered.snapshot()["dropped"] == 3
+    buffered.start()
+    buffered.stop()
+    assert sink.rows == [row(0), row(1)]
+    assert buffered.written == 2
+
+
+def test_sink_configs_fallback():
+    assert sinks.sink_configs({"usePostgres": True, "printValue": False}) == [
+        {"type": "postgres"}
+    ]
+    assert sinks.sink_configs({"usePostgres": True, "sinks": [{"type": "csv"}]}) == [
+        {"type": "csv"}
+    ]
+
+
+def test_buffered_sink_writes_by_age():
+    sink = RecordingSink()
+    buffered = sinks.BufferedSink("recording", sink, batch_size=10, max_age=0.05)
+    buffered.start()
+    buffered.put(reading(1))
+    buffered.join(0.5)
+    assert sink.rows == [row(1)]
+    buffered.stop()
+
+
+def test_file_sinks_use_configured_registry(tmp_path):
+    field = ObisField(
+        parse_code("1.0.3.8.0.255"), "BlindenergieP", "blindenergie_p", "BIGINT"
+    )
+    decoder = SimpleNamespace(registry=ObisRegistry(DEFAULT_FIELDS + (field,)))
+    for kind in ("csv", "ndjson"):
+        path = str(tmp_path / f"smartmeter.{kind}")
+        sink = sinks.open_sink({"type": kind, "path": path}, decoder)
+        sink.close()
+    with open(tmp_path / "smartmeter.csv") as file:
+        assert next(csv.reader(file))[-1] == "blindenergie_p"
+    assert sink.columns[-1] == "blindenergie_p"
+
+
+def test_postgres_sink_writes_partial_batch_on_close(smartmeterpostgres, monkeypatch):
+    writer = PostgresWriter({}, batch_size=10)
+    inserted = []
+    monkeypatch.setattr(
+        writer, "_insert", lambda rows: inserted.extend(rows) or list(range(len(rows)))
+    )
+    smartmeterpostgres.writer = writer
+    sink = sinks.PostgresSink(smartmeterpostgres)
+    sink.write(batch(1, 2))
+    assert inserted == []
+    # the shutdown path of the gateway: BufferedSink.stop closes the sink
+    sink.close()
+    assert inserted == [row(1), row(2)]
+    assert smartmeterpostgres.writer is None
@@ -0,0 +1,125 @@
+import os
+
+import psycopg2
+from src.smartmeter.spool import RecordFormat, Spool, SpoolDrainer
+from tests.helpers import row
+
+RECORD_SIZE = RecordFormat().size
+
+
+# writer which fails a number of times before it accepts rows
+class FakeWriter:
+    def __init__(self, failures: int = 0, rejected: tuple = ()) -> None:
+        self.failures = failures
+        self.rejected = rejected  # rows the database refuses
+        self.rows = []
+
+    def copy(self, rows):
+        if any(row in self.rejected for row in rows):
+            raise psycopg2.DataError("integer out of range")
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError("connection refused")
+        self.rows.extend(rows)
+        return len(rows)
+
+
+def test_append_and_read(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(row(1))
+    spool.append(row(2)[:2] + (None,) * 12)
+    rows, position = spool.read(10)
+    assert rows == [row(1), row(2)[:2] + (None,) * 12]
+    assert isinstance(rows[0][3], int)
+    assert position == (spool.segment, 2 * RECORD_SIZE)
+
+
+def test_negative_integers_are_no_none(tmp_path):
+    spool = Spool(str(tmp_path))
+    negative = row(1)[:2] + (-1, -12937) + row(1)[4:]
+    spool.append(negative)
+    assert spool.read(10)[0] == [negative]
+
+
+def test_restart_continues_after_checkpoint(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=3 * RECORD_SIZE)
+    for i in range(5):
+        spool.append(row(i))
+    rows, position = spool.read(2)
+    spool.commit(position)
+    spool.append(row(5))
+    spool.close()
+    # a torn record at the end of a segment is skipped
+    with open(spool.path(spool.segment), "ab") as file:
+        file.write(b"\x01\x02")
+
+    spool = Spool(str(tmp_path), segment_size=3 * RECORD_SIZE)
+    spool.append(row(6))
+    rows, position = spool.read(100)
+    assert rows == [row(i) for i in range(2, 7)]
+    spool.commit(position)
+    assert spool.segments() == [spool.segment]
+
+
+def test_max_bytes_drops_oldest_segments(tmp_path):
+    spool = Spool(
+        str(tmp_path), segment_size=2 * RECORD_SIZE, max_bytes=4 * RECORD_SIZE
+    )
+    for i in range(10):
+        spool.append(row(i))
+    rows, _ = spool.read(100)
+    assert rows[-1] == row(9)
+    assert len(rows) <= 6
+    assert (
+        sum(os.path.getsize(spool.path(s)) for s in spool.segments()) <= 6 * RECORD_SIZE
+    )
+
+
+def test_drainer_keeps_rows_while_database_is_down(tmp_path):
+    spool = Spool(str(tmp_path))
+    writer = FakeWriter(failures=1)
+    drainer = SpoolDrainer(spool, writer, batch_size=2)
+    for i in range(3):
+        spool.append(row(i))
+    try:
+        drainer.drain()
+    except psycopg2.OperationalError:
+        pass
+    assert writer.rows == []
+    assert drainer.drain() == 3
+    assert writer.rows == [row(i) for i in range(3)]
+    assert drainer.drain() == 0
+
+
+def test_drainer_quarantines_rejected_rows(tmp_path):
+    spool = Spool(str(tmp_path))
+    writer = FakeWriter(rejected=(row(1),))
+    drainer = SpoolDrainer(spool, writer, batch_size=2)
+    for i in range(3):
+        spool.append(row(i))
+    assert drainer.drain() == 1
+    assert writer.rows == [row(2)]
+    (name,) = os.listdir(tmp_path / "quarantine")
+    with open(tmp_path / "quarantine" / name, "rb") as file:
+        data = file.read()
+    assert [
+        spool.format.unpack(data[start : start + RECORD_SIZE])
+        for start in range(0, len(data), RECORD_SIZE)
+    ] == [row(0), row(1)]
+
+
+def test_drainer_survives_unexpected_errors(tmp_path, monkeypatch):
+    spool = Spool(str(tmp_path))
+    drainer = SpoolDrainer(spool, FakeWriter(), interval=0.01)
+    calls = []
+
+    def drain():
+        calls.append(1)
+        if len(calls) == 1:
+            raise UnicodeDecodeError("utf-8", b"\xc3", 0, 1, "unexpected end of data")
+        drainer.stopped.set()
+        return 0
+
+    monkeypatch.setattr(drainer, "drain", drain)
+    drainer.run()
+    assert len(calls) == 2